@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for input_slicer._get_region
+#
+# Compares the original per-base dictionary encoding against the vectorized
+# byte-table encoding on a synthetic chromosome and reports windows/s.
+#
+# python benchmarks/bench_encode.py [-L 500] [-B 100] [-C 1000000]
+
+import argparse, os, shutil, tempfile, sys
+from time import time
+import numpy as np
+import pysam
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from teamRNN import reader
+from teamRNN.constants import base2index, contexts
+
+def make_chrom(out_dir, chrom_len, seed=42):
+	'''
+	Writes a random chromosome and a methratio record for every C/G
+	'''
+	rng = np.random.RandomState(seed)
+	seq = ''.join(rng.choice(list('ACGT'), chrom_len))
+	fa = os.path.join(out_dir, 'synthetic.fa')
+	with open(fa, 'w') as FA:
+		FA.write('>Chr1 dna:chromosome\n')
+		for i in range(0, chrom_len, 60):
+			FA.write(seq[i:i+60]+'\n')
+	pysam.faidx(fa)
+	mr = os.path.join(out_dir, 'synthetic_meth.txt')
+	with open(mr, 'w') as MR:
+		MR.write('\t'.join(('chr','pos','strand','context','ratio','eff_CT_count','C_count',\
+			'CT_count','rev_G_count','rev_GA_count','CI_lower','CI_upper'))+'\n')
+		for i, b in enumerate(seq):
+			if b in 'CG':
+				ct = rng.randint(1, 40)
+				c = rng.randint(0, ct+1)
+				MR.write('Chr1\t%i\t%s\t%s\t%.3f\t%i.00\t%i\t%i\t0\t0\t0.0\t0.0\n'%(i+1, \
+					'+' if b == 'C' else '-', contexts[rng.randint(3)], c/float(ct), ct, c, ct))
+	return fa, mr
+
+def legacy_get_region(IS, chrom, cur, chrom_len, chrom_quality, seq_len):
+	'''
+	The original per-window transform
+	'''
+	seq = IS.legacy_RC.fetch(chrom, cur, cur+seq_len)
+	meth = IS.MC.M5.fetch(chrom, cur+1, cur+seq_len)
+	out_slice = np.zeros((len(seq), 10), dtype=np.float32)
+	out_slice[:,0] = [base2index[b] for b in seq]
+	out_slice[:,1] = np.arange(cur+1,cur+len(seq)+1)/float(chrom_len)
+	out_slice[:,8] = IS.ploidy
+	out_slice[:,9] = chrom_quality
+	not_n1 = meth[:,0] != -1
+	new_index = meth[not_n1, 0]*2+2
+	out_slice[not_n1, new_index] = np.true_divide(meth[not_n1, 2], meth[not_n1, 3])
+	out_slice[not_n1, new_index+1] = meth[not_n1, 3]
+	return ((chrom, cur, cur+seq_len), out_slice)
+
+def run(func, IS, chrom_len, full_len, step, n_regions):
+	starts = range(0, chrom_len-full_len+1, step)[:n_regions]
+	s_time = time()
+	for cur in starts:
+		func(IS, 'Chr1', cur, chrom_len, 3, full_len)
+	return len(starts), time()-s_time
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark input_slicer region encoding")
+	parser.add_argument('-L', '--sequence_length', metavar='INT', default=500, type=int, help='Window length [%(default)s]')
+	parser.add_argument('-B', '--batch_size', metavar='INT', default=100, type=int, help='Windows per batch [%(default)s]')
+	parser.add_argument('-o', '--offset', metavar='INT', default=1, type=int, help='Window offset [%(default)s]')
+	parser.add_argument('-C', '--chrom_len', metavar='INT', default=1000000, type=int, help='Synthetic chromosome length [%(default)s]')
+	parser.add_argument('-N', '--regions', metavar='INT', default=500, type=int, help='Batch regions to time [%(default)s]')
+	args = parser.parse_args()
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		fa, mr = make_chrom(tmp_dir, args.chrom_len)
+		IS = reader.input_slicer(fa, mr)
+		IS.legacy_RC = reader.refcache(fa)
+		full_len = args.sequence_length+(args.batch_size-1)*args.offset
+		step = args.offset*args.batch_size
+		new_func = lambda IS, *a: IS._get_region(*a)
+		for name, func in (('before', legacy_get_region), ('after', new_func)):
+			# warm up caches
+			run(func, IS, args.chrom_len, full_len, step, 5)
+			n, elapsed = run(func, IS, args.chrom_len, full_len, step, args.regions)
+			print("%-6s %8.1f windows/s (%i regions of %i bases in %.2fs)"%(name, \
+				n*args.batch_size/elapsed, n, full_len, elapsed))
+		del IS
+	finally:
+		shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+	main()
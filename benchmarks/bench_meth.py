@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for methylation loading
+#
+# Compares one Meth5py.fetch per window against the chunked methcache
+# loader on a synthetic chromosome and reports reads/s.
+#
+# python benchmarks/bench_meth.py [-L 500] [-C 1000000]
+
+import argparse, os, shutil, tempfile, sys
+from time import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from teamRNN import reader
+from bench_encode import make_chrom
+
+def time_reads(fetch, starts, seq_len):
+	s_time = time()
+	for cur in starts:
+		fetch(cur, seq_len)
+	return time()-s_time
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark methylation loading")
+	parser.add_argument('-L', '--sequence_length', metavar='INT', default=500, type=int, help='Window length [%(default)s]')
+	parser.add_argument('-o', '--offset', metavar='INT', default=1, type=int, help='Window offset [%(default)s]')
+	parser.add_argument('-C', '--chrom_len', metavar='INT', default=1000000, type=int, help='Synthetic chromosome length [%(default)s]')
+	parser.add_argument('-N', '--reads', metavar='INT', default=20000, type=int, help='Windows to read [%(default)s]')
+	args = parser.parse_args()
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		fa, mr = make_chrom(tmp_dir, args.chrom_len)
+		MC = reader.methcache(mr, fa)
+		starts = list(range(0, args.chrom_len-args.sequence_length+1, args.offset))[:args.reads]
+		# Both paths must agree
+		for cur in starts[:100]:
+			old = MC.M5.fetch('Chr1', cur+1, cur+args.sequence_length)
+			new = MC.fetch('Chr1', cur, cur+args.sequence_length)
+			for i, col in enumerate(new):
+				assert(np.array_equal(old[:,i], col))
+		funcs = (('Meth5py.fetch', lambda cur, n: MC.M5.fetch('Chr1', cur+1, cur+n)), \
+			('methcache', lambda cur, n: MC.fetch('Chr1', cur, cur+n)))
+		for name, func in funcs:
+			elapsed = time_reads(func, starts, args.sequence_length)
+			print("%-14s %10.1f reads/s (%i windows of %i bases in %.2fs)"%(name, \
+				len(starts)/elapsed, len(starts), args.sequence_length, elapsed))
+		MC.close()
+	finally:
+		shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for reference loading
+#
+# Compares refcache string fetches plus encode_seq against the 2-bit
+# packed_reference on a synthetic chromosome and reports windows/s and
+# the resident memory each one holds.
+#
+# python benchmarks/bench_reference.py [-L 500] [-C 1000000]
+
+import argparse, os, shutil, tempfile, sys, resource
+from time import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from teamRNN import reader
+from bench_encode import make_chrom
+
+def rss_mb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark reference loading")
+	parser.add_argument('-L', '--sequence_length', metavar='INT', default=500, type=int, help='Window length [%(default)s]')
+	parser.add_argument('-C', '--chrom_len', metavar='INT', default=1000000, type=int, help='Synthetic chromosome length [%(default)s]')
+	parser.add_argument('-N', '--reads', metavar='INT', default=20000, type=int, help='Windows to read [%(default)s]')
+	args = parser.parse_args()
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		fa, mr = make_chrom(tmp_dir, args.chrom_len)
+		rng = np.random.RandomState(1)
+		starts = rng.randint(0, args.chrom_len-args.sequence_length, args.reads)
+		s_time = time()
+		PR = reader.packed_reference(fa)
+		print("packed store built in %.2fs (%i bytes on disk)"%(time()-s_time, \
+			sum(os.path.getsize(f) for f in PR._track_files('Chr1'))))
+		RC = reader.refcache(fa)
+		funcs = (('refcache', lambda cur: reader.encode_seq(RC.fetch('Chr1', cur, cur+args.sequence_length))), \
+			('packed', lambda cur: PR.fetch('Chr1', cur, cur+args.sequence_length)))
+		for cur in starts[:100]:
+			assert(np.array_equal(funcs[0][1](cur), funcs[1][1](cur)))
+		for name, func in funcs:
+			s_time = time()
+			for cur in starts:
+				func(cur)
+			elapsed = time()-s_time
+			print("%-9s %10.1f windows/s (%i random windows of %i bases in %.2fs)"%(name, \
+				len(starts)/elapsed, len(starts), args.sequence_length, elapsed))
+		print("peak RSS %.1f MB"%(rss_mb()))
+	finally:
+		shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+	main()
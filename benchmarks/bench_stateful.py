@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for stateful batch assembly
+#
+# Compares the original pool path, where workers pickle each region back
+# to the parent, against workers writing into the shared batch buffer,
+# and reports batches/s.
+#
+# python benchmarks/bench_stateful.py [-L 500] [-B 100] [-W 4]
+
+import argparse, os, shutil, tempfile, sys
+from functools import partial
+from time import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from teamRNN import reader
+from bench_encode import make_chrom
+
+def legacy_batch(IS, region_starts, chrom, chrom_len, chrom_quality, seq_len):
+	'''
+	The original imap of pickled regions followed by np.array
+	'''
+	partial_wgr = partial(reader.worker_get_region, chrom=chrom, chrom_len=chrom_len, chrom_quality=chrom_quality, seq_len=seq_len)
+	c, x = zip(*IS.pool.imap(partial_wgr, region_starts, chunksize=25))
+	return (list(c), np.array(x))
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark stateful batch assembly")
+	parser.add_argument('-L', '--sequence_length', metavar='INT', default=500, type=int, help='Window length [%(default)s]')
+	parser.add_argument('-B', '--batch_size', metavar='INT', default=100, type=int, help='Contigs per batch [%(default)s]')
+	parser.add_argument('-W', '--workers', metavar='INT', default=4, type=int, help='Worker processes [%(default)s]')
+	parser.add_argument('-C', '--chrom_len', metavar='INT', default=2000000, type=int, help='Synthetic chromosome length [%(default)s]')
+	parser.add_argument('-N', '--batches', metavar='INT', default=20, type=int, help='Batches to time [%(default)s]')
+	args = parser.parse_args()
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		fa, mr = make_chrom(tmp_dir, args.chrom_len)
+		IS = reader.input_slicer(fa, mr, stateful=True, workers=args.workers)
+		L = args.sequence_length
+		contig_len = args.chrom_len//args.batch_size
+		assert(contig_len >= args.batches*L)
+		starts = np.arange(args.batch_size)*contig_len
+		legacy = partial(legacy_batch, IS, chrom='Chr1', chrom_len=args.chrom_len, chrom_quality=3, seq_len=L)
+		shared = partial(IS._pool_batch, chrom='Chr1', chrom_len=args.chrom_len, chrom_quality=3, seq_len=L)
+		assert(np.array_equal(legacy(starts)[1], shared(starts)[1]))
+		for name, func in (('pickled', legacy), ('shared', shared)):
+			s_time = time()
+			for iB in range(args.batches):
+				func(starts+iB*L)
+			elapsed = time()-s_time
+			print("%-8s %8.2f batches/s (%i batches of %i x %i with %i workers in %.2fs)"%(name, \
+				args.batches/elapsed, args.batches, args.batch_size, L, args.workers, elapsed))
+		del IS
+	finally:
+		shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for switching chromosomes in output_aggregator
+#
+# Votes windows on several synthetic chromosomes in an interleaved order
+# (as when Horovod shards or out-of-order batches revisit chromosomes) and
+# compares the original full-array HDF5 swapping against the block cache
+# at several memory budgets.
+#
+# python benchmarks/bench_swap.py [-C 2000000] [-c 4] [-S 16]
+
+import argparse, os, shutil, tempfile, sys
+from time import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from teamRNN import writer
+from teamRNN.constants import gff3_i2f
+from bench_vote import make_predictions
+import h5py, pysam
+
+def make_genome(out_dir, n_chroms, chrom_len, seed=42):
+	rng = np.random.RandomState(seed)
+	fa = os.path.join(out_dir, 'synthetic.fa')
+	with open(fa, 'w') as FA:
+		for c in range(n_chroms):
+			seq = ''.join(rng.choice(list('ACGT'), chrom_len))
+			FA.write('>Chr%i dna:chromosome\n'%(c+1))
+			for i in range(0, chrom_len, 60):
+				FA.write(seq[i:i+60]+'\n')
+	pysam.faidx(fa)
+	return fa
+
+class legacy_aggregator:
+	'''
+	The original dense uint32 arrays, swapped in and out of HDF5 whole
+	'''
+	def __init__(self, chrom_dict, h5_file):
+		self.H5 = h5py.File(h5_file, 'w')
+		for chrom, chrom_len in chrom_dict.items():
+			for name, n_cols in (('/votes', len(gff3_i2f)), ('/totals', 1)):
+				self.H5.create_dataset(chrom+name, (chrom_len, n_cols), compression='gzip', \
+					compression_opts=6, chunks=True, fillvalue=0, dtype=np.uint32)
+		self.cur_chrom = chrom
+		self.votes = np.zeros(self.H5[chrom+'/votes'].shape, dtype=np.uint32)
+		self.totals = np.zeros(self.H5[chrom+'/totals'].shape, dtype=np.uint32)
+	def _swap(self, chrom):
+		for name, array in (('/votes', self.votes), ('/totals', self.totals)):
+			self.H5[self.cur_chrom+name].write_direct(array)
+		self.votes = self.H5[chrom+'/votes'][:]
+		self.totals = self.H5[chrom+'/totals'][:]
+		self.cur_chrom = chrom
+	def vote(self, chrom, start, end, array):
+		if chrom != self.cur_chrom: self._swap(chrom)
+		self.totals[start:end] += 1
+		self.votes[start:end] += np.minimum(array, 1)
+	def close(self):
+		self.H5.close()
+
+def visits(chroms, chrom_len, seq_len, offset, n_switches, windows):
+	'''
+	Yields (chrom, starts) for every visit, cycling through the chromosomes
+	and advancing through each one
+	'''
+	cur = dict((c, 0) for c in chroms)
+	for i in range(n_switches):
+		chrom = chroms[i%len(chroms)]
+		starts = [(cur[chrom]+j*offset)%(chrom_len-seq_len) for j in range(windows)]
+		cur[chrom] = starts[-1]+offset
+		yield chrom, starts
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark switching chromosomes while voting")
+	parser.add_argument('-L', '--sequence_length', metavar='INT', default=500, type=int, help='Window length [%(default)s]')
+	parser.add_argument('-o', '--offset', metavar='INT', default=50, type=int, help='Window offset [%(default)s]')
+	parser.add_argument('-C', '--chrom_len', metavar='INT', default=2000000, type=int, help='Synthetic chromosome length [%(default)s]')
+	parser.add_argument('-c', '--chroms', metavar='INT', default=4, type=int, help='Number of chromosomes [%(default)s]')
+	parser.add_argument('-S', '--switches', metavar='INT', default=16, type=int, help='Chromosome visits [%(default)s]')
+	parser.add_argument('-W', '--windows', metavar='INT', default=100, type=int, help='Windows voted per visit [%(default)s]')
+	args = parser.parse_args()
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		fa = make_genome(tmp_dir, args.chroms, args.chrom_len)
+		chroms = ['Chr%i'%(c+1) for c in range(args.chroms)]
+		L = args.sequence_length
+		predictions = make_predictions(args.windows, L, True)
+		plan = list(visits(chroms, args.chrom_len, L, args.offset, args.switches, args.windows))
+		# Original swapping
+		LA = legacy_aggregator(dict((c, args.chrom_len) for c in chroms), os.path.join(tmp_dir, 'legacy.h5'))
+		s_time = time()
+		for chrom, starts in plan:
+			for cur, yp in zip(starts, predictions):
+				LA.vote(chrom, cur, cur+L, yp)
+		elapsed = time()-s_time
+		LA.close()
+		print("%-14s %8.2fs (%.3fs per visit)"%('full swap', elapsed, elapsed/len(plan)))
+		for budget in (0, 64, 4):
+			OA = writer.output_aggregator(fa, noTEMD=True, h5_file=os.path.join(tmp_dir, 'votes.h5'), \
+				max_votes=-(-L//args.offset), mem_budget=budget*2**20)
+			s_time = time()
+			for chrom, starts in plan:
+				OA.vote_batch([(chrom, cur, cur+L) for cur in starts], predictions)
+			elapsed = time()-s_time
+			print("%-14s %8.2fs (%.3fs per visit) %s"%('cache %iMB'%(budget) if budget else 'cache', \
+				elapsed, elapsed/len(plan), OA.cache.stats()))
+			OA.close()
+	finally:
+		shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+	main()
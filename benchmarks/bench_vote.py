@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for output_aggregator.vote
+#
+# Compares the original per-base TE order/superfamily voting loop against
+# the vectorized scatter-add, and against voting whole batches with
+# vote_batch, on a synthetic chromosome and reports bases/s with and
+# without TE metadata.
+#
+# python benchmarks/bench_vote.py [-L 500] [-o 50] [-B 100] [-C 1000000]
+
+import argparse, os, shutil, tempfile, sys
+from time import time
+import numpy as np
+import pysam
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from teamRNN import writer
+from teamRNN.constants import gff3_i2f, te_order_i2f, te_sufam_i2f
+
+def make_fasta(out_dir, chrom_len, seed=42):
+	rng = np.random.RandomState(seed)
+	seq = ''.join(rng.choice(list('ACGT'), chrom_len))
+	fa = os.path.join(out_dir, 'synthetic.fa')
+	with open(fa, 'w') as FA:
+		FA.write('>Chr1 dna:chromosome\n')
+		for i in range(0, chrom_len, 60):
+			FA.write(seq[i:i+60]+'\n')
+	pysam.faidx(fa)
+	return fa
+
+def make_predictions(n, seq_len, noTEMD, seed=42):
+	'''
+	Random predictions where each feature column is called in runs
+	'''
+	rng = np.random.RandomState(seed)
+	n_feat = len(gff3_i2f)
+	features = (rng.rand(n, 1, n_feat) < 0.2) & (rng.rand(n, seq_len, 1) < 0.7)
+	if noTEMD: return features.astype(np.uint32)
+	order = rng.randint(0, len(te_order_i2f), (n, seq_len, 1))
+	sufam = rng.randint(0, len(te_sufam_i2f), (n, seq_len, 1))
+	return np.concatenate((features, order, sufam), axis=2).astype(np.uint32)
+
+def legacy_vote(OA, chrom, start, end, array):
+	'''
+	The original vote with a per-base loop over the TE metadata
+	'''
+	n_feat = len(gff3_i2f)
+	if OA.cur_chrom != chrom: OA._load_arrays(chrom)
+	OA.feature_totals.fill(start, end, 1)
+	feature_array = np.minimum(array[:,:n_feat], 1)
+	if np.sum(feature_array):
+		OA.feature_votes.add(start, end, feature_array)
+	if not OA.noTEMD:
+		if sum(array[:,-2]):
+			for i,v in enumerate(array[:,-2]):
+				OA.te_order_votes.fill(start+i, start+i+1, 1, col=v)
+		if sum(array[:,-1]):
+			for i,v in enumerate(array[:,-1]):
+				OA.te_sufam_votes.fill(start+i, start+i+1, 1, col=v)
+
+def run(func, OA, starts, seq_len, predictions):
+	s_time = time()
+	for cur, yp in zip(starts, predictions):
+		func(OA, 'Chr1', cur, cur+seq_len, yp)
+	return time()-s_time
+
+def run_batches(OA, starts, seq_len, predictions, batch_size):
+	s_time = time()
+	for i in range(0, len(starts), batch_size):
+		cb = [('Chr1', cur, cur+seq_len) for cur in starts[i:i+batch_size]]
+		OA.vote_batch(cb, predictions[i:i+batch_size])
+	return time()-s_time
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark output_aggregator voting")
+	parser.add_argument('-L', '--sequence_length', metavar='INT', default=500, type=int, help='Window length [%(default)s]')
+	parser.add_argument('-o', '--offset', metavar='INT', default=50, type=int, help='Window offset [%(default)s]')
+	parser.add_argument('-C', '--chrom_len', metavar='INT', default=1000000, type=int, help='Synthetic chromosome length [%(default)s]')
+	parser.add_argument('-B', '--batch_size', metavar='INT', default=100, type=int, help='Windows per batch [%(default)s]')
+	parser.add_argument('-N', '--windows', metavar='INT', default=2000, type=int, help='Windows to vote [%(default)s]')
+	args = parser.parse_args()
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		fa = make_fasta(tmp_dir, args.chrom_len)
+		starts = list(range(0, args.chrom_len-args.sequence_length+1, args.offset))[:args.windows]
+		max_votes = -(-args.sequence_length//args.offset)
+		new_func = lambda OA, *a: OA.vote(*a)
+		for noTEMD in (True, False):
+			predictions = make_predictions(len(starts), args.sequence_length, noTEMD)
+			outputs = []
+			for name, func in (('before', legacy_vote), ('after', new_func), ('batch', None)):
+				OA = writer.output_aggregator(fa, noTEMD=noTEMD, h5_file=os.path.join(tmp_dir, 'votes.h5'), \
+					max_votes=max_votes)
+				if func:
+					elapsed = run(func, OA, starts, args.sequence_length, predictions)
+				else:
+					elapsed = run_batches(OA, starts, args.sequence_length, predictions, args.batch_size)
+				outputs.append(OA.write_gff3())
+				OA.close()
+				print("%-6s %-7s %12.1f bases/s (%i windows of %i bases in %.2fs)"%(name, \
+					'noTEMD' if noTEMD else 'TEMD', len(starts)*args.sequence_length/elapsed, \
+					len(starts), args.sequence_length, elapsed))
+			# All paths must agree
+			assert(outputs[0] == outputs[1] == outputs[2])
+	finally:
+		shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for output_aggregator.write_gff3
+#
+# Votes TE-dense predictions on a synthetic chromosome and compares the
+# original per-feature TE class summing and formatting against the
+# prefix-sum lookup and block formatting, reporting features/s.
+#
+# python benchmarks/bench_write.py [-C 2000000] [-L 500] [-o 50]
+
+import argparse, os, shutil, tempfile, sys
+from time import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from teamRNN import writer
+from teamRNN.util import calcRegionBounds
+from teamRNN.constants import gff3_i2f, gff3_f2i, te_feature_names, te_order_i2f, te_sufam_i2f
+from bench_vote import make_fasta
+
+def te_predictions(n, seq_len, seed=42):
+	'''
+	Random predictions where TE features are called in short runs
+	'''
+	rng = np.random.RandomState(seed)
+	out = np.zeros((n, seq_len, len(gff3_i2f)+2), dtype=np.uint32)
+	te_cols = [gff3_f2i['+'+f] for f in te_feature_names]
+	for col in te_cols:
+		out[:,:,col] = np.repeat(rng.rand(n, seq_len//10) < 0.5, 10, axis=1)
+	out[:,:,-2] = rng.randint(0, len(te_order_i2f), (n, seq_len))
+	out[:,:,-1] = rng.randint(0, len(te_sufam_i2f), (n, seq_len))
+	return out
+
+def legacy_write(OA, threshold=0.5):
+	'''
+	The original feature loop that sums the TE class votes of every feature
+	'''
+	out_gff3 = ['##gff-version   3']
+	count = 0
+	for chrom in sorted(OA.chrom_dict):
+		OA._load_arrays(chrom)
+		total_array = OA.feature_totals.column(0)
+		features = []
+		for feat_index in OA.feature_votes.voted_columns():
+			vote_array = OA.feature_votes.column(feat_index)
+			mask = np.logical_and(vote_array >= threshold*total_array, vote_array > 0)
+			for s,e in calcRegionBounds(mask, inclusive=True)+1:
+				features.append((s,e,feat_index))
+		features.sort(key=lambda x: (x[0], x[1]))
+		for s,e,feat_index in features:
+			full_name = gff3_i2f[feat_index]
+			feature_str = "%s\tteamRNN\t%s\t%i\t%i\t.\t%s\t.\tID=team_%i"%(chrom, full_name[1:], s, e, full_name[0], count)
+			if full_name[1:] in te_feature_names:
+				te_order = te_order_i2f[np.argmax(np.sum(OA.te_order_votes.region(s-1, e), axis=0))]
+				te_sufam = te_sufam_i2f[np.argmax(np.sum(OA.te_sufam_votes.region(s-1, e), axis=0))]
+				feature_str += ';Order=%s;Superfamily=%s'%(te_order, te_sufam)
+			out_gff3.append(feature_str)
+			count += 1
+	return out_gff3
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark GFF3 writing")
+	parser.add_argument('-L', '--sequence_length', metavar='INT', default=500, type=int, help='Window length [%(default)s]')
+	parser.add_argument('-o', '--offset', metavar='INT', default=50, type=int, help='Window offset [%(default)s]')
+	parser.add_argument('-C', '--chrom_len', metavar='INT', default=2000000, type=int, help='Synthetic chromosome length [%(default)s]')
+	args = parser.parse_args()
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		fa = make_fasta(tmp_dir, args.chrom_len)
+		L = args.sequence_length
+		OA = writer.output_aggregator(fa, h5_file=os.path.join(tmp_dir, 'votes.h5'), max_votes=-(-L//args.offset))
+		starts = list(range(0, args.chrom_len-L+1, args.offset))
+		batch_size = 100
+		for i in range(0, len(starts), batch_size):
+			cb = [('Chr1', cur, cur+L) for cur in starts[i:i+batch_size]]
+			OA.vote_batch(cb, te_predictions(len(cb), L, seed=i))
+		outputs = []
+		for name, func in (('before', legacy_write), ('after', lambda OA: OA.write_gff3())):
+			s_time = time()
+			outputs.append(func(OA))
+			elapsed = time()-s_time
+			print("%-6s %10.1f features/s (%i features in %.2fs)"%(name, (len(outputs[-1])-1)/elapsed, \
+				len(outputs[-1])-1, elapsed))
+		# Both paths must agree
+		assert(outputs[0] == outputs[1])
+		OA.close()
+	finally:
+		shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+	main()
@@ -55,13 +55,14 @@ if node_name in tacc_nodes:
 from glob import glob
 from time import time
 import pickle
+from functools import partial
 try:
 	import horovod.tensorflow.keras as hvd
 	#hvd.init() # Can't init until after mp forking
 except:
 	hvd = False
-from teamRNN import reader, constants, writer, model
-from teamRNN.util import irange, fivenum, is_reverse
+from teamRNN import reader, constants, writer, model, pipeline
+from teamRNN.util import irange, fivenum, is_reverse, background_iter
 from pysam import FastaFile
 import numpy as np
 
@@ -76,12 +77,17 @@ def main():
 	parser.add_argument('-R', '--reference', metavar="FASTA", help='Reference file', type=fC.fasta, required=True)
 	parser.add_argument('-D', '--directory', metavar="DIR", help='Model directory [%(default)s]', default='model', type=str)
 	parser.add_argument('-N', '--name', metavar="STR", help='Name of model to use [%(default)s]', default='default', type=str)
-	parser.add_argument('-M', '--methratio', metavar='FILE', type=fC.methratio, help='Methratio file used as input', required=True)
+	parser.add_argument('-M', '--methratio', metavar='FILE', type=fC.methratio, help='Methratio file used as input (not needed by call)')
 	parser.add_argument('-o', '--offset', metavar='INT', help='Number of bases to slide between windows [%(default)s]', default=1, type=int)
 	parser.add_argument('-Q', '--quality', metavar='INT', help='Input assembly quality [%(default)s]', default=-1, type=int)
 	parser.add_argument('-P', '--ploidy', metavar='INT', help='Input chromosome ploidy [%(default)s]', default=2, type=int)
 	parser.add_argument('--max_fill', metavar='INT', help='Maximum gap size to be filled [%(default)s]', default=50, type=int)
 	parser.add_argument('--min_feat', metavar='INT', help='Minimum feature size to be kept [%(default)s]', default=75, type=int)
+	parser.add_argument('--features', metavar='DIR', help='Directory of the memory-mapped feature store [METHRATIO.features]', type=str)
+	parser.add_argument('--workers', metavar='INT', help='Number of processes that assemble stateful batches and call features from the votes [%(default)s]', default=4, type=int)
+	parser.add_argument('--prefetch', metavar='INT', help='Number of batches prepared in the background during classification [%(default)s]', default=0, type=int)
+	parser.add_argument('--vote_budget', metavar='INT', help='Memory (MB) for cached vote blocks during classification (0 is unlimited) [%(default)s]', default=4096, type=int)
+	parser.add_argument('--keep_votes', action='store_true', help='Keep the votes in DIR/votes.h5 after classification so features can be re-called with call')
 	parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose logging')
 	##############################################
 	# Training
@@ -115,6 +121,9 @@ def main():
 	parser_train.add_argument('-f', '--force', action='store_true', help='Overwrite a previously saved model')
 	parser_train.add_argument('--train', metavar="STR", help='Comma separated list of chromosomes to train on [all]', type=str)
 	parser_train.add_argument('--test', metavar="STR", help='Comma separated list of chromosomes to test on [none]', type=str)
+	pipelines = ('cache', 'tfdata', 'window', 'stream')
+	parser_train.add_argument('--pipeline', metavar="STR", help='Training input pipeline ([cache], tfdata, window, stream)', default='cache', type=_argChecker(pipelines, 'pipeline').check)
+	parser_train.add_argument('--mem_budget', metavar="INT", help='Memory (MB) for resident chromosomes of the stream pipeline, which always keeps at least two [%(default)s]', default=0, type=int)
 	parser_train.add_argument('--every', metavar="INT", help='Collect MSE values for the first training and test chromosomes every [5] epochs', type=int, default=5)
 	#
 	parser_train.set_defaults(target_function=train)
@@ -125,16 +134,48 @@ def main():
 	##############################################
 	parser_classify = subparsers.add_parser("classify", help="Classify data using model")
 	parser_classify.add_argument('-O', '--output', metavar="GFF3", help='Output gff3 [%(default)s]', default='output.gff3', type=str)
-	parser_classify.add_argument('-T', '--threshold', metavar="FLOAT", help='[%(default)s] of all votes needed for output classification', default=0.5, type=float)
+	parser_classify.add_argument('-T', '--threshold', metavar="FLOAT[:INT:INT]", help='[0.5] of all votes needed for output classification. A comma separated list of THRESHOLD[:MIN_FEAT:MAX_FILL] settings writes one output per setting in a single pass', default=[(0.5, None, None)], type=_call_settings)
 	#
 	parser_classify.set_defaults(target_function=classify)
 	#parser_classify.add_argument('-', '--', action='store_true', help='')
 	#parser_classify.add_argument('-', '--', metavar="", help=' [%(default)s]', default='', type=)
 	##############################################
+	# Featurize
+	##############################################
+	parser_featurize = subparsers.add_parser("featurize", help="Write the input features to a memory-mapped store")
+	parser_featurize.add_argument('-f', '--force', action='store_true', help='Overwrite previously featurized chromosomes')
+	#
+	parser_featurize.set_defaults(target_function=featurize)
+	##############################################
+	# Convert
+	##############################################
+	parser_convert = subparsers.add_parser("convert", help="Convert the methratio file to a memory-mapped columnar store")
+	parser_convert.add_argument('-p', '--processes', metavar='INT', help='Number of parsing processes (0 uses all cores) [%(default)s]', default=0, type=int)
+	parser_convert.add_argument('--chunk_mb', metavar='INT', help='Megabytes of the methratio file parsed per task [%(default)s]', default=64, type=int)
+	#
+	parser_convert.set_defaults(target_function=convert)
+	##############################################
+	# Call
+	##############################################
+	parser_call = subparsers.add_parser("call", help="Call features from the votes kept by --keep_votes")
+	parser_call.add_argument('-V', '--votes', metavar="H5", help='Kept vote file [DIR/votes.h5]', type=str)
+	parser_call.add_argument('-O', '--output', metavar="GFF3", help='Output gff3 [%(default)s]', default='output.gff3', type=str)
+	parser_call.add_argument('-T', '--threshold', metavar="FLOAT[:INT:INT]", help='[0.5] of all votes needed for output classification. A comma separated list of THRESHOLD[:MIN_FEAT:MAX_FILL] settings writes one output per setting, as in classification', default=[(0.5, None, None)], type=_call_settings)
+	#
+	parser_call.set_defaults(target_function=call)
+	##############################################
 	# Parse args
 	##############################################
 	args = parser.parse_args()
 	args.config = os.path.join(args.directory, 'config.pkl')
+	if args.target_function != call and not args.methratio:
+		parser.error("argument -M/--methratio is required")
+	if not args.features and args.methratio: args.features = '%s.features'%(args.methratio)
+	if args.target_function in (classify, call):
+		# Settings without their own filters use --min_feat and --max_fill
+		args.threshold = [(t, args.min_feat if m is None else m, args.max_fill if f is None else f) for t, m, f in args.threshold]
+		if len(set(args.threshold)) != len(args.threshold):
+			parser.error("argument -T/--threshold contains repeated settings")
 	################################
 	# Configure logging
 	################################
@@ -163,6 +204,8 @@ def train(args):
 	#if args.bidirectional and args.stateful:
 	#	sys.exit("Cannot use stateful and bidirectional")
 	logger.debug("Model will be trained on the given input")
+	# Feature callers are forked before the slicer, prefetch threads, or TF session exist
+	CP = writer.call_pool(args.workers)
 	# Attempt to load old parameters
 	if os.path.exists(args.config) and not args.force:
 		logger.info("Loading model parameters from %s"%(args.config))
@@ -170,12 +213,12 @@ def train(args):
 			cached_args = pickle.load(CF)
 		# Open the input
 		out_dim = calc_n_outputs(args, cached_args)
-		IS = reader.input_slicer(args.reference, args.methratio, args.annotation, args.quality, args.ploidy, out_dim, stateful=bool(cached_args.stateful))
+		IS = reader.input_slicer(args.reference, args.methratio, args.annotation, args.quality, args.ploidy, out_dim, stateful=bool(cached_args.stateful), features=args.features, workers=args.workers)
 		init_hvd(args)
 	else:
 		# Open the input
 		out_dim = calc_n_outputs(args, args)
-		IS = reader.input_slicer(args.reference, args.methratio, args.annotation, args.quality, args.ploidy, out_dim, stateful=bool(args.stateful))
+		IS = reader.input_slicer(args.reference, args.methratio, args.annotation, args.quality, args.ploidy, out_dim, stateful=bool(args.stateful), features=args.features, workers=args.workers)
 		init_hvd(args)
 		# Save the parameters
 		if not hvd or (hvd and hvd.rank() == 0):
@@ -219,82 +262,34 @@ def train(args):
 	train_chroms = _target_checker(cached_args.train, IS, IS.FA.references)
 	test_chroms = _target_checker(cached_args.test, IS, [])
 
-	# Define the iterfunction
-	iter_func = IS.stateful_chrom_iter if cached_args.stateful else IS.chrom_iter
-	
-	train_x, train_xr = {}, {}
-	train_y, train_yr = {}, {}
-	logger.info("Caching training data")
+	train_data = {}
 	sl = args.sequence_length
-	for chrom in sorted(train_chroms):
-		cbl, xbl, ybl = zip(*iter_func(chrom, seq_len=sl, offset=args.offset, \
-			batch_size=cached_args.batch_size, hvd_rank=args.hvd_rank, hvd_size=args.hvd_size))
-		train_x[chrom] = np.vstack(xbl)
-		train_y[chrom] = np.vstack(ybl)
-		if cached_args.stranded:
-			train_xr[chrom] = reader.rev_comp(np.vstack(xbl[::-1]))
-			train_yr[chrom] = np.flip(np.vstack(ybl[::-1]), axis=1)
-			reader.mask(train_y[chrom], '-')
-			reader.mask(train_yr[chrom], '+')
-		n_batches = len(cbl)
-		if cached_args.stranded and cached_args.stateful:
-			assert(train_x[chrom].shape == (n_batches*model_batch, sl, M.n_inputs))
-			assert(train_y[chrom].shape == (n_batches*model_batch, sl, M.n_outputs))
-			assert(train_xr[chrom].shape == (n_batches*model_batch, sl, M.n_inputs))
-			assert(train_yr[chrom].shape == (n_batches*model_batch, sl, M.n_outputs))
-		else:
-			assert(train_x[chrom].shape == (n_batches*model_batch, sl, M.n_inputs))
-			assert(train_y[chrom].shape == (n_batches*model_batch, sl, M.n_outputs))
-		logger.info("Finished caching %s"%(chrom))
-	# Cache test data
-	test_cbld, test_xbld, test_ybld = {}, {}, {}
-	for chrom in [train_chroms[0]]+([test_chroms[0]] if test_chroms else []):
-		cbl, xbl, ybl = zip(*iter_func(chrom, seq_len=sl, offset=args.offset, \
-			batch_size=cached_args.batch_size, hvd_rank=args.hvd_rank, hvd_size=args.hvd_size))
-		if cached_args.stranded:
-			test_cbld[chrom] = cbl+cbl[::-1]
-			test_xbld[chrom] = list(xbl)+map(reader.rev_comp, xbl[::-1])
-			yrbl = [np.flip(yb.copy(), axis=1) for yb in ybl[::-1]]
-			[reader.mask(yb, '+') for yb in yrbl]
-			[reader.mask(yb, '-') for yb in ybl]
-			test_ybld[chrom] = list(ybl)+yrbl
-		else:
-			test_cbld[chrom] = cbl
-			test_xbld[chrom] = xbl
-			test_ybld[chrom] = ybl
-	tc = train_chroms[0]
-	if cached_args.stranded:
-		assert(np.all(np.vstack((train_x[tc],train_xr[tc])) == np.vstack(test_xbld[tc])))
-		assert(np.all(np.vstack((train_y[tc],train_yr[tc])) == np.vstack(test_ybld[tc])))
+	pipeline_args = (IS, train_chroms, sl, args.offset, cached_args.batch_size, model_batch, \
+		args.hvd_rank, args.hvd_size, bool(cached_args.stateful), cached_args.stranded)
+	if args.pipeline in ('tfdata', 'window'):
+		logger.info("Streaming training data through the %s pipeline"%(args.pipeline))
+		pipeline_class = pipeline.tfdata_pipeline if args.pipeline == 'tfdata' else pipeline.window_pipeline
+		TP = pipeline_class(*pipeline_args)
+	elif args.pipeline == 'stream':
+		logger.info("Streaming training chromosomes from disk")
+		TP = pipeline.stream_pipeline(*pipeline_args, mem_budget=args.mem_budget)
 	else:
-		assert(np.all(train_x[tc] == np.vstack(test_xbld[tc])))
-		assert(np.all(train_y[tc] == np.vstack(test_ybld[tc])))
-	del cbl, xbl, ybl
+		TP = False
+		logger.info("Caching training data")
+		for chrom in sorted(train_chroms):
+			train_data[chrom] = pipeline.load_chrom(IS, chrom, sl, args.offset, cached_args.batch_size, \
+				model_batch, args.hvd_rank, args.hvd_size, bool(cached_args.stateful))
+			logger.info("Finished caching %s"%(chrom))
 	# Run
 	for E in irange(args.epochs):
 		#### Train #################################################
 		train_start = time()
-		for chrom in sorted(train_chroms):
-			history = LossHistory()
-			start = time()
-			if cached_args.stateful: M.model.reset_states()
-			M.model.fit(train_x[chrom], train_y[chrom], \
-				batch_size=model_batch, epochs=1, shuffle=False, \
-				callbacks=[history], verbose=0)
-			if cached_args.stranded and cached_args.stateful:
-				if cached_args.stateful: M.model.reset_states()
-				M.model.fit(train_xr[chrom], train_yr[chrom], \
-					batch_size=model_batch, epochs=1, shuffle=False, \
-					callbacks=[history], verbose=0)
-			L5 = np.round(fivenum(history.losses),3)
-			A5 = np.round(fivenum(history.acc),3)
-			if cached_args.stranded and cached_args.stateful:
-				rate = train_x[chrom].shape[0]*2/float(time()-start)
-			else:
-				rate = train_x[chrom].shape[0]/float(time()-start)
-			logger.debug("E%i %s LOSS%s ACC%s %i seq/s"%(E, chrom, str(L5), str(A5), int(rate)))
-			#logger.debug("E-%i %s ACC  %s"%(E, chrom, str(fivenum(history.acc))))
-			if cached_args.stateful: M.model.reset_states()
+		if TP:
+			TP.fit_epoch(M.model, LossHistory, E)
+		else:
+			for chrom in sorted(train_chroms):
+				pipeline.fit_chrom(M.model, LossHistory, E, chrom, train_data[chrom], \
+					model_batch, bool(cached_args.stateful), cached_args.stranded)
 		logger.info("Epoch-%04i - Finished training in %i seconds"%(E, int(time()-train_start)))
 		#### Calculate MSE #########################################
 		#if (E+1)%5 == 0: # Every 5th epoch [4, 9, ...]
@@ -307,12 +302,14 @@ def train(args):
 				chrom_time, start_time = time(), time()
 				reverse = False
 				if cached_args.stateful: M.model.reset_states()
-				for cb, xb, yb in zip(test_cbld[chrom], test_xbld[chrom], \
-						test_ybld[chrom]):
+				# Views of the training cache when the chromosome is cached
+				for cb, xb, yb, rb in pipeline.eval_batches(IS, chrom, sl, args.offset, cached_args.batch_size, \
+						model_batch, args.hvd_rank, args.hvd_size, bool(cached_args.stateful), \
+						cached_args.stranded, train_data.get(chrom)):
 					cc, cs, ce = cb[0][0], cb[0][1], cb[-1][2]
 					assert(len(cb) == model_batch)
 					if cached_args.stateful and cached_args.stranded:
-						if not reverse and is_reverse(xb):
+						if not reverse and rb:
 							M.model.reset_states()
 							reverse = True
 					y_pred_batch, predict_time = M.predict(xb, return_time=True)
@@ -336,17 +333,24 @@ def train(args):
 			else:
 				M.save()
 	#### Write output #############################################
-	args.threshold = 0.5
+	args.threshold = [0.5]
 	args.output = os.path.join(args.directory, 'training_output.gff3')
 	args.raw_output = os.path.join(args.directory, 'training_output_raw.gff3')
 	#### Classify #################################################
 	OA = make_predictions(IS, M, args, cached_args, model_batch)
+	# The slicer's files and workers are not needed to write
+	IS.close()
 	#### Write #####################################################
 	if not hvd or (hvd and hvd.rank() == 0):
-		logger.info("Features need %.2f of the votes to be output"%(args.threshold))
-		logger.info("Writing %s"%(args.output))
-	OA.write_gff3(out_file=args.raw_output, threshold=args.threshold, min_size=0, max_fill_size=0)
-	OA.write_gff3(out_file=args.output, threshold=args.threshold, min_size=args.min_feat, max_fill_size=args.max_fill)
+		logger.info("Features need %.2f of the votes to be output"%(args.threshold[0]))
+		logger.info("Writing %s and %s"%(args.raw_output, args.output))
+	# Raw and filtered outputs are called in a single pass over the votes
+	OA.write_gff3s([(args.raw_output, args.threshold[0], 0, 0), \
+		(args.output, args.threshold[0], args.min_feat, args.max_fill)], processes=args.workers, pool=CP)
+	OA.close()
+	if CP:
+		CP.close()
+		CP.join()
 	#### Shut Down #################################################
 	del M
 	if hvd:
@@ -374,10 +378,12 @@ def classify(args):
 		logger.info("Loading model parameters from %s"%(args.config))
 	with open(args.config, 'rb') as CF:
 		cached_args = pickle.load(CF)
+	# Feature callers are forked before the slicer, prefetch threads, or TF session exist
+	CP = writer.call_pool(args.workers)
 	# Open the input
 	out_dim = calc_n_outputs(args, cached_args)
 	IS = reader.input_slicer(args.reference, args.methratio, quality=args.quality, ploidy=args.ploidy, \
-		out_dim=out_dim, stateful=bool(cached_args.stateful))
+		out_dim=out_dim, stateful=bool(cached_args.stateful), features=args.features, workers=args.workers)
 	init_hvd(args)
 	hidden_list = map(int, cached_args.hidden_list.split(',')) if cached_args.hidden_list else []
 	model_batch = int(cached_args.batch_size/args.hvd_size) if hvd and cached_args.stateful else cached_args.batch_size
@@ -412,14 +418,74 @@ def classify(args):
 	#print M.model.summary()
 	#### Classify #################################################
 	OA = make_predictions(IS, M, args, cached_args, model_batch)
+	# The slicer's files and workers are not needed to write
+	IS.close()
 	#### Write #####################################################
 	if not hvd or (hvd and hvd.rank() == 0):
-		logger.info("Features need %.2f of the votes to be output"%(args.threshold))
-		logger.info("Writing %s"%(args.output))
-	OA.write_gff3(out_file=args.output, threshold=args.threshold, min_size=args.min_feat, max_fill_size=args.max_fill)
+		logger.info("Features need %s of the votes to be output"%(', '.join(['%.2f'%(t) for t, m, f in args.threshold])))
+	outputs = threshold_outputs(args.output, args.threshold)
+	if not hvd or (hvd and hvd.rank() == 0):
+		logger.info("Writing %s"%(', '.join([output[0] for output in outputs])))
+	OA.write_gff3s(outputs, processes=args.workers, pool=CP)
+	OA.close()
+	if CP:
+		CP.close()
+		CP.join()
 	if not hvd or (hvd and hvd.rank() == 0):
 		logger.info("Done")
 
+def threshold_outputs(out_file, settings):
+	'''
+	Returns the (out_file, threshold, min_size, max_fill_size) of every
+	(threshold, min_size, max_fill_size) setting. With several settings, each
+	output file is suffixed with all three (output_T0.3_min75_fill50.gff3).
+	'''
+	if len(settings) == 1:
+		return [(out_file,)+tuple(settings[0])]
+	base, ext = os.path.splitext(out_file)
+	return [('%s_T%s_min%i_fill%i%s'%(base, t, m, f, ext), t, m, f) for t, m, f in settings]
+
+def featurize(args):
+	logger.debug("Featurizing the reference and methylation data")
+	IS = reader.input_slicer(args.reference, args.methratio, quality=args.quality, ploidy=args.ploidy)
+	init_hvd(args)
+	FS = reader.feature_store(args.reference, args.methratio, args.quality, args.ploidy, args.features)
+	# Each rank featurizes its own share of the chromosomes
+	chroms = sorted(IS.FA.references)[args.hvd_rank::args.hvd_size]
+	if not hvd or (hvd and hvd.rank() == 0):
+		logger.info("Writing features to %s"%(FS.store_dir))
+	FS.build(IS, chroms, force=args.force)
+	if not hvd or (hvd and hvd.rank() == 0):
+		logger.info("Done")
+
+def convert(args):
+	logger.debug("Converting the methratio file")
+	init_hvd(args)
+	MS = reader.meth_store(args.methratio, args.reference)
+	if not hvd or (hvd and hvd.rank() == 0):
+		logger.info("Writing methylation columns to %s"%(MS.store_dir))
+	# The store is locked while it is built, so other ranks wait for it
+	MS.build(args.processes, args.chunk_mb*2**20)
+	if not hvd or (hvd and hvd.rank() == 0):
+		logger.info("Done")
+
+def call(args):
+	logger.debug("Calling features from kept votes")
+	if not args.votes: args.votes = os.path.join(args.directory, 'votes.h5')
+	if not os.path.exists(args.votes):
+		logger.error("Could not find %s. Classify with --keep_votes to keep the votes."%(args.votes))
+		sys.exit()
+	OA = writer.output_aggregator(args.reference, h5_file=args.votes, mem_budget=args.vote_budget*2**20, read_only=True)
+	if not OA.complete():
+		logger.error("%s is missing votes from an unfinished classification"%(args.votes))
+		sys.exit()
+	logger.info("Features need %s of the votes to be output"%(', '.join(['%.2f'%(t) for t, m, f in args.threshold])))
+	outputs = threshold_outputs(args.output, args.threshold)
+	logger.info("Writing %s"%(', '.join([output[0] for output in outputs])))
+	OA.write_gff3s(outputs, processes=args.workers)
+	OA.close()
+	logger.info("Done")
+
 def calc_n_outputs(args, cached_args):
 	if 'noTEMD' in args and args.noTEMD:
 		logger.info("Not including TE metadata in output")
@@ -432,42 +498,101 @@ def calc_n_outputs(args, cached_args):
 def make_predictions(IS, M, args, cached_args, model_batch):
 	# Open the output
 	noTEMD = 'noTEMD' in cached_args and cached_args.noTEMD
-	OA = writer.output_aggregator(args.reference, noTEMD=noTEMD, h5_file=os.path.join(args.directory, 'tmp_vote.h5'), stranded=cached_args.stranded)
-	# Store iteration method
-	iter_func = IS.stateful_chrom_iter if cached_args.stateful else IS.chrom_iter
+	# Stateful votes overwrite, otherwise a base is covered by at most seq_len/offset windows
+	max_votes = 1 if cached_args.stateful else -(-cached_args.sequence_length//args.offset)
+	vote_file = 'votes.h5' if args.keep_votes else 'tmp_vote.h5'
+	OA = writer.output_aggregator(args.reference, noTEMD=noTEMD, h5_file=os.path.join(args.directory, vote_file), \
+		stranded=cached_args.stranded, max_votes=max_votes, mem_budget=args.vote_budget*2**20, keep=args.keep_votes)
+	# Store iteration method for each chromosome (or shard of one)
+	if cached_args.stateful:
+		work = [(chrom, partial(IS.stateful_chrom_iter, chrom, seq_len=cached_args.sequence_length, \
+				offset=args.offset, batch_size=cached_args.batch_size, \
+				hvd_rank=args.hvd_rank, hvd_size=args.hvd_size, stranded=cached_args.stranded)) \
+			for chrom in sorted(IS.FA.references)]
+		planned = False
+	else:
+		# Independent batches are balanced across ranks over the whole genome
+		plan = IS.plan_batches(cached_args.sequence_length, args.offset, cached_args.batch_size, args.hvd_size)
+		work = [(chrom, partial(IS.chrom_range_iter, chrom, first, last, seq_len=cached_args.sequence_length, \
+				offset=args.offset, batch_size=cached_args.batch_size)) \
+			for chrom, first, last in plan[args.hvd_rank]]
+		planned = [sum([last-first for chrom, first, last in shard]) for shard in plan]
 	#### Classify #################################################
-	for chrom in sorted(IS.FA.references):
+	# Seconds spent producing batches, waiting for them, predicting, and voting
+	stage_times = {'produce':0, 'wait':0, 'predict':0, 'vote':0}
+	total_start = time()
+	n_batches = 0
+	for chrom, make_iter in work:
 		seqs = 0
 		start_time = time()
 		if cached_args.stateful: M.model.reset_states()
 		reverse = False
-		for count, batch in enumerate(iter_func(chrom, seq_len=cached_args.sequence_length, \
-				offset=args.offset, batch_size=cached_args.batch_size, \
-				hvd_rank=args.hvd_rank, hvd_size=args.hvd_size, stranded=cached_args.stranded)):
+		batch_iter = make_iter()
+		if args.prefetch:
+			batch_iter = background_iter(batch_iter, args.prefetch, stage_times)
+		stage_start = time()
+		for count, batch in enumerate(batch_iter):
+			stage_times['wait'] += time()-stage_start
 			if len(batch) == 2: cb, xb = batch
 			elif len(batch) == 3: cb, xb, yb = batch
 			else: raise ValueError(len(batch) in (2,3))
 			cc, cs, ce = cb[0][0], cb[0][1], cb[-1][2]
 			assert(len(cb) == model_batch)
 			seqs += model_batch
+			n_batches += 1
 			if cached_args.stateful and cached_args.stranded:
 				if not reverse and is_reverse(xb):
 					M.model.reset_states()
 					reverse = True
 			y_pred_batch, predict_time = M.predict(xb, return_time=True)
+			stage_times['predict'] += predict_time
 			#logger.debug("PREDICT: Batch-%03i %s:%i-%i TRAIN=%.1fs TOTAL=%.1fs RATE=%.1f seq/s"%(count, cc, cs, ce, predict_time, time()-start_time, len(xb)/predict_time))
 			if not y_pred_batch.sum(): logger.warn("No predictions in Batch-%03i %s:%i-%i"%(count, cc, cs, ce))
-			for c, x, yp in zip(cb, xb, y_pred_batch):
-				chrom,s,e = c
-				if cached_args.stateful:
-					OA.vote(*c, array=yp, overwrite=True, reverse=reverse)
-				else:
-					OA.vote(*c, array=yp)
+			vote_start = time()
+			if cached_args.stateful:
+				OA.vote_batch(cb, y_pred_batch, overwrite=True, reverse=reverse)
+			else:
+				OA.vote_batch(cb, y_pred_batch)
+			stage_start = time()
+			stage_times['vote'] += stage_start-vote_start
 		if cached_args.stateful: M.model.reset_states()
 		rate = seqs/float(time()-start_time)
 		logger.debug("Finished predictions for %s at a rate of %.1f seq/s"%(chrom, rate))
+	log_stage_times(stage_times, time()-total_start, args.prefetch)
+	if planned: log_workload(args, planned, n_batches, time()-total_start)
 	return OA
 
+def log_workload(args, planned, n_batches, elapsed):
+	'''
+	Logs the planned and actual number of batches and seconds of every rank
+	'''
+	logger.debug("Rank %i classified %i batches (%i planned) in %.1fs"%(args.hvd_rank, \
+		n_batches, planned[args.hvd_rank], elapsed))
+	if hvd:
+		loads = np.array(hvd.allgather(np.array([[n_batches, elapsed]]), name="Workload")).reshape(-1,2)
+	else:
+		loads = np.array([[n_batches, elapsed]])
+	if args.hvd_rank == 0:
+		logger.info("Expected batches per rank: %s"%(str(planned)))
+		logger.info("Actual batches per rank: %s"%(str([int(n) for n in loads[:,0]])))
+		logger.info("Seconds per rank: %s (max/mean %.2f)"%(str([round(t,1) for t in loads[:,1]]), \
+			loads[:,1].max()/max(loads[:,1].mean(), 1e-9)))
+
+def log_stage_times(stage_times, total_time, prefetch=0):
+	'''
+	Logs the share of the classification wall time used by each stage. With
+	prefetching, batches are produced in the background and "wait" is only
+	the time inference stalled on them, otherwise production is the wait.
+	'''
+	if not prefetch: stage_times['produce'] = stage_times['wait']
+	total_time = max(total_time, 1e-9)
+	stages = ('produce', 'predict', 'vote')
+	out_str = ' '.join(['%s:%.1f%%'%(c, 100*stage_times[c]/total_time) for c in stages])
+	logger.info("Stage utilization over %.1fs (prefetch=%i) - %s - stalled on input %.1fs"%(total_time, \
+		prefetch, out_str, stage_times['wait']))
+	bottleneck = max(stages, key=lambda c: stage_times[c])
+	logger.debug("The %s stage is the bottleneck"%(bottleneck))
+
 def test_barrier(msg):
 	if hvd.rank() == 0: logger.debug(msg)
 	print hvd.allgather([hvd.rank()], name="Barrier")
@@ -518,6 +643,26 @@ class _argChecker:
 		else:
 			raise argparse.ArgumentTypeError("%s not a valid %s"%(x, self.name))
 
+def _call_settings(x):
+	'''
+	Parses a comma separated list of THRESHOLD[:MIN_FEAT:MAX_FILL] settings
+	into (threshold, min_feat, max_fill) tuples. Filters that are not given
+	are None.
+	'''
+	settings = []
+	for setting in x.split(','):
+		fields = setting.split(':')
+		try:
+			if len(fields) == 1:
+				settings.append((float(fields[0]), None, None))
+			elif len(fields) == 3:
+				settings.append((float(fields[0]), int(fields[1]), int(fields[2])))
+			else:
+				raise ValueError(setting)
+		except ValueError:
+			raise argparse.ArgumentTypeError("%s not a THRESHOLD[:MIN_FEAT:MAX_FILL] setting"%(setting))
+	return settings
+
 import tensorflow
 class LossHistory(tensorflow.keras.callbacks.Callback):
 	def on_train_begin(self, logs={}):
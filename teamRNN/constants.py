@@ -35,6 +35,8 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ###############################################################################
 
+import numpy as np
+
 # Pulled from all GFF3 files
 features = ['CDS', 'RNase_MRP_RNA', 'SRP_RNA', 'antisense_RNA', 'antisense_lncRNA', 'biological_region', 'chromosome', 'contig', 'exon', 'five_prime_UTR', 'gene', 'lnc_RNA', 'mRNA', 'miRNA', 'ncRNA', 'ncRNA_gene', 'pre_miRNA', 'pseudogene', 'pseudogenic_exon', 'pseudogenic_tRNA', 'pseudogenic_transcript', 'rRNA', 'region', 'snRNA', 'snoRNA', 'supercontig', 'tRNA', 'three_prime_UTR', 'tmRNA', 'transposable_element', 'transposable_element_gene', 'transposon_fragment', 'uORF']
 contexts = ('CG','CHG','CHH')
@@ -87,6 +89,21 @@ ignored_bases = 'URYKMSWBDHV-'
 base2index = {b:i for i,b in enumerate(bases)}
 base2index.update({b:len(bases)-1 for b in ignored_bases})
 index2base = bases
+# 256-entry byte lookup table for encoding raw FASTA bytes. Soft-masked
+# (lowercase) bases encode like their uppercase form and unknown bytes are N.
+base_lut = np.full(256, base2index['N'], dtype=np.uint8)
+for b,i in base2index.items():
+	base_lut[ord(b)] = i
+	base_lut[ord(b.lower())] = i
+del b, i
+# Unpacks a byte of four 2-bit base indices (A G T C), first base in the high bits.
+# Rows are viewed as one uint32 so take() returns all four uint8 indices at once.
+twobit_lut = ((np.arange(256)[:,None] >> np.array([6,4,2,0])) & 3).astype(np.uint8).view(np.uint32).ravel()
+# Compact per-base input record (17 bytes instead of 10 float32 channels), which
+# is expanded to the model input by reader.expand_inputs. Ploidy and quality are
+# constant along a chromosome and are not stored.
+compact_dtype = np.dtype([('base', np.uint8), ('pos', np.float32), ('ratio', np.float16, (3,)), ('cov', np.uint16, (3,))])
+max_compact_cov = np.iinfo(np.uint16).max
 
 # Process configuration
 tacc_nodes = {'knl':(136,2), 'skx':(48,2), 'hikari':(24,2)}
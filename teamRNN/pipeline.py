@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+#
+###############################################################################
+# BSD 3-Clause License
+# 
+# Copyright (c) 2019, Texas Advanced Computing Center
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+import logging, threading
+from time import time
+from functools import partial
+logger = logging.getLogger(__name__)
+import numpy as np
+import tensorflow as tf
+from teamRNN.reader import mask, rev_comp, expand_inputs
+from teamRNN.constants import compact_dtype
+from teamRNN.util import irange, fivenum, background_iter
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+class reset_states_at(tf.keras.callbacks.Callback):
+	'''
+	Resets the model states before batch `index` of every epoch, which
+	separates the forward and reverse traversals of a stranded stateful
+	chromosome that is fit in a single call
+	'''
+	def __init__(self, index):
+		super(reset_states_at, self).__init__()
+		self.index = index
+	def on_batch_begin(self, batch, logs={}):
+		if batch == self.index:
+			self.model.reset_states()
+
+def log_history(E, label, history, n_seqs, elapsed):
+	L5 = np.round(fivenum(history.losses),3)
+	A5 = np.round(fivenum(history.acc),3)
+	logger.debug("E%i %s LOSS%s ACC%s %i seq/s"%(E, label, str(L5), str(A5), int(n_seqs/max(elapsed, 1e-9))))
+
+def load_chrom(IS, chrom, seq_len, offset, batch_size, model_batch, hvd_rank=0, hvd_size=1, stateful=False):
+	'''
+	Materializes every forward-strand training batch of a chromosome. Inputs
+	are kept as compact records and the labels are not masked, so
+	strand_batch can derive both strands from them.
+
+	# Returns
+	tuple: (x, y, (ploidy, quality)) with the (n_batches*model_batch, seq_len)
+	compact inputs, the (n_batches*model_batch, seq_len, out_dim) labels, and
+	the input constants of the chromosome
+	'''
+	iter_func = IS.stateful_chrom_iter if stateful else IS.chrom_iter
+	cbl, xbl, ybl = zip(*iter_func(chrom, seq_len=seq_len, offset=offset, \
+		batch_size=batch_size, hvd_rank=hvd_rank, hvd_size=hvd_size, compact=True))
+	x = np.vstack(xbl)
+	y = np.vstack(ybl)
+	n_batches = len(cbl)
+	assert(x.shape == (n_batches*model_batch, seq_len) and x.dtype == compact_dtype)
+	assert(y.shape == (n_batches*model_batch, seq_len, IS.out_dim))
+	chrom_quality = IS.RC.chrom_qualities[chrom] if IS.quality == -1 else IS.quality
+	return (x, y, (IS.ploidy, chrom_quality))
+
+def strand_batch(data, model_batch, stranded, index, reverse=False):
+	'''
+	Returns batch `index` of the load_chrom arrays of a chromosome, expanded
+	to the float32 model input. Reverse strand batches are complemented,
+	reversed in time, and masked from the forward batch when they are
+	requested, so only the forward strand is ever stored.
+
+	# Parameters
+	data (tuple): (x, y, (ploidy, quality)) from load_chrom
+	model_batch (int): Sequences per batch
+	stranded (bool): Mask the strand that is not being trained
+	index (int): Forward batch index
+	reverse (bool): Return the reverse strand of the batch
+
+	# Returns
+	tuple: (x, y) batch
+	'''
+	x, y, (ploidy, quality) = data
+	x = x[index*model_batch:(index+1)*model_batch]
+	y = y[index*model_batch:(index+1)*model_batch]
+	if reverse:
+		yr = np.flip(y, axis=1).copy() # flip y
+		mask(yr, '+') # mask forward prediction
+		return (expand_inputs(rev_comp(x), ploidy, quality), yr)
+	if stranded:
+		#remove all predictions from reverse strand
+		y = y.copy()
+		mask(y, '-')
+	return (expand_inputs(x, ploidy, quality), y)
+
+def strand_batches(data, model_batch, stranded, reverse=False):
+	'''
+	Keras Sequence of every strand_batch of a chromosome, in training order
+	'''
+	n_batches = data[0].shape[0]//model_batch
+	order = irange(n_batches-1, -1, -1) if reverse else irange(n_batches)
+	return window_batches(partial(strand_batch, data, model_batch, stranded), \
+		[(index, reverse) for index in order])
+
+def fit_chrom(model, history_class, E, chrom, data, model_batch, stateful=False, stranded=False):
+	'''
+	Fits one epoch of the batches load_chrom materialized for a chromosome,
+	which are expanded one at a time. The reverse strand is only fit
+	separately by stateful models.
+	'''
+	reverse = stateful and stranded
+	n_batches = data[0].shape[0]//model_batch
+	history = history_class()
+	start = time()
+	if stateful: model.reset_states()
+	model.fit(strand_batches(data, model_batch, stranded), steps_per_epoch=n_batches, \
+		epochs=1, shuffle=False, callbacks=[history], verbose=0)
+	if reverse:
+		model.reset_states()
+		model.fit(strand_batches(data, model_batch, stranded, reverse=True), steps_per_epoch=n_batches, \
+			epochs=1, shuffle=False, callbacks=[history], verbose=0)
+	log_history(E, chrom, history, data[0].shape[0]*(2 if reverse else 1), time()-start)
+	if stateful: model.reset_states()
+
+def eval_batches(IS, chrom, seq_len, offset, batch_size, model_batch, hvd_rank=0, hvd_size=1, stateful=False, stranded=False, data=None):
+	'''
+	Yields the (coordinates, x, y, reverse) evaluation batches of a
+	chromosome in training order, with the reverse strand last when
+	stranded. Batches come from strand_batch when the load_chrom arrays of
+	the chromosome are given and are otherwise generated one at a time, so
+	an evaluated chromosome is never held twice. Coordinates are generated
+	from the batch starts as they are needed.
+	'''
+	if stateful:
+		starts = IS.stateful_batch_starts(chrom, seq_len, batch_size, hvd_rank, hvd_size)
+		coords = lambda region_starts: [(chrom, cur, cur+seq_len) for cur in region_starts]
+	else:
+		starts = IS.chrom_batch_starts(chrom, seq_len, offset, batch_size, hvd_rank, hvd_size)
+		full_len = seq_len+(batch_size-1)*offset
+		coords = lambda cur: IS._coord2batch((chrom, cur, cur+full_len), seq_len, batch_size, offset)
+	n_batches = len(starts)
+	if data is not None:
+		for i in irange(n_batches):
+			yield (coords(starts[i]),)+strand_batch(data, model_batch, stranded, i)+(False,)
+		if stranded:
+			for i in irange(n_batches-1, -1, -1):
+				yield (coords(starts[i]),)+strand_batch(data, model_batch, stranded, i, True)+(True,)
+	elif stateful:
+		for i, (c, x, y) in enumerate(IS.stateful_chrom_iter(chrom, seq_len=seq_len, offset=offset, \
+				batch_size=batch_size, hvd_rank=hvd_rank, hvd_size=hvd_size, stranded=stranded)):
+			yield (c, x, y, i >= n_batches)
+	else:
+		chrom_len = IS.FA.get_reference_length(chrom)
+		chrom_quality = IS.RC.chrom_qualities[chrom] if IS.quality == -1 else IS.quality
+		make_batch = lambda cur: IS._make_batch(chrom, cur, chrom_len, chrom_quality, seq_len, batch_size, offset)
+		for cur in starts:
+			c, x, y = make_batch(cur)
+			if stranded:
+				y = y.copy()
+				mask(y, '-')
+			yield (c, x, y, False)
+		if stranded:
+			for cur in starts[::-1]:
+				c, x, y = make_batch(cur)
+				yr = np.flip(y, axis=1).copy()
+				mask(yr, '+')
+				yield (c, rev_comp(x), yr, True)
+
+class input_pipeline:
+	'''
+	Base class of the streaming training inputs
+
+	Subclasses define either self.datasets, {chrom: (data, n_forward_batches)}
+	for stateful models, or self.dataset and self.n_batches for independent
+	batches, where data is anything keras can fit for a number of steps.
+	'''
+	def fit_epoch(self, model, history_class, E):
+		'''
+		Fits one epoch and logs the loss, accuracy, and throughput
+
+		# Parameters
+		model (tf.keras.Model): Compiled model
+		history_class (class): Callback that collects batch losses and accuracies
+		E (int): Epoch number
+		'''
+		if self.stateful:
+			for chrom in self.chroms:
+				ds, n_forward = self.datasets[chrom]
+				if not n_forward: continue
+				steps = n_forward*2 if self.stranded else n_forward
+				history = history_class()
+				callbacks = [history, reset_states_at(n_forward)] if self.stranded else [history]
+				start = time()
+				model.reset_states()
+				model.fit(ds, steps_per_epoch=steps, epochs=1, shuffle=False, callbacks=callbacks, verbose=0)
+				model.reset_states()
+				log_history(E, chrom, history, steps*self.model_batch, time()-start)
+		elif self.n_batches:
+			history = history_class()
+			start = time()
+			model.fit(self.dataset, steps_per_epoch=self.n_batches, epochs=1, shuffle=False, callbacks=[history], verbose=0)
+			log_history(E, ','.join(self.chroms), history, self.n_batches*self.model_batch, time()-start)
+
+class tfdata_pipeline(input_pipeline):
+	'''
+	tf.data training input built on the input_slicer region fetch
+
+	Batches are extracted by a parallel map of a py_func over their start
+	positions. Independent batches of all chromosomes are interleaved into
+	one dataset per epoch, which is prefetched with AUTOTUNE. Stateful
+	batches keep their order within each chromosome and come from
+	stateful_chrom_iter, which already fans out to the worker pool, so they
+	are not prefetched. Datasets are not repeated, so every fit reads a
+	fresh iterator to its end and nothing is fetched after it returns.
+
+	>>> TP = tfdata_pipeline(IS, ['Chr1','Chr2'], seq_len=500, offset=1, batch_size=100, model_batch=100)
+	>>> TP.fit_epoch(M.model, LossHistory, E)
+	'''
+	def __init__(self, IS, chroms, seq_len, offset, batch_size, model_batch, hvd_rank=0, hvd_size=1, stateful=False, stranded=False):
+		self.IS = IS
+		self.chroms = sorted(chroms)
+		self.seq_len = seq_len
+		self.offset = offset
+		self.batch_size = batch_size
+		self.model_batch = model_batch
+		self.hvd_rank = hvd_rank
+		self.hvd_size = hvd_size
+		self.stateful = stateful
+		self.stranded = stranded
+		self.n_outputs = IS.out_dim
+		self.chrom_lens = {c:IS.FA.get_reference_length(c) for c in self.chroms}
+		self.qualities = {c:IS.RC.chrom_qualities[c] if IS.quality == -1 else IS.quality for c in self.chroms}
+		if stateful:
+			# {chrom: (dataset, n_forward_batches)}
+			self.datasets = {c:self._stateful_dataset(c) for c in self.chroms}
+		else:
+			self.dataset, self.n_batches = self._interleaved_dataset()
+	def _shapes(self, x, y):
+		x.set_shape((self.model_batch, self.seq_len, 10))
+		y.set_shape((self.model_batch, self.seq_len, self.n_outputs))
+		return (x, y)
+	def _fetch_batch(self, chrom_index, cur):
+		chrom = self.chroms[chrom_index]
+		cb, xb, yb = self.IS._make_batch(chrom, int(cur), self.chrom_lens[chrom], self.qualities[chrom], \
+			self.seq_len, self.batch_size, self.offset)
+		y = np.array(yb, dtype=np.float32)
+		#remove all predictions from reverse strand
+		if self.stranded: mask(y, '-')
+		return (np.ascontiguousarray(xb, dtype=np.float32), y)
+	def _interleaved_dataset(self):
+		chrom_starts = [np.array(self.IS.chrom_batch_starts(c, self.seq_len, self.offset, self.batch_size, \
+			self.hvd_rank, self.hvd_size), dtype=np.int64) for c in self.chroms]
+		n_batches = sum(map(len, chrom_starts))
+		def starts_gen(chrom_index):
+			for cur in chrom_starts[chrom_index]:
+				yield (chrom_index, cur)
+		ds = tf.data.Dataset.range(len(self.chroms)).interleave(lambda ci: \
+			tf.data.Dataset.from_generator(starts_gen, (tf.int64, tf.int64), args=(ci,)), \
+			cycle_length=max(1, len(self.chroms)), block_length=1, num_parallel_calls=AUTOTUNE)
+		ds = ds.map(lambda ci, cur: tuple(tf.py_func(self._fetch_batch, [ci, cur], [tf.float32, tf.float32])), \
+			num_parallel_calls=AUTOTUNE)
+		ds = ds.map(self._shapes).prefetch(AUTOTUNE)
+		logger.debug("Interleaving %i batches from %i chromosomes"%(n_batches, len(self.chroms)))
+		return (ds, n_batches)
+	def _stateful_dataset(self, chrom):
+		n_forward = len(self.IS.stateful_batch_starts(chrom, self.seq_len, self.batch_size, self.hvd_rank, self.hvd_size))
+		def batch_gen():
+			for c, x, y in self.IS.stateful_chrom_iter(chrom, seq_len=self.seq_len, offset=self.offset, \
+					batch_size=self.batch_size, hvd_rank=self.hvd_rank, hvd_size=self.hvd_size, \
+					stranded=self.stranded):
+				yield (x.astype(np.float32), y.astype(np.float32))
+		# The generator shares the worker pool and batch buffer with every
+		# other chromosome, so it only runs while its own fit pulls from it
+		ds = tf.data.Dataset.from_generator(batch_gen, (tf.float32, tf.float32))
+		return (ds.map(self._shapes), n_forward)
+
+class window_batches(tf.keras.utils.Sequence):
+	'''
+	Keras Sequence that gathers each batch when it is requested
+
+	# Parameters
+	gather (function): returns the (x, y) batch of a tuple of arguments
+	batches (list): gather arguments of every batch, in order
+	'''
+	def __init__(self, gather, batches):
+		self.gather = gather
+		self.batches = batches
+	def __len__(self):
+		return len(self.batches)
+	def __getitem__(self, index):
+		return self.gather(*self.batches[index])
+
+class window_pipeline(input_pipeline):
+	'''
+	Window-index training input
+
+	Only the contiguous compact input track of each chromosome and
+	the start of every batch are kept in memory, instead of every
+	overlapping window. Batches are gathered from the tracks on the fly, so
+	memory scales with the genome size instead of the genome size times the
+	sequence length. Tracks are memory-mapped from the feature store when
+	one exists, and labels are unpacked from the annotation raster of each
+	batch.
+
+	>>> TP = window_pipeline(IS, ['Chr1','Chr2'], seq_len=500, offset=1, batch_size=100, model_batch=100)
+	>>> TP.fit_epoch(M.model, LossHistory, E)
+	'''
+	def __init__(self, IS, chroms, seq_len, offset, batch_size, model_batch, hvd_rank=0, hvd_size=1, stateful=False, stranded=False):
+		self.IS = IS
+		self.chroms = sorted(chroms)
+		self.seq_len = seq_len
+		self.offset = offset
+		self.batch_size = batch_size
+		self.model_batch = model_batch
+		self.stateful = stateful
+		self.stranded = stranded
+		self.ploidy = IS.ploidy
+		self.qualities = {c:IS.RC.chrom_qualities[c] if IS.quality == -1 else IS.quality for c in self.chroms}
+		self.tracks = {}
+		for chrom in self.chroms:
+			start = time()
+			self.tracks[chrom] = IS.chrom_track(chrom)
+			logger.debug("Loaded the %s track in %.1f seconds"%(chrom, time()-start))
+		if stateful:
+			self.datasets = {}
+			for chrom in self.chroms:
+				starts = IS.stateful_batch_starts(chrom, seq_len, batch_size, hvd_rank, hvd_size).astype(np.intp)
+				batches = [(chrom, region_starts, False) for region_starts in starts]
+				if stranded:
+					batches += [(chrom, region_starts, True) for region_starts in starts[::-1]]
+				self.datasets[chrom] = (window_batches(self._gather_stateful, batches), len(starts))
+		else:
+			batches = [(chrom, cur) for chrom in self.chroms for cur in \
+				IS.chrom_batch_starts(chrom, seq_len, offset, batch_size, hvd_rank, hvd_size)]
+			self.dataset = window_batches(self._gather, batches)
+			self.n_batches = len(batches)
+	def _gather(self, chrom, cur):
+		'''
+		Gathers the batch of windows starting at cur, which is identical to
+		the batch input_slicer.chrom_iter yields
+		'''
+		full_len = self.seq_len+(self.batch_size-1)*self.offset
+		x = self.IS._list2batch_num(self.tracks[chrom][cur:cur+full_len], self.seq_len, self.batch_size, self.offset)
+		y = self.IS._list2batch_num(self.IS.GI.fetch(chrom, cur, cur+full_len), self.seq_len, self.batch_size, self.offset)
+		x, y = expand_inputs(x, self.ploidy, self.qualities[chrom]), np.array(y)
+		#remove all predictions from reverse strand
+		if self.stranded: mask(y, '-')
+		return (x, y)
+	def _gather_stateful(self, chrom, region_starts, reverse):
+		'''
+		Gathers one window from each contiguous sequence, which is identical
+		to the batch input_slicer.stateful_chrom_iter yields
+		'''
+		x = self.tracks[chrom][region_starts[:,np.newaxis]+np.arange(self.seq_len)]
+		y = np.array([self.IS.GI.fetch(chrom, cur, cur+self.seq_len) for cur in region_starts])
+		if reverse:
+			x = rev_comp(x) # flip and comp x
+			mask(y, '+') # mask forward prediction
+			y = np.flip(y, axis=1) # flip y
+		elif self.stranded:
+			mask(y, '-')
+		return (expand_inputs(x, self.ploidy, self.qualities[chrom]), y)
+
+class stream_pipeline:
+	'''
+	Out-of-core training input
+
+	Chromosomes are materialized like the in-memory cache, one at a time,
+	by a background thread while the previous chromosome is being fit, and
+	are released after fitting. The number of resident chromosomes is set
+	by a memory budget, but at least two are kept so loading is always
+	double-buffered. Each epoch logs the time spent loading, fitting, and
+	waiting for a chromosome to show how much of the I/O was hidden.
+
+	>>> TP = stream_pipeline(IS, ['Chr1','Chr2'], seq_len=500, offset=1, batch_size=100, model_batch=100, mem_budget=4096)
+	>>> TP.fit_epoch(M.model, LossHistory, E)
+	'''
+	def __init__(self, IS, chroms, seq_len, offset, batch_size, model_batch, hvd_rank=0, hvd_size=1, stateful=False, stranded=False, mem_budget=0):
+		self.IS = IS
+		self.chroms = sorted(chroms)
+		self.load = partial(load_chrom, IS, seq_len=seq_len, offset=offset, batch_size=batch_size, \
+			model_batch=model_batch, hvd_rank=hvd_rank, hvd_size=hvd_size, stateful=stateful)
+		self.model_batch = model_batch
+		self.stateful = stateful
+		self.stranded = stranded
+		# Approximate bytes of each materialized chromosome
+		if stateful:
+			n_windows = {c:len(IS.stateful_batch_starts(c, seq_len, batch_size, hvd_rank, hvd_size))*model_batch for c in self.chroms}
+		else:
+			n_windows = {c:len(IS.chrom_batch_starts(c, seq_len, offset, batch_size, hvd_rank, hvd_size))*batch_size for c in self.chroms}
+		window_bytes = seq_len*(compact_dtype.itemsize+IS.out_dim)
+		self.chrom_bytes = {c:n*window_bytes for c, n in n_windows.items()}
+		max_bytes = max(self.chrom_bytes.values()) if self.chroms else 0
+		self.n_resident = max(2, int(mem_budget*2**20/max_bytes) if max_bytes else 2)
+		if mem_budget and self.n_resident*max_bytes > mem_budget*2**20:
+			logger.warn("A %i MB budget cannot hold two %.1f MB chromosomes. Streaming two at a time anyway"%(mem_budget, max_bytes/2.0**20))
+		logger.debug("Keeping up to %i chromosomes (%.1f MB each) resident"%(self.n_resident, max_bytes/2.0**20))
+	def _loads(self, slots):
+		for chrom in self.chroms:
+			# Wait for a resident chromosome to be released
+			slots.acquire()
+			yield (chrom, self.load(chrom))
+	def fit_epoch(self, model, history_class, E):
+		'''
+		Fits one epoch, streaming the chromosomes through a bounded buffer
+
+		# Parameters
+		model (tf.keras.Model): Compiled model
+		history_class (class): Callback that collects batch losses and accuracies
+		E (int): Epoch number
+		'''
+		slots = threading.Semaphore(self.n_resident)
+		stats = {}
+		fit_time, stall_time = 0.0, 0.0
+		loads = background_iter(self._loads(slots), depth=self.n_resident-1, stats=stats)
+		try:
+			while True:
+				start = time()
+				try:
+					chrom, data = next(loads)
+				except StopIteration:
+					break
+				stall_time += time()-start
+				start = time()
+				fit_chrom(model, history_class, E, chrom, data, self.model_batch, self.stateful, self.stranded)
+				fit_time += time()-start
+				del data
+				slots.release()
+		finally:
+			# Unblock the loader if fitting stopped early
+			for i in range(self.n_resident): slots.release()
+			loads.close()
+		io_time = stats.get('produce', 0)
+		hidden = 100*(1-stall_time/io_time) if io_time else 100
+		logger.info("Epoch-%04i - Loading %.1fs, fitting %.1fs, waiting %.1fs (%i%% of loading hidden)"%(E, \
+			io_time, fit_time, stall_time, int(max(0, hidden))))
@@ -7,17 +7,28 @@ import numpy as np
 import multiprocessing as mp
 from functools import partial
 from quicksect import IntervalTree
-from teamRNN.constants import gff3_f2i, gff3_i2f, contexts, strands, base2index, te_feature_names
+from teamRNN.constants import gff3_f2i, gff3_i2f, contexts, strands, base2index, base_lut, twobit_lut, te_feature_names
+from teamRNN.constants import compact_dtype, max_compact_cov
 from teamRNN.constants import te_order_f2i, te_order_i2f, te_sufam_f2i, te_sufam_i2f
-from teamRNN.util import irange, iterdict
-from collections import defaultdict as dd
-import re, logging, os
+from teamRNN.util import irange, iterdict, file_signature, cache_key, file_digest, file_lock
+from collections import defaultdict as dd, OrderedDict
+import re, logging, os, tempfile, threading, atexit
 from time import time
 logger = logging.getLogger(__name__)
-try:
-	import cPickle as pickle
-except:
-	import pickle
+
+# {file: pid} of the shared batch buffers each process has allocated
+_shared_files = {}
+def _remove_shared_files():
+	'''
+	Removes the shared batch buffers left by this process when it exits
+	without closing its input_slicers. Buffers of a parent process are
+	kept, since forked children inherit the registry.
+	'''
+	for shared_file, pid in list(_shared_files.items()):
+		if pid == os.getpid() and os.path.exists(shared_file):
+			os.remove(shared_file)
+		_shared_files.pop(shared_file, None)
+atexit.register(_remove_shared_files)
 
 known_qualities = dd(int)
 known_qualities.update({'dna:chromosome':3, 'dna:contig':1, 'dna:scaffold':2, 'dna:supercontig':1})
@@ -28,6 +39,40 @@ def _split2quality(split_name):
 	else:
 		return 0
 
+def fasta_qualities(fasta_file):
+	'''
+	Detects the assembly quality of every chromosome from its FASTA header
+	in a single forward pass. The .fai sequence offsets are visited in file
+	order and only the header line right before each one is read, so the
+	FASTA is opened once and the sequences themselves are never scanned.
+
+	# Parameters
+	fasta_file (str): Indexed FASTA file
+
+	# Returns
+	dict: {chrom: quality}
+	'''
+	offsets = []
+	with open('%s.fai'%(fasta_file), 'r') as FAI:
+		for split_line in map(lambda x: x.rstrip('\n').split('\t'), FAI):
+			offsets.append((int(split_line[2]), split_line[0]))
+	qualities = {}
+	with open(fasta_file, 'rb') as FA:
+		for offset, chrom in sorted(offsets):
+			# Grow the look-behind until the whole header line is covered
+			look_behind = 256
+			while True:
+				start = max(0, offset-look_behind)
+				FA.seek(start)
+				block = FA.read(offset-start)
+				header_start = block.rfind(b'>')
+				if header_start != -1 or start == 0: break
+				look_behind *= 4
+			header = block[header_start:].decode('ascii', 'replace').rstrip('\r\n')
+			split_line = header.split(' ')
+			qualities[chrom] = _split2quality(split_line) if split_line[0] == '>%s'%(chrom) else 0
+	return qualities
+
 class refcache:
 	def __init__(self, fasta_file, cacheSize=5000000):
 		self.fasta_file = fasta_file
@@ -59,7 +104,7 @@ class refcache:
 	def fetch(self, chrom, pos, pos2):
 		assert(pos2 <= self.chrom_lens[chrom])
 		if pos2-pos+1 >= self.cacheSize:
-			logger.debug("Region was too large for refcache, you should consider increasing the cache size to %i"%((pos2-pos1+1)*10))
+			logger.debug("Region was too large for refcache, you should consider increasing the cache size to %i"%((pos2-pos+1)*10))
 			return self.FA.fetch(chrom, pos, pos2)
 		if pos < self.start[chrom] or pos2 > self.end[chrom]:
 			self.start[chrom] = pos
@@ -70,27 +115,432 @@ class refcache:
 		eI = pos2-self.start[chrom]
 		return self.chrom_caches[chrom][sI:eI]
 
+class packed_reference:
+	'''
+	Read-only 2-bit reference store
+
+	Every chromosome is stored once as memory-mappable arrays of four
+	2-bit base indices (A G T C) per byte plus a bit-packed mask of N (and
+	other ambiguous) bases. Worker processes map the same files, so the
+	reference is shared through the page cache instead of being copied
+	into every process, and fetches decode straight to the uint8 base
+	channel.
+
+	>>> PR = packed_reference('ref.fa')
+	>>> PR.fetch('Chr1', 0, 5)
+	array([0, 1, 2, 3, 4], dtype=uint8)
+	'''
+	version = 1
+	def __init__(self, fasta_file, store_dir='', chunkSize=2**23):
+		self.fasta_file = fasta_file
+		if not store_dir: store_dir = '%s.2bit'%(fasta_file)
+		key = cache_key(file_signature(fasta_file), self.version)
+		self.store_dir = os.path.join(store_dir, key)
+		self.index_file = os.path.join(self.store_dir, 'index.tsv')
+		# Keep chunks byte aligned for both the bases and the mask
+		self.chunkSize = max(8, chunkSize - chunkSize%8)
+		if not os.path.exists(self.index_file):
+			self._build()
+		self.chroms = []
+		self.chrom_lens = {}
+		self.chrom_qualities = {}
+		with open(self.index_file, 'r') as IF:
+			for chrom, chrom_len, quality in map(lambda x: x.rstrip('\n').split('\t'), IF):
+				self.chroms.append(chrom)
+				self.chrom_lens[chrom] = int(chrom_len)
+				self.chrom_qualities[chrom] = int(quality)
+		self.tracks = {}
+	def _track_files(self, chrom):
+		return (os.path.join(self.store_dir, '%s.2bit.npy'%(chrom)), \
+			os.path.join(self.store_dir, '%s.nmask.npy'%(chrom)))
+	def _build(self):
+		try:
+			os.makedirs(self.store_dir)
+		except OSError:
+			# Already created (possibly by another rank)
+			assert(os.path.isdir(self.store_dir))
+		with file_lock(os.path.join(self.store_dir, 'build.lock')):
+			if os.path.exists(self.index_file): return
+			s_time = time()
+			qualities = fasta_qualities(self.fasta_file)
+			index_lines = []
+			with FastaFile(self.fasta_file) as FA:
+				for chrom in FA.references:
+					chrom_len = FA.get_reference_length(chrom)
+					self._pack_chrom(FA, chrom, chrom_len)
+					index_lines.append('%s\t%i\t%i\n'%(chrom, chrom_len, qualities[chrom]))
+			# The index is written last and marks the store as complete
+			tmp_file = '%s.%i.tmp'%(self.index_file, os.getpid())
+			with open(tmp_file, 'w') as OF:
+				OF.writelines(index_lines)
+			os.rename(tmp_file, self.index_file)
+			logger.info("Packed %s in %i seconds"%(self.fasta_file, int(time()-s_time)))
+	def _pack_chrom(self, FA, chrom, chrom_len):
+		base_file, mask_file = self._track_files(chrom)
+		tmp_files = ['%s.%i.tmp.npy'%(f[:-4], os.getpid()) for f in (base_file, mask_file)]
+		packed = np.lib.format.open_memmap(tmp_files[0], mode='w+', dtype=np.uint8, shape=((chrom_len+3)//4,))
+		nmask = np.lib.format.open_memmap(tmp_files[1], mode='w+', dtype=np.uint8, shape=((chrom_len+7)//8,))
+		for cur in irange(0, chrom_len, self.chunkSize):
+			bases = encode_seq(FA.fetch(chrom, cur, min(cur+self.chunkSize, chrom_len)))
+			n_mask = bases == base2index['N']
+			quads = np.zeros(((len(bases)+3)//4, 4), dtype=np.uint8)
+			quads.flat[:len(bases)] = bases & 3
+			packed[cur//4:cur//4+len(quads)] = (quads[:,0] << 6) | (quads[:,1] << 4) | (quads[:,2] << 2) | quads[:,3]
+			n_bits = np.packbits(n_mask)
+			nmask[cur//8:cur//8+len(n_bits)] = n_bits
+		for array, tmp_file, out_file in zip((packed, nmask), tmp_files, (base_file, mask_file)):
+			array.flush()
+			del array
+			os.rename(tmp_file, out_file)
+	def track(self, chrom):
+		'''
+		Returns the memory-mapped (packed bases, N-mask, has N) of a chromosome
+		'''
+		if chrom not in self.tracks:
+			# Plain ndarray views of the maps skip np.memmap's per-slice overhead
+			packed, nmask = (np.asarray(np.load(f, mmap_mode='r')) for f in self._track_files(chrom))
+			self.tracks[chrom] = (packed, nmask, bool(nmask.any()))
+		return self.tracks[chrom]
+	def fetch(self, chrom, pos, pos2):
+		'''
+		Returns the uint8 base indices of the 0-based half-open region [pos, pos2)
+		'''
+		assert(pos2 <= self.chrom_lens[chrom])
+		packed, nmask, has_n = self.track(chrom)
+		b0 = pos//4
+		bases = twobit_lut.take(packed[b0:(pos2+3)//4]).view(np.uint8)[pos-4*b0:pos2-4*b0]
+		if has_n:
+			m0 = pos//8
+			n_bytes = nmask[m0:(pos2+7)//8]
+			if n_bytes.any():
+				n_bits = np.unpackbits(n_bytes)[pos-8*m0:pos2-8*m0]
+				bases[n_bits.astype(bool)] = base2index['N']
+		return bases
+
+class methcache:
+	'''
+	Bulk methylation loader for Meth5py files
+
+	Instead of one small HDF5 read per window, aligned chunks of a
+	chromosome's context, strand, c, and ct columns are read at once into
+	contiguous arrays and windows are sliced out of them. Chromosomes no
+	longer than `chunkSize` are loaded whole, and at most
+	`cacheSize/chunkSize` chunks are kept in memory (least recently used
+	chunks are dropped first).
+
+	>>> MC = methcache('meth.txt', 'ref.fa')
+	>>> context, strand, c, ct = MC.fetch('Chr1', 0, 500)
+	'''
+	def __init__(self, meth_file, fasta_file, chunkSize=1000000, cacheSize=32000000):
+		MS = meth_store(meth_file, fasta_file)
+		if MS.complete():
+			# Converted columns are memory-mapped instead of indexed by Meth5py
+			self.MS, self.M5 = MS, False
+			self.chrom_lens = dict(MS.chrom_lens)
+		else:
+			self.MS, self.M5 = False, Meth5py(meth_file, fasta_file)
+			self.chrom_lens = dict(self.M5.chrom_dict)
+		self.chunkSize = chunkSize
+		self.maxChunks = max(1, int(cacheSize/chunkSize))
+		self.chunks = OrderedDict()
+		# Guards the LRU and HDF5 handle when regions are read from threads
+		self.lock = threading.Lock()
+	def close(self):
+		if self.M5: self.M5.close()
+	def _load_chunk(self, chrom, chunk_index):
+		key = (chrom, chunk_index)
+		with self.lock:
+			if key in self.chunks:
+				# Mark as most recently used
+				self.chunks[key] = self.chunks.pop(key)
+				return self.chunks[key]
+			start = chunk_index*self.chunkSize
+			end = min(start+self.chunkSize, self.chrom_lens[chrom])
+			# [[context_I, strand_I, c, ct, g, ga], ...]
+			block = self.M5.H5[chrom][start:end,:4]
+			columns = (np.ascontiguousarray(block[:,0], dtype=np.int8), \
+				np.ascontiguousarray(block[:,1], dtype=np.int8), \
+				np.ascontiguousarray(block[:,2]), np.ascontiguousarray(block[:,3]))
+			self.chunks[key] = columns
+			while len(self.chunks) > self.maxChunks:
+				self.chunks.popitem(last=False)
+			return columns
+	def fetch(self, chrom, pos, pos2):
+		'''
+		Returns the (context, strand, c, ct) columns of [pos, pos2), where
+		missing records have a context of -1. Regions within a single
+		chunk (or any region of a converted store) are returned as views.
+		'''
+		assert(pos2 <= self.chrom_lens[chrom])
+		if self.MS: return self.MS.fetch(chrom, pos, pos2)
+		first = pos//self.chunkSize
+		last = max(first, (pos2-1)//self.chunkSize)
+		if first == last:
+			offset = first*self.chunkSize
+			return tuple(col[pos-offset:pos2-offset] for col in self._load_chunk(chrom, first))
+		parts = []
+		for chunk_index in irange(first, last+1):
+			offset = chunk_index*self.chunkSize
+			sI = max(pos, offset)-offset
+			eI = min(pos2, offset+self.chunkSize)-offset
+			parts.append([col[sI:eI] for col in self._load_chunk(chrom, chunk_index)])
+		return tuple(np.concatenate(cols) for cols in zip(*parts))
+
+class meth_store:
+	'''
+	Memory-mapped columnar methylation store
+
+	The methratio file is converted once into per-chromosome .npy columns
+	of context and strand indices (int8) and c and ct counts (int32), laid
+	out like the Meth5py index with -1 at positions without a record. The
+	file is parsed in parallel by splitting it into line-aligned byte
+	ranges, and every process writes its records straight into the
+	memory-mapped columns. The index is written last and marks the store as
+	complete, after which methcache reads from it instead of Meth5py.
+
+	>>> MS = meth_store('meth.txt', 'ref.fa')
+	>>> n_lines = MS.build(processes=8)
+	>>> context, strand, c, ct = MS.fetch('Chr1', 0, 500)
+	'''
+	version = 1
+	columns = (('context', np.int8), ('strand', np.int8), ('c', np.int32), ('ct', np.int32))
+	def __init__(self, meth_file, fasta_file, store_dir=''):
+		self.meth_file = meth_file
+		self.fasta_file = fasta_file
+		if not store_dir: store_dir = '%s.columns'%(meth_file)
+		key = cache_key(file_signature(meth_file), file_signature(fasta_file), self.version)
+		self.store_dir = os.path.join(store_dir, key)
+		self.index_file = os.path.join(self.store_dir, 'index.tsv')
+		with FastaFile(fasta_file) as FA:
+			self.chrom_lens = {c:FA.get_reference_length(c) for c in FA.references}
+		self.tracks = {}
+	def complete(self):
+		return os.path.exists(self.index_file)
+	def _column_files(self, chrom):
+		return [os.path.join(self.store_dir, '%s.%s.npy'%(chrom, name)) for name, dtype in self.columns]
+	def _ranges(self, chunk_bytes):
+		'''
+		Splits the methratio file after its header into byte ranges that
+		start and end on line boundaries
+		'''
+		file_size = os.path.getsize(self.meth_file)
+		with open(self.meth_file, 'rb') as MF:
+			first_line = MF.readline()
+			start = MF.tell() if first_line.split(b'\t')[0] == b'chr' else 0
+			bounds = [start]
+			for approx in irange(start+chunk_bytes, file_size, chunk_bytes):
+				if approx <= bounds[-1]: continue
+				MF.seek(approx)
+				MF.readline()
+				bounds.append(min(MF.tell(), file_size))
+		if bounds[-1] != file_size: bounds.append(file_size)
+		return [(s, e) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+	def build(self, processes=0, chunk_bytes=2**26):
+		'''
+		Converts the methratio file into the store
+
+		# Parameters
+		processes (int): Parsing processes [all cores]
+		chunk_bytes (int): Approximate bytes of the methratio file parsed per task
+
+		# Returns
+		int: Number of methratio records converted, excluding those
+		outside of the reference chromosomes
+		'''
+		try:
+			os.makedirs(self.store_dir)
+		except OSError:
+			# Already created (possibly by another rank)
+			assert(os.path.isdir(self.store_dir))
+		with file_lock(os.path.join(self.store_dir, 'build.lock')):
+			if self.complete(): return 0
+			s_time = time()
+			for chrom, chrom_len in iterdict(self.chrom_lens):
+				for (name, dtype), column_file in zip(self.columns, self._column_files(chrom)):
+					column = np.lib.format.open_memmap(column_file, mode='w+', dtype=dtype, shape=(chrom_len,))
+					column[:] = -1
+					column.flush()
+					del column
+			ranges = self._ranges(chunk_bytes)
+			NP = min(processes if processes else mp.cpu_count(), len(ranges))
+			task = partial(convert_methratio_range, meth_file=self.meth_file, store=self)
+			if NP > 1:
+				pool = mp.Pool(NP)
+				counts = list(pool.imap_unordered(task, ranges))
+				pool.close()
+				pool.join()
+			else:
+				counts = list(map(task, ranges))
+			n_lines, n_skipped = map(sum, zip(*counts)) if counts else (0, 0)
+			if n_skipped:
+				logger.warn("Skipped %i methratio lines outside of the chromosomes in %s"%(n_skipped, self.fasta_file))
+			# The index is written last and marks the store as complete
+			tmp_file = '%s.%i.tmp'%(self.index_file, os.getpid())
+			with open(tmp_file, 'w') as OF:
+				OF.writelines(['%s\t%i\n'%(chrom, self.chrom_lens[chrom]) for chrom in sorted(self.chrom_lens)])
+			os.rename(tmp_file, self.index_file)
+			elapsed = time()-s_time
+			logger.info("Converted %i methratio lines with %i processes in %.1f seconds (%i lines/s)"%(n_lines, \
+				max(NP, 1), elapsed, int(n_lines/max(elapsed, 1e-9))))
+			return n_lines
+	def track(self, chrom):
+		'''
+		Returns the memory-mapped (context, strand, c, ct) columns of a chromosome
+		'''
+		if chrom not in self.tracks:
+			# Plain ndarray views of the maps skip np.memmap's per-slice overhead
+			self.tracks[chrom] = tuple(np.asarray(np.load(f, mmap_mode='r')) for f in self._column_files(chrom))
+		return self.tracks[chrom]
+	def fetch(self, chrom, pos, pos2):
+		'''
+		Zero-copy views of the (context, strand, c, ct) columns of [pos, pos2)
+		'''
+		return tuple(col[pos:pos2] for col in self.track(chrom))
+
+class feature_store:
+	'''
+	Persistent, memory-mapped per-chromosome input tracks
+
+	Each chromosome is stored as a contiguous .npy file of chrom_len compact
+	input records, which expand to the output of input_slicer._get_region
+	over the whole chromosome. Quality and ploidy are only added when the
+	records are expanded, so tracks live in a sub-directory keyed by just the
+	reference and methratio, and changing either creates a new store instead
+	of reusing a stale one.
+
+	>>> FS = feature_store('ref.fa', 'meth.txt', store_dir='meth.txt.features')
+	>>> FS.build(input_slicer('ref.fa', 'meth.txt'))
+	>>> x = expand_inputs(FS.fetch('Chr1', 0, 500), FS.ploidy, 3)
+	'''
+	version = 2
+	def __init__(self, fasta_file, meth_file, quality=-1, ploidy=2, store_dir=''):
+		self.fasta_file = fasta_file
+		self.meth_file = meth_file
+		self.quality = quality
+		self.ploidy = ploidy
+		if not store_dir: store_dir = '%s.features'%(meth_file)
+		key = cache_key(file_signature(fasta_file), file_signature(meth_file), self.version)
+		self.store_dir = os.path.join(store_dir, key)
+		with FastaFile(fasta_file) as FA:
+			self.chrom_lens = {c:FA.get_reference_length(c) for c in FA.references}
+		self.tracks = {}
+		# Chromosomes without a track, so windows do not stat the file again
+		self.missing = set()
+	def _track_file(self, chrom):
+		return os.path.join(self.store_dir, '%s.npy'%(chrom))
+	def has(self, chrom):
+		if chrom in self.tracks: return True
+		if chrom in self.missing: return False
+		if os.path.exists(self._track_file(chrom)): return True
+		self.missing.add(chrom)
+		return False
+	def complete(self):
+		return all(map(self.has, self.chrom_lens))
+	def track(self, chrom):
+		'''
+		Returns the read-only memory-mapped track of a chromosome
+		'''
+		if chrom not in self.tracks:
+			self.tracks[chrom] = np.load(self._track_file(chrom), mmap_mode='r')
+			assert(self.tracks[chrom].shape == (self.chrom_lens[chrom],))
+		return self.tracks[chrom]
+	def fetch(self, chrom, start, end):
+		'''
+		Zero-copy view of the compact records in [start, end) of the
+		chromosome track
+		'''
+		return self.track(chrom)[start:end]
+	def build(self, IS, chroms=[], chunk_size=1000000, force=False):
+		'''
+		Featurizes chromosomes with an input_slicer and writes their tracks
+
+		Tracks are written to a temporary file and renamed when finished,
+		so an interrupted run never leaves a partial track behind.
+
+		# Parameters
+		IS (input_slicer): slicer opened on the same reference and methratio
+		chroms (list): chromosomes to featurize [all]
+		chunk_size (int): bases featurized per _get_region call
+		force (bool): rebuild existing tracks
+		'''
+		try:
+			os.makedirs(self.store_dir)
+		except OSError:
+			# Already created (possibly by another rank)
+			assert(os.path.isdir(self.store_dir))
+		for chrom in sorted(chroms if chroms else self.chrom_lens):
+			if self.has(chrom) and not force: continue
+			s_time = time()
+			chrom_len = self.chrom_lens[chrom]
+			chrom_quality = IS.RC.chrom_qualities[chrom] if self.quality == -1 else self.quality
+			out_file = self._track_file(chrom)
+			tmp_file = '%s.%i.tmp.npy'%(out_file[:-4], os.getpid())
+			out_track = np.lib.format.open_memmap(tmp_file, mode='w+', \
+				dtype=compact_dtype, shape=(chrom_len,))
+			for cur in irange(0, chrom_len, chunk_size):
+				cur_len = min(chunk_size, chrom_len-cur)
+				out_track[cur:cur+cur_len] = IS._get_region(chrom, cur, chrom_len, chrom_quality, cur_len, compact=True)[1]
+			out_track.flush()
+			del out_track
+			os.rename(tmp_file, out_file)
+			self.tracks.pop(chrom, None)
+			self.missing.discard(chrom)
+			logger.info("Featurized %s in %i seconds"%(chrom, int(time()-s_time)))
+
 class gff3_interval:
+	version = 1
 	def __init__(self, gff3, out_dim=len(gff3_f2i)+2, include_chrom=False, force=False):
 		self.gff3 = gff3
-		self.pkl = "%s.pkl"%(gff3)
 		self.out_dim = out_dim
 		self.noTEMD = out_dim == len(gff3_f2i)
 		self.force = force
 		self._order_re = re.compile('Order=(?P<order>[^;/]+)')
 		self._sufam_re = re.compile('Superfamily=(?P<sufam>[^;]+)')
-		# creates self.interval_tree
-		self._2tree(include_chrom)
-	def _2tree(self, include_chrom=False):
+		self.include_chrom = include_chrom
+		# Cache files are keyed by the GFF3 contents and every parse parameter
+		self.key = cache_key(file_digest(gff3), out_dim, self.noTEMD, include_chrom, self.version)
+		self.lock_file = '%s.%s.lock'%(gff3, self.key)
+		self._interval_tree = False
+		# creates self.intervals
+		self._2array(include_chrom)
+		# Packed feature flags take n_bytes, followed by uint8 TE order and superfamily
+		self.n_bytes = (len(gff3_f2i)+7)//8
+		# Rasters are opened on the first fetch of each chromosome
+		self.rasters = {}
+	def _cached(self, cache_file, build):
+		'''
+		Returns True after making sure cache_file exists. Only one process
+		builds it, through build(tmp_file) and an atomic rename, while the
+		others wait on the lock and then reuse it.
+		'''
+		if os.path.exists(cache_file) and not self.force:
+			return True
+		with file_lock(self.lock_file):
+			if not os.path.exists(cache_file) or self.force:
+				tmp_file = '%s.%i.tmp'%(cache_file, os.getpid())
+				build(tmp_file)
+				os.rename(tmp_file, cache_file)
+		return True
+	def _2array(self, include_chrom=False):
+		'''
+		Parses the GFF3 into sorted per-chromosome interval arrays of
+		(starts, ends, [element_id, te_order_id, te_sufam_id]), which are cached
+		in "<gff3>.<key>.npz".
+		'''
+		npz_file = '%s.%s.npz'%(self.gff3, self.key)
+		self._cached(npz_file, partial(self._write_arrays, include_chrom=include_chrom))
+		self.intervals = {}
+		with np.load(npz_file) as NPZ:
+			offsets = NPZ['offsets']
+			starts, ends, data = NPZ['starts'], NPZ['ends'], NPZ['data']
+			for i, chrom in enumerate(NPZ['chroms']):
+				s, e = offsets[i:i+2]
+				self.intervals[str(chrom)] = (starts[s:e], ends[s:e], data[s:e])
+		logger.debug("Loaded %i intervals from %s"%(len(starts), npz_file))
+	def _write_arrays(self, out_file, include_chrom=False):
 		#Chr1    TAIR10  transposable_element_gene       433031  433819  .       -       .       ID=AT1G02228;Note=transposable_element_gene;Name=AT1G02228;Derives_from=AT1TE01405
 		exclude = set(['chromosome','contig','supercontig']) if include_chrom else set([])
-		self.interval_tree = dd(IntervalTree)
-		if os.path.exists(self.pkl) and not self.force:
-			with open(self.pkl,'rb') as P:
-				chrom_file_dict = pickle.load(P)
-			for chrom, pkl_file in iterdict(chrom_file_dict):
-				self.interval_tree[chrom].load(pkl_file)
-			return
+		records = dd(list)
 		with open(self.gff3,'r') as IF:
 			for line in filter(lambda x: x[0] != "#", IF):
 				tmp = line.rstrip('\n').split('\t')
@@ -107,60 +557,143 @@ class gff3_interval:
 						except:
 							te_order_id, te_sufam_id = 0,0
 					start, end = map(int, tmp[3:5])
-					self.interval_tree[chrom].add(start-1, end, (element_id, te_order_id, te_sufam_id))
-		logger.debug("Finished creating interval trees")
-		chrom_file_dict = {chrom:'%s.%s.pkl'%(self.gff3, chrom) for chrom in self.interval_tree}
-		for chrom, pkl_file in iterdict(chrom_file_dict):
-			self.interval_tree[chrom].dump(pkl_file)
-		with open(self.pkl, 'wb') as P:
-			pickle.dump(chrom_file_dict, P)
-		logger.debug("Finished creating pickle files")
+					records[chrom].append((start-1, end, element_id, te_order_id, te_sufam_id))
+		chroms = sorted(records)
+		# Stable sort keeps file order for identical intervals
+		rows = [sorted(records[chrom], key=lambda r: (r[0], r[1])) for chrom in chroms]
+		offsets = np.cumsum([0]+list(map(len, rows)))
+		flat = np.array([r for chrom_rows in rows for r in chrom_rows], dtype=np.int64).reshape(-1,5)
+		with open(out_file, 'wb') as OF:
+			np.savez(OF, chroms=np.array(chroms), offsets=offsets, starts=flat[:,0], \
+				ends=flat[:,1], data=flat[:,2:].astype(np.uint8))
+		logger.debug("Finished parsing %s"%(self.gff3))
+	@property
+	def interval_tree(self):
+		'''
+		quicksect trees of the cached intervals, only built when requested
+		'''
+		if self._interval_tree is False:
+			self._interval_tree = dd(IntervalTree)
+			for chrom, (starts, ends, data) in iterdict(self.intervals):
+				for s, e, d in zip(starts, ends, data):
+					self._interval_tree[chrom].add(int(s), int(e), tuple(map(int, d)))
+		return self._interval_tree
 	def _extract_order_sufam(self, attribute_string):
 		order_match = self._order_re.search(attribute_string)
 		sufam_match = self._sufam_re.search(attribute_string)
 		order_str = order_match.group('order') if order_match else ''
 		sufam_str = sufam_match.group('sufam') if sufam_match else ''
 		return (order_str, sufam_str)
+	def _raster_file(self, chrom):
+		return '%s.%s.%s.labels.npy'%(self.gff3, self.key, chrom)
+	def _raster(self, chrom):
+		'''
+		Rasterizes the annotation of a chromosome into a per-base uint8 label
+		array of [packed feature flags, TE order, TE superfamily], which is
+		cached next to the GFF3 and memory-mapped.
+
+		# Parameters
+		chrom (str): Chromosome name
+
+		# Returns
+		np.memmap: (max_end, n_bytes+2) uint8 label array
+		'''
+		raster_file = self._raster_file(chrom)
+		self._cached(raster_file, partial(self._write_raster, chrom))
+		return np.load(raster_file, mmap_mode='r')
+	def raster(self, chrom):
+		'''
+		Returns the memory-mapped label array of a chromosome
+		'''
+		if chrom not in self.rasters:
+			self.rasters[chrom] = self._raster(chrom)
+		return self.rasters[chrom]
+	def _write_raster(self, chrom, out_file):
+		# Later intervals overwrite TE metadata, matching a sorted search
+		starts, ends, data = self.intervals[chrom]
+		chrom_len = int(ends.max()) if len(ends) else 0
+		raster = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.uint8, \
+			shape=(chrom_len, self.n_bytes+2))
+		chunk_size = 1000000
+		for chunk_start in irange(0, chrom_len, chunk_size):
+			chunk_end = min(chunk_start+chunk_size, chrom_len)
+			flags = np.zeros((chunk_end-chunk_start, len(gff3_f2i)), dtype=np.uint8)
+			te_md = np.zeros((chunk_end-chunk_start, 2), dtype=np.uint8)
+			for index in np.where((starts < chunk_end) & (ends > chunk_start))[0]:
+				s = max(starts[index], chunk_start)-chunk_start
+				e = min(ends[index], chunk_end)-chunk_start
+				element_id, te_order_id, te_sufam_id = data[index]
+				flags[s:e,element_id] = 1
+				te_md[s:e] = (te_order_id, te_sufam_id)
+			raster[chunk_start:chunk_end,:self.n_bytes] = np.packbits(flags, axis=1)
+			raster[chunk_start:chunk_end,self.n_bytes:] = te_md
+		raster.flush()
+		del raster
+		logger.debug("Rasterized %s annotation"%(chrom))
 	def fetch(self, chrom, start, end):
 		outA = np.zeros((end-start, self.out_dim), dtype=np.uint8)
-		#print("Fetching %s:%i-%i"%(chrom, start, end))
-		for interval in self.interval_tree[chrom].search(start,end):
-			s = max(interval.start, start)-start
-			e = min(interval.end, end)-start
-			element_id, te_order_id, te_sufam_id = interval.data
-			#print("Detected %s at %i-%i"%(i,s,e))
-			outA[s:e,element_id] = 1
+		if chrom not in self.intervals: return outA
+		raster = self.raster(chrom)
+		# Bases past the last annotated interval stay unlabeled
+		e = min(end, raster.shape[0])-start
+		if e > 0:
+			region = raster[start:start+e]
+			outA[:e,:len(gff3_f2i)] = np.unpackbits(region[:,:self.n_bytes], axis=1)[:,:len(gff3_f2i)]
 			if not self.noTEMD:
-				outA[s:e,-2] = te_order_id
-				outA[s:e,-1] = te_sufam_id
+				outA[:e,-2:] = region[:,self.n_bytes:]
 		return outA
 
 class input_slicer:
-	def __init__(self, fasta_file, meth_file, gff3_file='', quality=-1, ploidy=2, out_dim=len(gff3_f2i)+2, stateful=False):
+	def __init__(self, fasta_file, meth_file, gff3_file='', quality=-1, ploidy=2, out_dim=len(gff3_f2i)+2, stateful=False, features='', workers=4):
 		self.fasta_file = fasta_file
 		self.FA = FastaFile(fasta_file)
 		self.meth_file = meth_file
-		self.M5 = False if stateful else Meth5py(meth_file, fasta_file)
+		self.features = features
+		self.FS = feature_store(fasta_file, meth_file, quality, ploidy, features) if features else False
+		if self.FS and self.FS.complete():
+			logger.debug("Reading all inputs from the feature store in %s"%(self.FS.store_dir))
+			self.MC = False
+		else:
+			self.MC = False if stateful else methcache(meth_file, fasta_file)
 		self.gff3_file = gff3_file
 		if gff3_file:
 			self.GI = gff3_interval(gff3_file, out_dim=out_dim)
-		self.RC = refcache(fasta_file)
+		self.RC = packed_reference(fasta_file)
 		self.quality = quality
 		self.ploidy = ploidy
 		self.out_dim = out_dim
-		if stateful:
-			self.pool = mp.Pool(4, slicer_init, (self.fasta_file, self.meth_file, \
-						self.gff3_file, self.quality, self.ploidy, self.out_dim))
+		self._arange = np.arange(0)
+		self.workers = workers
+		# (shape, file, x, y) of the batch buffer shared with the pool
+		self._shared = False
+		# Only one batch at a time fills the shared buffer
+		self._pool_lock = threading.Lock()
+		if stateful and not (self.FS and self.FS.complete()):
+			# Workers read the memory-mapped methylation columns. Forked processes
+			# cannot safely read an HDF5 file the parent may have open, so the
+			# Meth5py index is never used by the pool.
+			meth_store(meth_file, fasta_file).build(workers)
+			self.pool = mp.Pool(workers, slicer_init, (self.fasta_file, self.meth_file, \
+						self.gff3_file, self.quality, self.ploidy, self.out_dim, self.features))
 		else:
 			self.pool = False
 	def __del__(self):
-		for f in (self.FA, self.M5):
+		self.close()
+	def close(self):
+		'''
+		Closes the reference and methylation files, stops the worker pool,
+		and removes the shared batch buffer
+		'''
+		for f in (self.FA, self.MC):
 			if f: f.close()
+		self.FA, self.MC = False, False
 		if self.pool:
 			self.pool.close()
 			self.pool.join()
+			self.pool = False
+		self._free_shared()
 #>C1 dna:chromosome chromosome:BOL:C1:1:43764888:1 REF
-	def _get_region(self, chrom, cur, chrom_len, chrom_quality, seq_len, print_region=False):
+	def _get_region(self, chrom, cur, chrom_len, chrom_quality, seq_len, print_region=False, compact=False):
 		def log_time(st,et,c):
 			out_str = 'get (s) - '
 			out_str += ' '.join(['%s:%i'%(i,int(et[i]-st[i])) for i in c])
@@ -171,27 +704,25 @@ class input_slicer:
 		if print_region: logger.debug("Fetching %s:%i-%i"%(chrom, cur, cur+seq_len))
 		#print "Fetching %s:%i-%i"%(chrom, cur, cur+seq_len)
 		coord = (chrom, cur, cur+seq_len)
-		#startTimes['reference'] = time()
-		seq = self.RC.fetch(chrom, cur, cur+seq_len)
-		#endTimes['reference'] = time()
-		# [[context_I, strand_I, c, ct, g, ga], ...]
-		#startTimes['methylation'] = time()
-		meth = self.M5.fetch(chrom, cur+1, cur+seq_len)
-		#endTimes['methylation'] = time()
-		assert(len(seq) == len(meth))
-		# Transform output
-		out_slice = np.zeros((len(seq), 10), dtype=np.float32)
-		#startTimes['transform'] = time()
-		out_slice[:,0] = [base2index[b] for b in seq]
-		out_slice[:,1] = np.arange(cur+1,cur+len(seq)+1)/float(chrom_len)
-		out_slice[:,8] = self.ploidy
-		out_slice[:,9] = chrom_quality
-		### Methylation
-		not_n1 = meth[:,0] != -1
-		new_index = meth[not_n1, 0]*2+2
-		out_slice[not_n1, new_index] = np.true_divide(meth[not_n1, 2], meth[not_n1, 3])
-		out_slice[not_n1, new_index+1] = meth[not_n1, 3]
-		#endTimes['transform'] = time()
+		if self.FS and self.FS.has(chrom):
+			# Zero-copy view of the pre-computed track
+			out_slice = self.FS.fetch(chrom, cur, cur+seq_len)
+		else:
+			#startTimes['reference'] = time()
+			bases = self.RC.fetch(chrom, cur, cur+seq_len)
+			#endTimes['reference'] = time()
+			# (context_I, strand_I, c, ct)
+			#startTimes['methylation'] = time()
+			meth = self.MC.fetch(chrom, cur, cur+seq_len)
+			#endTimes['methylation'] = time()
+			assert(len(bases) == len(meth[0]))
+			# Transform output
+			#startTimes['transform'] = time()
+			out_slice = self._compact_region(bases, meth, cur, chrom_len)
+			#endTimes['transform'] = time()
+		# Inputs stay compact until they reach the model
+		if not compact:
+			out_slice = expand_inputs(out_slice, self.ploidy, chrom_quality)
 		if self.gff3_file:
 			#startTimes['gff3'] = time()
 			y_array = self.GI.fetch(chrom, cur, cur+seq_len)
@@ -201,56 +732,154 @@ class input_slicer:
 		else:
 			#log_time(startTimes, endTimes, time_categories)
 			return (coord, out_slice)
-	def chrom_iter(self, chrom, seq_len=5, offset=1, batch_size=False, hvd_rank=0, hvd_size=1, stranded=False):
+	def _compact_region(self, bases, meth, cur, chrom_len):
+		'''
+		Transforms encoded reference bases and their methylation records into
+		compact input records. Methylation ratios are stored as float16 and
+		coverage as uint16, saturating at %i.
+
+		# Parameters
+		bases (np.ndarray): uint8 base indices starting at 0-based position `cur`
+		meth (tuple): methcache columns (context_I, strand_I, c, ct)
+		cur (int): 0-based start of the region
+		chrom_len (int): Length of the chromosome
+
+		# Returns
+		np.ndarray: compact_dtype array of shape (len(bases),)
+		'''%(max_compact_cov)
+		n = len(bases)
+		out_slice = np.zeros(n, dtype=compact_dtype)
+		out_slice['base'] = bases
+		out_slice['pos'] = (self._positions(n)+(cur+1))/float(chrom_len)
+		### Methylation
+		context, strand, c, ct = meth
+		not_n1 = np.nonzero(context != -1)[0]
+		if len(not_n1):
+			context_n1 = context[not_n1].astype(np.intp)
+			ct_n1 = ct[not_n1]
+			out_slice['ratio'][not_n1, context_n1] = np.true_divide(c[not_n1], ct_n1)
+			out_slice['cov'][not_n1, context_n1] = np.minimum(ct_n1, max_compact_cov)
+		return out_slice
+	def chrom_track(self, chrom, chunk_size=1000000):
+		'''
+		Returns the contiguous compact input track of a chromosome. The
+		track is memory-mapped from the feature store when it exists and is
+		otherwise encoded into memory chunk by chunk.
+
+		# Parameters
+		chrom (str): Chromosome name
+		chunk_size (int): bases encoded at a time
+
+		# Returns
+		np.ndarray: compact_dtype array of shape (chrom_len,)
+		'''
+		if self.FS and self.FS.has(chrom):
+			return self.FS.track(chrom)
+		chrom_len = self.FA.get_reference_length(chrom)
+		# Stateful slicers leave methylation to the worker pool
+		MC = self.MC if self.MC else methcache(self.meth_file, self.fasta_file)
+		track = np.empty(chrom_len, dtype=compact_dtype)
+		for cur in irange(0, chrom_len, chunk_size):
+			end = min(cur+chunk_size, chrom_len)
+			track[cur:end] = self._compact_region(self.RC.fetch(chrom, cur, end), \
+				MC.fetch(chrom, cur, end), cur, chrom_len)
+		if not self.MC: MC.close()
+		return track
+	def _positions(self, n):
+		'''
+		Returns a view of [0, n) from an arange that is only reallocated
+		when a longer region is requested
+		'''
+		arange = self._arange
+		if len(arange) < n:
+			arange = self._arange = np.arange(n)
+		return arange[:n]
+	def chrom_iter(self, chrom, seq_len=5, offset=1, batch_size=False, hvd_rank=0, hvd_size=1, stranded=False, compact=False):
+		chrom_len = self.FA.get_reference_length(chrom)
+		chrom_quality = self.RC.chrom_qualities[chrom] if self.quality == -1 else self.quality
+		for cur in self.chrom_batch_starts(chrom, seq_len, offset, batch_size, hvd_rank, hvd_size):
+			yield self._make_batch(chrom, cur, chrom_len, chrom_quality, seq_len, batch_size, offset, compact)
+	def chrom_batch_starts(self, chrom, seq_len=5, offset=1, batch_size=1, hvd_rank=0, hvd_size=1):
+		'''
+		Returns the start of every batch chrom_iter yields for a rank. When
+		ranks have different numbers of batches, the first batches are
+		repeated so all ranks stay aligned.
+		'''
+		chrom_len = self.FA.get_reference_length(chrom)
+		full_len = seq_len+(batch_size-1)*offset
+		start_range = offset * batch_size * hvd_rank
+		#stop_range = chrom_len - seq_len + 1
+		stop_range = chrom_len - full_len + 1
+		step_size = offset * batch_size * hvd_size
+		starts = list(irange(start_range, stop_range, step_size))
 		if hvd_size > 1:
 			my_batches = self.chrom_iter_len(chrom, seq_len, offset, batch_size, hvd_rank, hvd_size)
 			n_batches_list = [self.chrom_iter_len(chrom, seq_len, offset, batch_size, i, hvd_size) for i in range(hvd_size)]
 			max_batches = int(max(n_batches_list))
 			if hvd_rank == 0:
 				logger.debug("All work loads %s. Using %i for all ranks"%(str(n_batches_list), max_batches))
+			starts += starts[:max(0, max_batches-my_batches)]
+		return starts
+	def _make_batch(self, chrom, cur, chrom_len, chrom_quality, seq_len, batch_size, offset, compact=False):
+		full_len = seq_len+(batch_size-1)*offset
+		cur_len = min(full_len, chrom_len-cur)
+		if self.gff3_file:
+			c,x,y = self._get_region(chrom, cur, chrom_len, chrom_quality, cur_len, compact=compact)
+			assert(len(y) == full_len)
+			yb = self._list2batch_num(y, seq_len, batch_size, offset)
+		else:
+			c,x = self._get_region(chrom, cur, chrom_len, chrom_quality, cur_len, compact=compact)
+		#print c
+		assert(len(x) == full_len)
+		cb = self._coord2batch(c, seq_len, batch_size, offset)
+		xb = self._list2batch_num(x, seq_len, batch_size, offset)
+		if self.gff3_file:
+			return (cb, xb, yb)
+		return (cb, xb)
+	def chrom_range_iter(self, chrom, first, last, seq_len=5, offset=1, batch_size=1):
+		'''
+		Yields batches [first, last) of a chromosome, numbered as in a
+		single-rank chrom_iter, without any padding batches
+		'''
 		chrom_len = self.FA.get_reference_length(chrom)
 		chrom_quality = self.RC.chrom_qualities[chrom] if self.quality == -1 else self.quality
+		step_size = offset * batch_size
+		for i in irange(first, last):
+			yield self._make_batch(chrom, i*step_size, chrom_len, chrom_quality, seq_len, batch_size, offset)
+	def plan_batches(self, seq_len=5, offset=1, batch_size=1, hvd_size=1, chroms=[]):
+		'''
+		Splits the batches of all chromosomes into hvd_size contiguous shards
+		that differ by at most one batch, instead of splitting and padding
+		every chromosome separately
+
+		# Parameters
+		seq_len (int): Sequence length
+		offset (int): Bases between sequences
+		batch_size (int): Sequences per batch
+		hvd_size (int): Number of ranks
+		chroms (list): Chromosomes to plan [all, sorted]
+
+		# Returns
+		list: [(chrom, first_batch, last_batch), ...] for each rank
+		'''
+		chroms = chroms if chroms else sorted(self.FA.references)
 		full_len = seq_len+(batch_size-1)*offset
-		start_range = offset * batch_size * hvd_rank
-		#stop_range = chrom_len - seq_len + 1
-		stop_range = chrom_len - full_len + 1
-		step_size = offset * batch_size * hvd_size
-		for cur in irange(start_range, stop_range, step_size):
-			cur_len = min(full_len, chrom_len-cur)
-			if self.gff3_file:
-				c,x,y = self._get_region(chrom, cur, chrom_len, chrom_quality, cur_len)
-				assert(len(y) == seq_len+(batch_size-1)*offset)
-				yb = self._list2batch_num(y, seq_len, batch_size, offset)
-			else:
-				c,x = self._get_region(chrom, cur, chrom_len, chrom_quality, cur_len)
-			#print c
-			assert(len(x) == seq_len+(batch_size-1)*offset)
-			cb = self._coord2batch(c, seq_len, batch_size, offset)
-			xb = self._list2batch_num(x, seq_len, batch_size, offset)
-			if self.gff3_file:
-				yield (cb, xb, yb)
-			else:
-				yield (cb, xb)
-		if hvd_size > 1:
-			for i,cur in enumerate(irange(start_range, stop_range, step_size)):
-				if i < max_batches-my_batches:
-					cur_len = min(full_len, chrom_len-cur)
-					if self.gff3_file:
-						c,x,y = self._get_region(chrom, cur, chrom_len, chrom_quality, cur_len)
-						assert(len(y) == seq_len+(batch_size-1)*offset)
-						yb = self._list2batch_num(y, seq_len, batch_size, offset)
-					else:
-						c,x = self._get_region(chrom, cur, chrom_len, chrom_quality, cur_len)
-					#print c
-					assert(len(x) == seq_len+(batch_size-1)*offset)
-					cb = self._coord2batch(c, seq_len, batch_size, offset)
-					xb = self._list2batch_num(x, seq_len, batch_size, offset)
-					if self.gff3_file:
-						yield (cb, xb, yb)
-					else:
-						yield (cb, xb)
-				else:
-					break
+		step_size = offset * batch_size
+		counts = [max(0, (self.FA.get_reference_length(c)-full_len)//step_size+1) for c in chroms]
+		chrom_starts = np.cumsum([0]+counts)
+		total = int(chrom_starts[-1])
+		bounds = [total*r//hvd_size for r in range(hvd_size+1)]
+		plan = []
+		for rank in range(hvd_size):
+			lo, hi = bounds[rank], bounds[rank+1]
+			shard = []
+			for chrom, cs, ce in zip(chroms, chrom_starts[:-1], chrom_starts[1:]):
+				if cs < hi and ce > lo:
+					shard.append((chrom, int(max(lo, cs)-cs), int(min(hi, ce)-cs)))
+			plan.append(shard)
+		logger.debug("Planned %i batches over %i ranks: %s"%(total, hvd_size, \
+			str([bounds[r+1]-bounds[r] for r in range(hvd_size)])))
+		return plan
 	def chrom_iter_len(self, chrom, seq_len=5, offset=1, batch_size=False, hvd_rank=0, hvd_size=1):
 		chrom_len = self.FA.get_reference_length(chrom)
 		full_len = seq_len+(batch_size-1)*offset
@@ -267,12 +896,12 @@ class input_slicer:
 	def _list2batch_num(self, input_list, seq_len, batch_size, offset=1):
 		#print "original"
 		#for i in input_list: print i
-		npa = np.array(input_list)
+		npa = np.asarray(input_list)
 		#print npa.shape, npa.strides
-		s0, s1 = npa.strides
-		n_inputs = npa.shape[1]
-		#print "seq_len = %i   batch_size = %i  strides = %s   inputs = %i"%(seq_len, batch_size, str(npa.strides), n_inputs)
-		ret = np.lib.stride_tricks.as_strided(npa, (batch_size, seq_len, n_inputs), (s0*offset,s0,s1))
+		# Compact records have no feature axis
+		s0 = npa.strides[0]
+		#print "seq_len = %i   batch_size = %i  strides = %s"%(seq_len, batch_size, str(npa.strides))
+		ret = np.lib.stride_tricks.as_strided(npa, (batch_size, seq_len)+npa.shape[1:], (s0*offset,s0)+npa.strides[1:])
 		#for i in range(ret.shape[0]):
 		#	print "Batch",i
 		#	for j in ret[i,:,:]: print j
@@ -285,10 +914,49 @@ class input_slicer:
 		#print "args: %s %i %i"%(str(coord), seq_len, batch_size)
 		#print "original: %s  return: %s"%(str(coord), str(ret))
 		return ret
-	def stateful_chrom_iter(self, chrom, seq_len=5, offset=1, batch_size=5, hvd_rank=0, hvd_size=1, stranded=False):
+	def stateful_chrom_iter(self, chrom, seq_len=5, offset=1, batch_size=5, hvd_rank=0, hvd_size=1, stranded=False, compact=False):
 		#print "seq_len: %i   batch_size: %i   hvd_size: %i   hvd_rank: %i"%(seq_len, batch_size, hvd_size, hvd_rank)
 		chrom_len = self.FA.get_reference_length(chrom)
 		chrom_quality = self.RC.chrom_qualities[chrom] if self.quality == -1 else self.quality
+		batch_starts = self.stateful_batch_starts(chrom, seq_len, batch_size, hvd_rank, hvd_size)
+		n_batches = len(batch_starts)
+		if self.FS and self.FS.has(chrom):
+			# Batches are gathered directly from the feature store without the pool
+			get_batch = partial(self._store_batch, chrom=chrom, chrom_quality=chrom_quality, \
+				seq_len=seq_len, compact=compact)
+		else:
+			get_batch = partial(self._pool_batch, chrom=chrom, chrom_len=chrom_len, \
+				chrom_quality=chrom_quality, seq_len=seq_len, compact=compact)
+		for iB in irange(n_batches):
+			rank_region_starts = batch_starts[iB]
+			if self.gff3_file:
+				c, npx, npy = get_batch(rank_region_starts)
+				#remove all predictions from reverse strand
+				if stranded: mask(npy, '-')
+				yield (c, npx, npy)
+			else:
+				c, npx = get_batch(rank_region_starts)
+				yield (c, npx)
+		if stranded:
+			for iB in irange(n_batches-1,-1,-1):
+				rank_region_starts = batch_starts[iB]
+				if self.gff3_file:
+					c, npx, npy = get_batch(rank_region_starts)
+					npx = rev_comp(npx) # flip and comp x
+					mask(npy, '+') # mask forward prediction
+					rnpy = np.flip(npy, axis=1) # flip y
+					yield (c, npx, rnpy)
+				else:
+					c, npx = get_batch(rank_region_starts)
+					npx = rev_comp(npx) # flip and comp x
+					yield (c, npx)
+	def stateful_batch_starts(self, chrom, seq_len=5, batch_size=5, hvd_rank=0, hvd_size=1):
+		'''
+		Returns the (n_batches x contigs_per_rank) region starts of the forward
+		batches stateful_chrom_iter yields for a rank. Each column walks one
+		contiguous sequence of the chromosome.
+		'''
+		chrom_len = self.FA.get_reference_length(chrom)
 		# Calculate the number of contiguous sequences
 		contigs_per_rank = int(batch_size/hvd_size)
 		if not contigs_per_rank and hvd_size > 1:
@@ -302,47 +970,108 @@ class input_slicer:
 		#print "contigs_per_rank: %i   max_contig_len: %.1f   n_batches: %i"%(contigs_per_rank, max_contig_len, n_batches)
 		# Calculate the start and end values for looping
 		starts = np.arange(batch_size)*(max_contig_len/2)
-		ends = starts+max_contig_len
-		#print "starts: [%s]   ends: [%s]"%(', '.join(map(str, starts)),', '.join(map(str, ends)))
-		partial_wgr = partial(worker_get_region, chrom=chrom, chrom_len=chrom_len, chrom_quality=chrom_quality, seq_len=seq_len)
-		for iB in irange(n_batches):
-			rank_start_inds = range(contigs_per_rank*hvd_rank, contigs_per_rank*(hvd_rank+1))
-			rank_region_starts = starts[rank_start_inds]+iB*seq_len
+		#print "starts: [%s]"%(', '.join(map(str, starts)))
+		rank_starts = starts[contigs_per_rank*hvd_rank:contigs_per_rank*(hvd_rank+1)]
+		return rank_starts[np.newaxis,:]+np.arange(n_batches)[:,np.newaxis]*seq_len
+	def _store_batch(self, region_starts, chrom, chrom_quality, seq_len, compact=False):
+		'''
+		Returns the coordinates, inputs, and labels (when using a gff3) of
+		each region in the same layout as the worker pool
+		'''
+		c = [(chrom, cur, cur+seq_len) for cur in region_starts]
+		x = np.array([self.FS.fetch(chrom, cur, cur+seq_len) for cur in region_starts])
+		if not compact: x = expand_inputs(x, self.ploidy, chrom_quality)
+		if self.gff3_file:
+			y = np.array([self.GI.fetch(chrom, cur, cur+seq_len) for cur in region_starts])
+			return (c, x, y)
+		return (c, x)
+	def _pool_batch(self, region_starts, chrom, chrom_len, chrom_quality, seq_len, compact=False):
+		'''
+		Has the worker pool write the compact records of each region of a
+		batch directly into the shared batch buffer by its index. Only the
+		indices are sent back, and the finished batch is copied out once.
+		'''
+		n = len(region_starts)
+		with self._pool_lock:
+			shape, shared_file, X, Y = self._shared_batch(n, seq_len)
+			fill = partial(worker_fill_region, chrom=chrom, chrom_len=chrom_len, chrom_quality=chrom_quality, \
+				seq_len=seq_len, shared_file=shared_file, shape=shape)
+			chunksize = max(1, n//(4*self.workers))
+			for index in self.pool.imap_unordered(fill, enumerate(region_starts), chunksize=chunksize):
+				pass
+			c = [(chrom, cur, cur+seq_len) for cur in region_starts]
+			x = X[:n].copy() if compact else expand_inputs(X[:n], self.ploidy, chrom_quality)
 			if self.gff3_file:
-				c, x, y = zip(*self.pool.imap(partial_wgr, rank_region_starts, chunksize=25))
-				npy = np.array(y)
-				#remove all predictions from reverse strand
-				if stranded: mask(npy, '-')
-				yield (list(c), np.array(x), npy)
-			else:
-				c, x = zip(*self.pool.imap(partial_wgr, rank_region_starts, chunksize=25))
-				yield (list(c), np.array(x))
-		if stranded:
-			for iB in irange(n_batches-1,-1,-1):
-				rank_start_inds = range(contigs_per_rank*hvd_rank, contigs_per_rank*(hvd_rank+1))
-				rank_region_starts = starts[rank_start_inds]+iB*seq_len
-				if self.gff3_file:
-					c, x, y = zip(*self.pool.imap(partial_wgr, rank_region_starts, chunksize=25))
-					npx, npy = map(np.array, (x,y))
-					npx = rev_comp(npx) # flip and comp x
-					mask(npy, '+') # mask forward prediction
-					rnpy = np.flip(npy, axis=1) # flip y
-					yield (list(c), npx, rnpy)
-				else:
-					c, x = zip(*self.pool.imap(partial_wgr, rank_region_starts, chunksize=25))
-					npx = rev_comp(np.array(x)) # flip and comp x
-					yield (list(c), npx)
-				
+				return (c, x, Y[:n].copy())
+			return (c, x)
+	def _shared_batch(self, n_contigs, seq_len):
+		'''
+		Returns the (shape, file, x, y) batch buffer shared with the worker pool,
+		which is a file in /dev/shm (when available) that every process maps.
+		It is only reallocated when the batch shape changes.
+		'''
+		shape = (n_contigs, seq_len)
+		if self._shared and self._shared[0] == shape:
+			return self._shared
+		self._free_shared()
+		shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+		fd, shared_file = tempfile.mkstemp(prefix='teamRNN_batch_', suffix='.bin', dir=shm_dir)
+		x_bytes, y_bytes = shared_batch_bytes(shape, self.out_dim if self.gff3_file else 0)
+		_shared_files[shared_file] = os.getpid()
+		os.ftruncate(fd, x_bytes+y_bytes)
+		os.close(fd)
+		X, Y = shared_batch_views(shared_file, shape, self.out_dim if self.gff3_file else 0)
+		self._shared = (shape, shared_file, X, Y)
+		logger.debug("Allocated a %i byte shared batch buffer in %s"%(x_bytes+y_bytes, shared_file))
+		return self._shared
+	def _free_shared(self):
+		if self._shared:
+			shared_file = self._shared[1]
+			self._shared = False
+			_shared_files.pop(shared_file, None)
+			if os.path.exists(shared_file): os.remove(shared_file)
 	def _get_region_map(self, cur, chrom, chrom_len, chrom_quality, seq_len):
 		return self._get_region(chrom, cur, chrom_len, chrom_quality, seq_len, print_region=False)
 
+def encode_seq(seq):
+	'''
+	Encodes a sequence into base indices with a single byte-table lookup
+
+	>>> encode_seq('AGTCNa')
+	array([0, 1, 2, 3, 4, 0], dtype=uint8)
+	'''
+	if not isinstance(seq, bytes): seq = seq.encode('ascii')
+	return base_lut[np.frombuffer(seq, dtype=np.uint8)]
+
 def rev_comp(batch):
-	ret = batch.copy()
-	ret = np.flip(ret, axis=1)
-	mask = ret[:,:,0] != 4
-	ret[mask,0] = (ret[mask,0]+2)%4
+	ret = np.flip(batch, axis=1).copy()
+	# Works on both compact records and expanded inputs
+	bases = ret['base'] if ret.dtype == compact_dtype else ret[:,:,0]
+	mask = bases != 4
+	bases[mask] = (bases[mask]+2)%4
 	return ret
 
+def expand_inputs(compact, ploidy, quality):
+	'''
+	Expands compact input records into the float32 model input
+
+	# Parameters
+	compact (np.ndarray): compact_dtype records of any shape
+	ploidy (int): Ploidy of the genome
+	quality (int): Assembly quality of the chromosome
+
+	# Returns
+	np.ndarray: float32 array of shape compact.shape+(10,)
+	'''
+	out = np.empty(compact.shape+(10,), dtype=np.float32)
+	out[...,0] = compact['base']
+	out[...,1] = compact['pos']
+	out[...,2:8:2] = compact['ratio']
+	out[...,3:8:2] = compact['cov']
+	out[...,8] = ploidy
+	out[...,9] = quality
+	return out
+
 def mask(batch, mask_strand='-'):
 	n_feat = len(gff3_f2i)
 	half_feat = n_feat/2
@@ -368,11 +1097,81 @@ def mask(batch, mask_strand='-'):
 	else:
 		raise ValueError
 
-def slicer_init(fasta_file, meth_file, gff3_file, quality, ploidy, out_dim):
+def convert_methratio_range(byte_range, meth_file, store):
+	'''
+	Parses the methratio lines in a line-aligned byte range and writes them
+	into the memory-mapped columns of a meth_store. Records on chromosomes
+	missing from the reference or past the end of their chromosome are skipped.
+
+	# Returns
+	tuple: Number of records (written, skipped)
+	'''
+	start, end = byte_range
+	with open(meth_file, 'rb') as MF:
+		MF.seek(start)
+		rows = [line.split(b'\t') for line in MF.read(end-start).splitlines() if line and line[:1] != b'#']
+	if not rows: return (0, 0)
+	#chr pos strand context ratio eff_CT_count C_count CT_count rev_G_count rev_GA_count CI_lower CI_upper
+	chrom_col, pos_col, strand_col, context_col, ratio_col, eff_col, c_col, ct_col = np.array([row[:8] for row in rows]).T
+	pos = pos_col.astype(np.int64)-1
+	values = [np.full(len(rows), -1, dtype=np.int8), np.full(len(rows), -1, dtype=np.int8), \
+		c_col.astype(np.int32), ct_col.astype(np.int32)]
+	for index, context in enumerate(contexts):
+		values[0][context_col == context.encode('ascii')] = index
+	for index, strand in enumerate(strands):
+		values[1][strand_col == strand.encode('ascii')] = index
+	n_written = 0
+	for chrom in np.unique(chrom_col):
+		chrom_len = store.chrom_lens.get(chrom.decode('ascii'), 0)
+		if not chrom_len: continue
+		selected = (chrom_col == chrom) & (pos >= 0) & (pos < chrom_len)
+		n_written += np.count_nonzero(selected)
+		for column_file, value in zip(store._column_files(chrom.decode('ascii')), values):
+			column = np.load(column_file, mmap_mode='r+')
+			column[pos[selected]] = value[selected]
+			column.flush()
+			del column
+	return (n_written, len(rows)-n_written)
+
+def slicer_init(fasta_file, meth_file, gff3_file, quality, ploidy, out_dim, features=''):
 	import os
-	global wIS
-	wIS = input_slicer(fasta_file, meth_file, gff3_file, quality, ploidy, out_dim)
+	global wIS, wShared
+	wIS = input_slicer(fasta_file, meth_file, gff3_file, quality, ploidy, out_dim, features=features)
+	# (file, (x, y)) of the mapped shared batch buffer
+	wShared = (False, False)
 	logger.debug("%i Finished initializing worker input slicer"%(os.getpid()))
+def shared_batch_bytes(shape, out_dim):
+	'''
+	Bytes used by the compact inputs and uint8 labels of a shared batch buffer
+	'''
+	n_contigs, seq_len = shape
+	return (n_contigs*seq_len*compact_dtype.itemsize, n_contigs*seq_len*out_dim)
+def shared_batch_views(shared_file, shape, out_dim):
+	'''
+	Maps the compact inputs (n_contigs x seq_len) and labels (n_contigs x seq_len x out_dim)
+	of a shared batch buffer. Labels are False without an out_dim.
+	'''
+	x_bytes, y_bytes = shared_batch_bytes(shape, out_dim)
+	X = np.memmap(shared_file, dtype=compact_dtype, mode='r+', shape=shape)
+	Y = np.memmap(shared_file, dtype=np.uint8, mode='r+', offset=x_bytes, shape=shape+(out_dim,)) if out_dim else False
+	return (X, Y)
+def worker_fill_region(task, chrom, chrom_len, chrom_quality, seq_len, shared_file, shape):
+	'''
+	Writes a region into its slot of the shared batch buffer and returns the slot index
+	'''
+	global wIS, wShared
+	index, region_start = task
+	if wShared[0] != shared_file:
+		wShared = (shared_file, shared_batch_views(shared_file, shape, wIS.out_dim if wIS.gff3_file else 0))
+	X, Y = wShared[1]
+	region = wIS._get_region(chrom, region_start, chrom_len, chrom_quality, seq_len, compact=True)
+	n = len(region[1])
+	X[index,:n] = region[1]
+	X[index,n:] = 0
+	if wIS.gff3_file:
+		Y[index,:n] = region[2]
+		Y[index,n:] = 0
+	return index
 def worker_get_region(region_start, chrom, chrom_len, chrom_quality, seq_len):
 	#global wIS
 	global wIS
@@ -36,6 +36,17 @@
 ###############################################################################
 
 import numpy as np
+import os, hashlib, threading
+from contextlib import contextmanager
+from time import time
+try:
+	from Queue import Queue, Empty, Full
+except ImportError:
+	from queue import Queue, Empty, Full
+try:
+	import fcntl
+except ImportError:
+	fcntl = False
 
 try:
 	from itertools import izip
@@ -123,3 +134,128 @@ def bridge_array(bool_array, min_size=1, max_gap_size=1):
 			removed_region_count += 1
 			assert(bool_array[s:e].sum() == interval_size)
 			bool_array[s:e] = 0
+
+def file_signature(file_name):
+	'''
+	Cheap signature of a large input file used for cache keys
+
+	# Returns
+	tuple: (absolute path, size, integer mtime)
+	'''
+	st = os.stat(file_name)
+	return (os.path.abspath(file_name), st.st_size, int(st.st_mtime))
+
+def cache_key(*parts):
+	'''
+	Hashes the string representation of all parts into a short hex key
+
+	>>> len(cache_key('a', 1, (2,3)))
+	16
+	'''
+	return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+def file_digest(file_name, block_size=2**20):
+	'''
+	SHA1 of a file's contents. The digest is remembered in a "<file>.sha1"
+	sidecar keyed by the file signature so warm starts skip re-reading it.
+
+	# Parameters
+	file_name (str): Input file
+	block_size (int): Bytes read at a time
+
+	# Returns
+	str: hex digest
+	'''
+	sig_file = '%s.sha1'%(file_name)
+	sig = '%i %i'%file_signature(file_name)[1:]
+	if os.path.exists(sig_file):
+		with open(sig_file, 'r') as SF:
+			cached = SF.read().split('\t')
+		if len(cached) == 2 and cached[0] == sig:
+			return cached[1].strip()
+	H = hashlib.sha1()
+	with open(file_name, 'rb') as IF:
+		for block in iter(lambda: IF.read(block_size), b''):
+			H.update(block)
+	digest = H.hexdigest()
+	try:
+		tmp_file = '%s.%i.tmp'%(sig_file, os.getpid())
+		with open(tmp_file, 'w') as SF:
+			SF.write('%s\t%s\n'%(sig, digest))
+		os.rename(tmp_file, sig_file)
+	except (IOError, OSError):
+		pass
+	return digest
+
+@contextmanager
+def file_lock(lock_file):
+	'''
+	Exclusive advisory lock so only one process (or Horovod rank)
+	writes a shared cache file at a time
+	'''
+	with open(lock_file, 'a') as LF:
+		if fcntl: fcntl.flock(LF, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			if fcntl: fcntl.flock(LF, fcntl.LOCK_UN)
+
+def background_iter(iterable, depth=2, stats=None):
+	'''
+	Yields the items of an iterable that is consumed ahead of time by a
+	background thread into a queue of at most `depth` items, so producing
+	the next item overlaps whatever the caller does with the current one.
+	Exceptions raised by the iterable are re-raised in the caller.
+
+	# Parameters
+	iterable (iterable): Item producer
+	depth (int): Maximum number of items produced ahead
+	stats (dict): If given, stats['produce'] accumulates the seconds spent producing items
+
+	>>> list(background_iter(range(3)))
+	[0, 1, 2]
+	'''
+	Q = Queue(maxsize=max(1, depth))
+	stop = threading.Event()
+	done = object()
+	def put(item):
+		while not stop.is_set():
+			try:
+				Q.put(item, timeout=0.1)
+				return True
+			except Full:
+				pass
+		return False
+	def produce():
+		try:
+			it = iter(iterable)
+			while True:
+				s_time = time()
+				try:
+					item = next(it)
+				except StopIteration:
+					break
+				if stats is not None: stats['produce'] = stats.get('produce', 0)+time()-s_time
+				if not put((False, item)): return
+		except Exception as e:
+			put((True, e))
+			return
+		put((False, done))
+	thread = threading.Thread(target=produce)
+	thread.daemon = True
+	thread.start()
+	try:
+		while True:
+			raised, item = Q.get()
+			if raised: raise item
+			if item is done: break
+			yield item
+	finally:
+		# Unblocks the producer if the caller stopped early
+		stop.set()
+		while True:
+			try:
+				Q.get_nowait()
+			except Empty:
+				break
+		thread.join()
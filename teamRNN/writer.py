@@ -38,6 +38,7 @@
 from operator import itemgetter
 from pysam import FastaFile
 import h5py, os, sys, logging
+import multiprocessing as mp
 from time import time
 logger = logging.getLogger(__name__)
 import numpy as np
@@ -48,76 +49,389 @@ from itertools import chain
 import re
 from quicksect import IntervalTree
 from glob import glob
-from collections import defaultdict as dd
-from itertools import izip
+from collections import defaultdict as dd, OrderedDict
+from itertools import izip, islice
+
+def vote_dtype(max_votes=0):
+	'''
+	Returns the smallest unsigned integer type that can count max_votes
+	(uint32 when the bound is unknown)
+	'''
+	if max_votes:
+		for dtype in (np.uint8, np.uint16, np.uint32):
+			if max_votes <= np.iinfo(dtype).max: return dtype
+	return np.uint32
+
+class block_cache:
+	'''
+	LRU cache of vote blocks shared by every vote_store of an aggregator
+
+	Blocks are marked dirty when they are fetched for writing. Once the
+	cached blocks exceed the memory budget, the least recently used ones
+	are evicted and only dirty blocks are written back to their store.
+
+	# Parameters
+	budget (int): Maximum bytes of cached blocks (0 is unlimited)
+	'''
+	def __init__(self, budget=0):
+		self.budget = budget
+		self.blocks = OrderedDict()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.writes = 0
+		self.evictions = 0
+	def get(self, key, write=False):
+		entry = self.blocks.pop(key, None)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		if write: entry[2] = True
+		# Reinserting marks the block as most recently used
+		self.blocks[key] = entry
+		return entry[0]
+	def put(self, key, block, owner, dirty=False):
+		self.blocks[key] = [block, owner, dirty]
+		self.nbytes += block.nbytes
+		while self.budget and self.nbytes > self.budget and len(self.blocks) > 1:
+			(name, col, b), (old_block, old_owner, old_dirty) = self.blocks.popitem(last=False)
+			if old_dirty:
+				old_owner._write_block(col, b, old_block)
+				self.writes += 1
+			self.nbytes -= old_block.nbytes
+			self.evictions += 1
+	def flush(self):
+		'''
+		Writes every dirty block back to its store
+		'''
+		for (name, col, b), entry in iterdict(self.blocks):
+			if entry[2]:
+				entry[1]._write_block(col, b, entry[0])
+				entry[2] = False
+				self.writes += 1
+	def stats(self):
+		return "%i blocks (%.1f MB) cached - %i hits, %i misses, %i evictions, %i blocks written"%(len(self.blocks), \
+			self.nbytes/2.0**20, self.hits, self.misses, self.evictions, self.writes)
+
+class vote_store:
+	'''
+	Block-sparse vote counts of one chromosome
+
+	Counts are kept in fixed-size blocks of a single column, which are only
+	allocated once the column receives a vote in that block. Columns and
+	regions that are never voted on take no memory. Blocks live in a
+	block_cache and are written to chunked HDF5 datasets (one per voted
+	column) whose chunks line up with the blocks when they are evicted, so
+	unvoted chunks are never stored on disk either. Evicted blocks are read
+	back lazily the next time they are touched.
+
+	# Parameters
+	H5 (h5py.File): Backing file
+	name (str): Group of the table in the backing file
+	chrom_len (int): Length of the chromosome
+	n_cols (int): Number of columns in the table
+	dtype (type): Count type (see vote_dtype)
+	block_size (int): Bases per block
+	cache (block_cache): Cache shared with other stores [unlimited]
+	'''
+	def __init__(self, H5, name, chrom_len, n_cols, dtype=np.uint32, block_size=2**16, cache=None):
+		self.H5 = H5
+		self.name = name
+		self.chrom_len = chrom_len
+		self.n_cols = n_cols
+		self.dtype = dtype
+		self.block_size = block_size
+		self.cache = cache if cache is not None else block_cache()
+		# Dataset handles (or None) of each column and blocks known to be empty
+		self.dsets = {}
+		self.empty = set()
+		# Per-block vote totals of each column, dropped when it is written
+		self.totals = {}
+		self.cols = set(map(int, H5[name].keys())) if name in H5 else set()
+	def _dset_name(self, col):
+		return '%s/%i'%(self.name, col)
+	def _dset(self, col):
+		if col not in self.dsets:
+			dset_name = self._dset_name(col)
+			self.dsets[col] = self.H5[dset_name] if dset_name in self.H5 else None
+		return self.dsets[col]
+	def _block(self, col, b, write=False):
+		'''
+		Returns block b of column col, reading it from the backing file
+		if it was evicted. Returns None for blocks without votes unless the
+		block is fetched for writing, which also marks it dirty.
+		'''
+		key = (self.name, col, b)
+		if write: self.totals.pop(col, None)
+		block = self.cache.get(key, write)
+		if block is not None: return block
+		if key in self.empty and not write: return None
+		lo, hi = self._bounds(b)
+		# The last block only covers the end of the chromosome
+		block = np.zeros(hi-lo, dtype=self.dtype)
+		dset = self._dset(col)
+		if dset is not None and key not in self.empty:
+			dset.read_direct(block, np.s_[lo:hi])
+		elif not write:
+			self.empty.add(key)
+			return None
+		if not (write or block.any()):
+			self.empty.add(key)
+			return None
+		self.empty.discard(key)
+		if write: self.cols.add(col)
+		self.cache.put(key, block, self, dirty=write)
+		return block
+	def _write_block(self, col, b, block):
+		if self._dset(col) is None:
+			self.dsets[col] = self.H5.create_dataset(self._dset_name(col), (self.chrom_len,), \
+				compression='gzip', compression_opts=6, chunks=(min(self.block_size, self.chrom_len),), \
+				fillvalue=0, dtype=self.dtype)
+		lo, hi = self._bounds(b)
+		self.dsets[col].write_direct(block, dest_sel=np.s_[lo:hi])
+	def _bounds(self, b):
+		return b*self.block_size, min((b+1)*self.block_size, self.chrom_len)
+	def _spans(self, start, end):
+		'''
+		Yields (block, block_start, block_end, offset) for every block
+		overlapping [start, end), where offset is relative to start
+		'''
+		B = self.block_size
+		for b in irange(start//B, (end-1)//B+1):
+			lo, hi = max(start, b*B), min(end, (b+1)*B)
+			yield b, lo-b*B, hi-b*B, lo-start
+	def voted_columns(self):
+		return sorted(self.cols)
+	def add(self, start, end, array, col_offset=0, overwrite=False):
+		'''
+		Adds (or writes) an (end-start, k) array of votes to [start, end) of
+		columns [col_offset, col_offset+k)
+		'''
+		assert(array.shape[0] == end-start and col_offset+array.shape[1] <= self.n_cols)
+		for i in np.flatnonzero(array.any(axis=0)):
+			for b, lo, hi, o in self._spans(start, end):
+				block = self._block(col_offset+i, b, write=True)
+				if overwrite:
+					block[lo:hi] = array[o:o+hi-lo, i]
+				else:
+					block[lo:hi] += array[o:o+hi-lo, i]
+		if overwrite:
+			# Zeros only need to be written over existing votes
+			for col in self.voted_columns():
+				i = col-col_offset
+				if 0 <= i < array.shape[1] and not array[:,i].any():
+					for b, lo, hi, o in self._spans(start, end):
+						if self._block(col, b) is not None:
+							self._block(col, b, write=True)[lo:hi] = 0
+	def fill(self, start, end, value=1, col=0, overwrite=False):
+		'''
+		Adds (or writes) a constant vote to column col over [start, end)
+		'''
+		for b, lo, hi, o in self._spans(start, end):
+			block = self._block(col, b, write=True)
+			if overwrite:
+				block[lo:hi] = value
+			else:
+				block[lo:hi] += value
+	def add_at(self, positions, cols, overwrite=False):
+		'''
+		Adds (or writes) a single vote to column cols[i] at positions[i].
+		Positions may repeat, in which case their votes are summed.
+		'''
+		B = self.block_size
+		positions = np.asarray(positions, dtype=np.int64)
+		cols = np.asarray(cols, dtype=np.int64)
+		assert(positions.shape == cols.shape)
+		if not len(positions): return
+		assert(0 <= positions.min() and positions.max() < self.chrom_len)
+		assert(0 <= cols.min() and cols.max() < self.n_cols)
+		# One sort groups the votes by (column, block) and counts repeated positions
+		n_blocks = (self.chrom_len-1)//B+1
+		keys, counts = np.unique((cols*n_blocks+positions//B)*B+positions%B, return_counts=True)
+		groups = keys//B
+		bounds = np.append(np.flatnonzero(np.diff(groups))+1, len(keys))
+		first = 0
+		for last in bounds:
+			col, b = divmod(int(groups[first]), n_blocks)
+			block = self._block(col, b, write=True)
+			local = keys[first:last]%B
+			if overwrite:
+				block[local] = 1
+			else:
+				block[local] += counts[first:last].astype(self.dtype)
+			first = last
+	def column(self, col):
+		'''
+		Returns the dense votes of a column across the chromosome
+		'''
+		out = np.zeros(self.chrom_len, dtype=self.dtype)
+		for b, lo, hi, o in self._spans(0, self.chrom_len):
+			block = self._block(col, b)
+			if block is not None: out[o:o+hi-lo] = block[lo:hi]
+		return out
+	def region(self, start, end):
+		'''
+		Returns the dense (end-start, n_cols) votes of [start, end)
+		'''
+		out = np.zeros((end-start, self.n_cols), dtype=self.dtype)
+		for col in self.voted_columns():
+			for b, lo, hi, o in self._spans(start, end):
+				block = self._block(col, b)
+				if block is not None: out[o:o+hi-lo, col] = block[lo:hi]
+		return out
+	def block_totals(self, col):
+		'''
+		Returns the uint64 vote totals of every block of a column
+		'''
+		if col not in self.totals:
+			totals = np.zeros((self.chrom_len-1)//self.block_size+1, dtype=np.uint64)
+			for b in irange(len(totals)):
+				block = self._block(col, b)
+				if block is not None: totals[b] = block.sum(dtype=np.uint64)
+			self.totals[col] = totals
+		return self.totals[col]
+	def column_sums(self):
+		sums = np.zeros(self.n_cols, dtype=np.uint64)
+		for col in self.voted_columns():
+			sums[col] = self.block_totals(col).sum(dtype=np.uint64)
+		return sums
+	def prefix_sums(self, positions):
+		'''
+		Returns the (len(positions), n_cols) votes of [0, position) for every
+		position. The cumulative sums are built from the cached block totals
+		and only the blocks containing a position are scanned, so the table is
+		never materialized for the whole chromosome.
+		'''
+		B = self.block_size
+		positions = np.asarray(positions, dtype=np.int64)
+		out = np.zeros((len(positions), self.n_cols), dtype=np.uint64)
+		if not len(positions): return out
+		# Sorting once makes the positions of each block a contiguous slice
+		order = np.argsort(positions, kind='mergesort')
+		sorted_pos = positions[order]
+		pos_blocks = sorted_pos//B
+		bounds = np.append(np.flatnonzero(np.diff(pos_blocks))+1, len(positions))
+		for col in self.voted_columns():
+			totals = self.block_totals(col)
+			before = np.concatenate((np.zeros(1, dtype=np.uint64), np.cumsum(totals, dtype=np.uint64)))
+			col_out = before[pos_blocks]
+			first = 0
+			for last in bounds:
+				b = int(pos_blocks[first])
+				block = self._block(col, b) if b < len(totals) and totals[b] else None
+				if block is not None:
+					cs = np.concatenate((np.zeros(1, dtype=np.uint64), np.cumsum(block, dtype=np.uint64)))
+					col_out[first:last] += cs[sorted_pos[first:last]-b*B]
+				first = last
+			out[order, col] = col_out
+		return out
+	def range_sums(self, starts, ends):
+		'''
+		Returns the (len(starts), n_cols) votes of every [start, end)
+		'''
+		n = len(starts)
+		prefix = self.prefix_sums(np.concatenate((starts, ends)))
+		return prefix[n:]-prefix[:n]
 
 class output_aggregator:
 	'''
 	>>> OA = output_aggregator(chrom_dict)
 	>>> OA.vote(chrom, s, e, out_array)
 	>>> OA.write_gff3()
+
+	Votes are counted in block-sparse vote_stores. Passing the maximum
+	number of windows that can overlap a base (seq_len/offset, or 1 when
+	votes overwrite) as max_votes lets the counts use the smallest dtype.
+	Chromosomes are split into blocks of block_size bases, which share an
+	LRU cache of mem_budget bytes (0 is unlimited), so switching between
+	chromosomes only writes back the modified blocks that get evicted.
+
+	The vote file is removed when closed unless keep is set, in which case
+	every cached block is written and the file is marked complete. An
+	existing vote file can be opened with read_only, which takes the vote
+	settings from the file and leaves it in place when closed.
 	'''
-	def __init__(self, fasta_file, noTEMD=False, h5_file='tmp_vote.h5', stranded=False):
+	def __init__(self, fasta_file, noTEMD=False, h5_file='tmp_vote.h5', stranded=False, max_votes=0, block_size=2**16, mem_budget=0, read_only=False, keep=False):
 		self.fasta_file = fasta_file
-		self.noTEMD = noTEMD
-		self.stranded = stranded
 		with FastaFile(fasta_file) as FA:
 			self.chrom_dict = {c:FA.get_reference_length(c) for c in FA.references}
 		self.cur_chrom = ''
 		self.h5_file = h5_file
-		self.H5 = h5py.File(h5_file, 'a')
+		self.read_only = read_only
+		self.keep = keep or read_only
+		self.mem_budget = mem_budget
+		if read_only:
+			self.H5 = h5py.File(h5_file, 'r')
+			noTEMD, stranded = bool(self.H5.attrs['noTEMD']), bool(self.H5.attrs['stranded'])
+			self.dtype = np.dtype(self.H5.attrs['dtype']).type
+			self.block_size = int(self.H5.attrs['block_size'])
+		else:
+			self.H5 = h5py.File(h5_file, 'w')
+			self.dtype = vote_dtype(max_votes)
+			self.block_size = block_size
+			# The settings are kept with the votes so the file can be read on its own
+			self.H5.attrs['noTEMD'], self.H5.attrs['stranded'] = noTEMD, stranded
+			self.H5.attrs['dtype'], self.H5.attrs['block_size'] = np.dtype(self.dtype).name, block_size
+			self.H5.attrs['complete'] = False
+		self.noTEMD = noTEMD
+		self.stranded = stranded
+		self.cache = block_cache(mem_budget)
+		self.chrom_stores = {}
+		logger.debug("Counting votes as %s"%(np.dtype(self.dtype).name))
 		self._genome_init()
 	def __del__(self):
 		if self.H5:
+			logger.debug("Vote cache: %s"%(self.cache.stats()))
+			if self.keep and not self.read_only:
+				self.cache.flush()
+				self.H5.attrs['complete'] = True
+				logger.info("Kept votes in %s"%(self.h5_file))
 			self.H5.close()
-			os.remove(self.h5_file)
+			if not self.keep: os.remove(self.h5_file)
+			self.H5 = False
 	def close(self):
 		self.__del__()
+	def complete(self):
+		'''
+		Whether every vote was written to the file before it was closed
+		'''
+		return bool(self.H5.attrs.get('complete', False))
+	def _release(self):
+		'''
+		Writes every modified block and closes the vote file so other
+		processes can read it
+		'''
+		self.cache.flush()
+		self.cache = block_cache(self.mem_budget)
+		self.chrom_stores, self.stores, self.cur_chrom = {}, [], ''
+		self.H5.close()
+	def _reopen(self):
+		self.H5 = h5py.File(self.h5_file, 'r' if self.read_only else 'a')
 	def _load_arrays(self, chrom):
-		s_time = time()
 		if chrom == self.cur_chrom:
 			return
-		self.feature_vote_array = self._swap_dset(self.cur_chrom, chrom, \
-			'/votes/features', self.feature_vote_array)
-		self.feature_total_array = self._swap_dset(self.cur_chrom, chrom, \
-			'/totals/features', self.feature_total_array)
+		# Blocks stay in the shared cache, so nothing is written when switching
+		if chrom not in self.chrom_stores:
+			self.chrom_stores[chrom] = self._chrom_stores(chrom)
+		self.stores = self.chrom_stores[chrom]
+		self.feature_votes, self.feature_totals = self.stores[:2]
 		if not self.noTEMD:
-			self.te_order_array = self._swap_dset(self.cur_chrom, chrom, \
-				'/votes/tes/order', self.te_order_array)
-			self.te_sufam_array = self._swap_dset(self.cur_chrom, chrom, \
-				'/votes/tes/sufam', self.te_sufam_array)
-		#self.te_total_array = self.H5[chrom+'/totals/tes']
-		logger.debug("Took %i seconds to swap from %s to %s"%(int(time()-s_time), self.cur_chrom, chrom))
+			self.te_order_votes, self.te_sufam_votes = self.stores[2:]
 		self.cur_chrom = chrom
-	def _swap_dset(self, old_c, new_c, suffix, old_a):
-		old_name = old_c+suffix
-		new_name = new_c+suffix
-		assert(old_a.shape == self.H5[old_name].shape)
-		self.H5[old_name].write_direct(old_a)
-		new_a = np.zeros(self.H5[new_name].shape, dtype=self.H5[new_name].dtype)
-		self.H5[new_name].read_direct(new_a)
-		return new_a
-	def _create_dset(self, size_tuple, name, dtype=np.uint32):
-		self.H5.create_dataset(name, size_tuple, compression='gzip', compression_opts=6, \
-			chunks=True, fillvalue=0, dtype=dtype)
-		return np.zeros(size_tuple, dtype=dtype)
+	def _chrom_stores(self, chrom):
+		chrom_len = self.chrom_dict[chrom]
+		tables = [('/votes/features', len(gff3_i2f)), ('/totals/features', 1)]
+		if not self.noTEMD:
+			# These do not need a total array since there is only a single value per location
+			tables += [('/votes/tes/order', len(te_order_i2f)), ('/votes/tes/sufam', len(te_sufam_i2f))]
+		return [vote_store(self.H5, chrom+suffix, chrom_len, n_cols, self.dtype, self.block_size, self.cache) for suffix, n_cols in tables]
 	def _genome_init(self):
 		n_features = len(gff3_i2f)
 		n_order_ids = len(te_order_i2f)
 		n_sufam_ids = len(te_sufam_i2f)
-		for chrom, chrom_len in iterdict(self.chrom_dict):
-			# total != sum
-			self.feature_vote_array = self._create_dset((chrom_len, n_features), \
-				chrom+'/votes/features')
-			self.feature_total_array = self._create_dset((chrom_len, 1), \
-				chrom+'/totals/features')
-			if not self.noTEMD:
-				# These do not need a total array since there is only a single value per location
-				self.te_order_array = self._create_dset((chrom_len, n_order_ids), \
-					chrom+'/votes/tes/order')
-				self.te_sufam_array = self._create_dset((chrom_len, n_sufam_ids), \
-					chrom+'/votes/tes/sufam')
-		self.cur_chrom = chrom
+		# Nothing is allocated until a chromosome receives votes
+		self.stores = []
 		# Init this
 		self.te_feature_ids = set([gff3_f2i[s+f] for f in te_feature_names for s in '+-'])
 		# Create counters
@@ -145,51 +459,95 @@ class output_aggregator:
 		assert(2*half_feat == n_feat)
 		if self.stranded:
 			if not reverse:
-				feature_array = array[:,:half_feat]
+				feature_array, col_offset = array[:,:half_feat], 0
 			else:
-				feature_array = array[::-1,half_feat:n_feat]
+				feature_array, col_offset = array[::-1,half_feat:n_feat], half_feat
 		else:
-			feature_array = array[:,:len(gff3_i2f)]
+			feature_array, col_offset = array[:,:n_feat], 0
+		# Each window casts at most one vote per feature and base
+		feature_array = np.minimum(feature_array, 1)
 		# Load the current chromosome arrays
 		if self.cur_chrom != chrom: self._load_arrays(chrom)
 		# Track features
-		#print "BEFORE", self.feature_total_array[start:end].flatten()
-		if overwrite:
-			self.feature_total_array[start:end] = 1
-		else:
-			self.feature_total_array[start:end] += 1
-		#print "AFTER", self.feature_total_array[start:end].flatten()
+		self.feature_totals.fill(start, end, 1, overwrite=overwrite)
 		if np.sum(feature_array):
-			if overwrite:
-				if self.stranded:
-					if not reverse:
-						self.feature_vote_array[start:end,:half_feat] = feature_array
-					else:
-						self.feature_vote_array[start:end,half_feat:n_feat] = feature_array
-				else:
-					self.feature_vote_array[start:end] = feature_array
-			else:
-				if self.stranded:
-					if not reverse:
-						self.feature_vote_array[start:end,:half_feat] += feature_array
-					else:
-						self.feature_vote_array[start:end,half_feat:n_feat] += feature_array
-				else:
-					self.feature_vote_array[start:end] += feature_array
+			self.feature_votes.add(start, end, feature_array, col_offset, overwrite)
 		if not self.noTEMD:
 			# Track te class/family
-			if sum(te_order_array):
-				for i,v in enumerate(te_order_array):
-					if overwrite:
-						self.te_order_array[start+i,v] = 1
-					else:
-						self.te_order_array[start+i,v] += 1
-			if sum(te_sufam_array):
-				for i,v in enumerate(te_sufam_array):
-					if overwrite:
-						self.te_sufam_array[start+i,v] = 1
-					else:
-						self.te_sufam_array[start+i,v] += 1
+			positions = np.arange(start, end)
+			if te_order_array.any():
+				self.te_order_votes.add_at(positions, te_order_array, overwrite)
+			if te_sufam_array.any():
+				self.te_sufam_votes.add_at(positions, te_sufam_array, overwrite)
+	def vote_batch(self, coords, batch_array, overwrite=False, reverse=False):
+		'''
+		Votes a batch of windows at once, which is equivalent to calling
+		vote() on every (coord, array) pair.
+
+		Windows that overlap at an even spacing, like those of a chrom_iter
+		batch, are summed into a single span with a strided add before the
+		stores are updated once. Other batches (like the disjoint regions of
+		a stateful batch) update the stores window by window.
+
+		# Parameters
+		coords (list): (chrom, start, end) of every window
+		batch_array (np.ndarray): (batch, seq_len, outputs) predictions
+		overwrite (bool): Overwrite instead of adding votes
+		reverse (bool): The batch is reverse complemented
+		'''
+		chrom = coords[0][0]
+		starts = np.array([c[1] for c in coords])
+		seq_len = batch_array.shape[1]
+		if any([c[0] != chrom or c[2]-c[1] != seq_len for c in coords]):
+			for c, array in zip(coords, batch_array):
+				self.vote(*c, array=array, overwrite=overwrite, reverse=reverse)
+			return
+		n_feat = len(gff3_i2f)
+		half_feat = n_feat/2
+		assert(batch_array.shape[2] == n_feat+(0 if self.noTEMD else 2))
+		if self.stranded:
+			if not reverse:
+				feature_batch, col_offset = batch_array[:,:,:half_feat], 0
+			else:
+				feature_batch, col_offset = batch_array[:,::-1,half_feat:n_feat], half_feat
+		else:
+			feature_batch, col_offset = batch_array[:,:,:n_feat], 0
+		# Each window casts at most one vote per feature and base
+		feature_batch = np.minimum(feature_batch, 1)
+		if self.cur_chrom != chrom: self._load_arrays(chrom)
+		offsets = np.diff(starts)
+		n, step = len(starts), offsets[0] if len(offsets) else seq_len
+		if overwrite or n == 1 or not (0 < step < seq_len and (offsets == step).all()):
+			for s, features in zip(starts, feature_batch):
+				self.feature_totals.fill(s, s+seq_len, 1, overwrite=overwrite)
+				if features.any():
+					self.feature_votes.add(s, s+seq_len, features, col_offset, overwrite)
+		else:
+			span = (n-1)*step+seq_len
+			votes = np.zeros((span, feature_batch.shape[2]), dtype=self.dtype)
+			totals = np.zeros((span, 1), dtype=self.dtype)
+			if seq_len%step == 0:
+				# Window i covers steps [i, i+m), so the batch is added as m strided slabs
+				m = seq_len//step
+				step_votes = votes.reshape(n+m-1, step, -1)
+				step_features = feature_batch.reshape(n, m, step, -1)
+				for j in irange(m):
+					step_votes[j:j+n] += step_features[:,j]
+					totals.reshape(n+m-1, step)[j:j+n] += 1
+			else:
+				for o, features in zip(starts-starts[0], feature_batch):
+					votes[o:o+seq_len] += features
+					totals[o:o+seq_len] += 1
+			self.feature_totals.add(starts[0], starts[0]+span, totals)
+			if votes.any():
+				self.feature_votes.add(starts[0], starts[0]+span, votes, col_offset)
+		if not self.noTEMD:
+			positions = starts[:,None]+np.arange(seq_len)
+			for te_batch, store in ((batch_array[:,:,-2], self.te_order_votes), (batch_array[:,:,-1], self.te_sufam_votes)):
+				# Only windows with TE classes vote
+				voted = te_batch.any(axis=1)
+				if voted.any():
+					store.add_at(positions[voted].ravel(), te_batch[voted].ravel(), overwrite)
 	def compare(self, chrom, start, end, pred_array, true_array):
 		if not self.noTEMD:
 			assert(array.shape[1] == len(gff3_i2f)+2)
@@ -247,54 +605,183 @@ class output_aggregator:
 				prec = str(tp/float(tp+fp))
 				oStr.append('%s, %i, %i, %i, %s, %s'%(name, tp, fp, fn, sen, prec))
 		return oStr
-	def write_gff3(self, out_file='', threshold=0.5, min_size=0, max_fill_size=0):
-		total_feature_count = 0
-		out_gff3 = ['##gff-version   3']
-		if os.path.exists(out_file):
-			logger.info("Overwriting old %s"%(out_file))
-			os.remove(out_file)
-		if min_size or max_fill_size:
-			logger.info("Filling gaps <= %i and Removing |features| < %i"%(max_fill_size, min_size))
-		for chrom in sorted(self.chrom_dict.keys()):
-			chrom_len = self.chrom_dict[chrom]
-			features = []
-			se_array = [[0,0] for i in irange(len(gff3_i2f))]
-			self._load_arrays(chrom)
-			logger.debug("Feature vote row sums: %s"%(str(list(self.feature_vote_array.sum(axis=0)))))
-			logger.debug("Feature total row sums: %s"%(str(list(self.feature_total_array.sum(axis=0)))))
-			for feat_index in gff3_i2f.keys():
-				vote_array = self.feature_vote_array[:,feat_index]
-				if self.stranded:
-					gtT_mask = vote_array >= threshold*self.feature_total_array[:,0]/2.0
-				else:
-					gtT_mask = vote_array >= threshold*self.feature_total_array[:,0]
-				gtZ_mask = vote_array > 0
-				mask = np.logical_and(gtT_mask, gtZ_mask)
+	def _call_features(self, chrom, settings=((0.5, 0, 0),)):
+		'''
+		Calls the features of a chromosome from its votes for every
+		(threshold, min_size, max_fill_size) setting. The votes are loaded
+		and every threshold mask is computed once for all settings.
+
+		# Returns
+		list: For every setting, arrays of the 1-based inclusive start,
+		      end, feature index, TE order index, and TE superfamily index
+		      of every feature, sorted by position. TE indices are -1 for
+		      other features.
+		'''
+		self._load_arrays(chrom)
+		logger.debug("Feature vote row sums: %s"%(str(list(self.feature_votes.column_sums()))))
+		logger.debug("Feature total row sums: %s"%(str(list(self.feature_totals.column_sums()))))
+		total_array = self.feature_totals.column(0)
+		if self.stranded: total_array = total_array/2.0
+		bounds = [[np.zeros((0,2), dtype=np.int64)] for setting in settings]
+		indices = [[np.zeros(0, dtype=np.int64)] for setting in settings]
+		# Features without votes cannot be called
+		for feat_index in self.feature_votes.voted_columns():
+			vote_array = self.feature_votes.column(feat_index)
+			gtZ_mask = vote_array > 0
+			masks = {}
+			for k, (threshold, min_size, max_fill_size) in enumerate(settings):
+				if threshold not in masks:
+					masks[threshold] = np.logical_and(vote_array >= threshold*total_array, gtZ_mask)
+				mask = masks[threshold]
 				if min_size or max_fill_size:
+					# Bridging works in place, so shared masks are copied
+					mask = mask.copy()
 					bridge_array(mask, min_size, max_fill_size)
 				bound_array = calcRegionBounds(mask, inclusive=True)+1
-				for s,e in bound_array:
-					features.append((s,e,feat_index))
-			features.sort(key=itemgetter(0,1))
-			for s,e,feat_index in features:
-				full_name = gff3_i2f[feat_index]
-				strand = full_name[0]
-				feature_name = full_name[1:]
-				feature_str = "%s\tteamRNN\t%s\t%i\t%i\t.\t%s\t.\tID=team_%i"%(chrom, feature_name, s, e, strand, total_feature_count)
-				if feature_name in te_feature_names and not self.noTEMD:
-					argmax_order_sum = np.argmax(np.sum(self.te_order_array[s-1:e], axis=0))
-					te_order = te_order_i2f[argmax_order_sum]
-					argmax_sufam_sum = np.argmax(np.sum(self.te_sufam_array[s-1:e], axis=0))
-					te_sufam = te_sufam_i2f[argmax_sufam_sum]
-					feature_str += ';Order=%s;Superfamily=%s'%(te_order, te_sufam)
-				out_gff3.append(feature_str)
-				total_feature_count += 1
-			logger.info("Finished writing %s"%(chrom))
-		if out_file:
-			with open(out_file,'w') as OF:
-				OF.write('\n'.join(out_gff3)+'\n')
-		else:
-			return out_gff3
+				bounds[k].append(bound_array.reshape(-1,2))
+				indices[k].append(np.full(len(bound_array), feat_index, dtype=np.int64))
+		calls = []
+		for k in irange(len(settings)):
+			call_bounds, call_indices = np.vstack(bounds[k]), np.concatenate(indices[k])
+			# Stable sort by (start, end) keeps features at the same location in index order
+			order = np.lexsort((call_bounds[:,1], call_bounds[:,0]))
+			calls.append([call_bounds[order,0], call_bounds[order,1], call_indices[order], \
+				np.full(len(order), -1, dtype=np.int64), np.full(len(order), -1, dtype=np.int64)])
+		if not self.noTEMD:
+			te_ids = [i for i in gff3_i2f if gff3_i2f[i][1:] in te_feature_names]
+			is_te = [np.in1d(call[2], te_ids) for call in calls]
+			te_starts = np.concatenate([call[0][te]-1 for call, te in zip(calls, is_te)])
+			te_ends = np.concatenate([call[1][te] for call, te in zip(calls, is_te)])
+			if len(te_starts):
+				# Class votes of every TE come from prefix sums at its bounds, shared by all settings
+				te_order = np.argmax(self.te_order_votes.range_sums(te_starts, te_ends), axis=1)
+				te_sufam = np.argmax(self.te_sufam_votes.range_sums(te_starts, te_ends), axis=1)
+				first = 0
+				for call, te in zip(calls, is_te):
+					last = first+te.sum()
+					call[3][te], call[4][te] = te_order[first:last], te_sufam[first:last]
+					first = last
+		return [tuple(call) for call in calls]
+	def _format_features(self, chrom, features, first_id=0):
+		'''
+		Formats called features as GFF3 lines with IDs counting from first_id
+		'''
+		starts, ends, indices, te_order, te_sufam = features
+		# Everything but the coordinates and ID is looked up per feature type
+		prefixes = dict((i, "%s\tteamRNN\t%s\t"%(chrom, gff3_i2f[i][1:])) for i in gff3_i2f)
+		strands = dict((i, "\t.\t%s\t.\tID=team_"%(gff3_i2f[i][0])) for i in gff3_i2f)
+		te_attrs = [';Order=%s;Superfamily='%(order) for order in te_order_i2f]
+		lines = ["%s%i\t%i%s%i"%(prefixes[f], s, e, strands[f], first_id+i) for i, (s, e, f) in \
+			enumerate(zip(starts.tolist(), ends.tolist(), indices.tolist()))]
+		for i in np.flatnonzero(te_order >= 0).tolist():
+			lines[i] += te_attrs[te_order[i]]+te_sufam_i2f[te_sufam[i]]
+		return lines
+	def _called_chroms(self, settings, processes=1, pool=False):
+		'''
+		Yields (chrom, calls) in sorted chromosome order. With several
+		processes, each worker reads its own chromosome from the vote file
+		and at most two chromosomes per worker are in flight, so finished
+		calls do not pile up in memory. Workers come from pool (see
+		call_pool) when it is given, and are otherwise started here.
+		'''
+		chroms = sorted(self.chrom_dict.keys())
+		if processes <= 1 or len(chroms) == 1:
+			for chrom in chroms:
+				yield chrom, self._call_features(chrom, settings)
+			return
+		self._release()
+		budget = self.mem_budget//processes
+		own_pool = not pool
+		if own_pool: pool = call_pool(processes)
+		try:
+			tasks = iter([(self.fasta_file, self.h5_file, budget, chrom, settings) for chrom in chroms])
+			pending = [pool.apply_async(call_chrom_features, (task,)) for task in islice(tasks, 2*processes)]
+			while pending:
+				chrom, calls = pending.pop(0).get()
+				for task in islice(tasks, 1):
+					pending.append(pool.apply_async(call_chrom_features, (task,)))
+				yield chrom, calls
+		finally:
+			if own_pool:
+				pool.close()
+				pool.join()
+			self._reopen()
+	def write_gff3(self, out_file='', threshold=0.5, min_size=0, max_fill_size=0, processes=1, pool=False):
+		'''
+		Calls features from the votes and writes them to out_file, one
+		chromosome at a time, or returns the GFF3 lines without out_file
+
+		# Parameters
+		out_file (str): Output GFF3 file
+		threshold (float): Fraction of the votes needed to call a feature
+		min_size (int): Minimum feature size
+		max_fill_size (int): Maximum size of gaps filled between features
+		processes (int): Number of processes calling chromosomes in parallel
+		pool (multiprocessing.Pool): Workers from call_pool [started here]
+		'''
+		return self.write_gff3s([(out_file, threshold, min_size, max_fill_size)], processes, pool)[0]
+	def write_gff3s(self, outputs, processes=1, pool=False):
+		'''
+		Writes several GFF3 outputs in a single pass over the votes
+
+		# Parameters
+		outputs (list): (out_file, threshold, min_size, max_fill_size) of
+		                every output. Outputs without a file are returned.
+		processes (int): Number of processes calling chromosomes in parallel
+		pool (multiprocessing.Pool): Workers from call_pool [started here]
+
+		# Returns
+		list: GFF3 lines of every output without a file (None for the others)
+		'''
+		settings = tuple([tuple(output[1:]) for output in outputs])
+		out_gff3s, handles, counts = [], [], [0]*len(outputs)
+		try:
+			for out_file, threshold, min_size, max_fill_size in outputs:
+				if os.path.exists(out_file):
+					logger.info("Overwriting old %s"%(out_file))
+					os.remove(out_file)
+				if min_size or max_fill_size:
+					logger.info("Filling gaps <= %i and Removing |features| < %i%s"%(max_fill_size, min_size, \
+						" in %s"%(out_file) if out_file else ""))
+				out_gff3s.append(['##gff-version   3'] if not out_file else None)
+				handles.append(open(out_file, 'w') if out_file else False)
+				if out_file: handles[-1].write('##gff-version   3\n')
+			for chrom, calls in self._called_chroms(settings, processes, pool):
+				for k, features in enumerate(calls):
+					lines = self._format_features(chrom, features, counts[k])
+					counts[k] += len(lines)
+					if handles[k]:
+						if lines: handles[k].write('\n'.join(lines)+'\n')
+					else:
+						out_gff3s[k] += lines
+				logger.info("Finished writing %s"%(chrom))
+		finally:
+			for OF in handles:
+				if OF: OF.close()
+		return out_gff3s
+
+def call_pool(processes):
+	'''
+	Starts the workers that call features in parallel, or returns False for
+	a single process. Forked workers inherit every lock held by another
+	thread, so on Python 2 the pool has to be started before a TF session,
+	prefetch thread, or HDF5 reader exists. Python 3 starts them from a
+	clean forkserver process instead.
+	'''
+	if processes <= 1: return False
+	if hasattr(mp, 'get_context'):
+		return mp.get_context('forkserver').Pool(processes)
+	return mp.Pool(processes)
+
+def call_chrom_features(task):
+	'''
+	Calls the features of one chromosome from a vote file in a worker process
+	'''
+	fasta_file, h5_file, mem_budget, chrom, settings = task
+	OA = output_aggregator(fasta_file, h5_file=h5_file, mem_budget=mem_budget, read_only=True)
+	calls = OA._call_features(chrom, settings)
+	OA.close()
+	return chrom, calls
 
 class MSE_interval:
 	def __init__(self, fasta_file, out_dir, hvd_rank):
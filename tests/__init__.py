@@ -23,6 +23,28 @@ except:
 	from mock import patch
 from glob import glob
 
+def setUpModule():
+	global call_pool
+	# Feature callers are forked before any test starts a TF session or
+	# thread, the same way the CLI starts them
+	call_pool = writer.call_pool(2)
+def tearDownModule():
+	call_pool.close()
+	call_pool.join()
+	# Caches written next to the test inputs
+	tpath = os.path.dirname(__file__)
+	gff3 = os.path.join(tpath, 'test.gff3')
+	for cache in glob(gff3+'.*.npz')+glob(gff3+'.*.lock')+glob(gff3+'.*.labels.npy')+glob(os.path.join(tpath, '*.sha1')):
+		os.remove(cache)
+	for store_dir in ('test.fa.2bit', 'test_meth.txt.columns', 'test_meth.txt.features'):
+		if os.path.exists(os.path.join(tpath, store_dir)): rmtree(os.path.join(tpath, store_dir))
+
+def worker_reads_columns(i):
+	'''
+	Whether a stateful pool worker reads methylation from the converted columns
+	'''
+	return bool(reader.wIS.MC.MS) and not reader.wIS.MC.M5
+
 class TestReader(unittest.TestCase):
 	def setUp(self):
 		tpath = os.path.dirname(__file__)
@@ -48,6 +70,8 @@ class TestReader(unittest.TestCase):
 		# Wipe log
 		logStream.truncate(0)
 		if os.path.exists('mse_tmp'): rmtree('mse_tmp')
+		# Stateful slicers convert the methratio for their workers
+		if os.path.exists(self.mr1+'.columns'): rmtree(self.mr1+'.columns')
 		map(os.remove, glob('*_s*png'))
 		## Runs after every test function ##
 	def _compare_against_file(self, out_lines, in_file, noTEMD=False):
@@ -98,6 +122,20 @@ class TestReader(unittest.TestCase):
 		IA = np.copy(ORIG)
 		util.bridge_array(IA, min_size=4, max_gap_size=3)
 		self.assertEqual(list(IA), [1,1,1,1,1,1,1,1,1,1,1,1])
+	def test_background_iter(self):
+		stats = {}
+		self.assertEqual(list(util.background_iter(iter(range(50)), 3, stats)), list(range(50)))
+		self.assertTrue(stats['produce'] >= 0)
+		def broken():
+			yield 1
+			raise ValueError("bad batch")
+		BI = util.background_iter(broken(), 2)
+		self.assertEqual(next(BI), 1)
+		self.assertRaises(ValueError, next, BI)
+		# Stopping early releases the producer
+		BI = util.background_iter(iter(range(1000)), 1)
+		self.assertEqual(next(BI), 0)
+		BI.close()
 	def test_refcache(self):
 		RC = reader.refcache(self.fa)
 		FA = FastaFile(self.fa)
@@ -109,6 +147,37 @@ class TestReader(unittest.TestCase):
 				self.assertEqual(RC.fetch(chrom, i, i+3), FA.fetch(chrom, i, i+3))
 		# clean up
 		FA.close()
+	def test_fasta_qualities(self):
+		tmp_dir = 'ref_tmp'
+		if os.path.exists(tmp_dir): rmtree(tmp_dir)
+		os.makedirs(tmp_dir)
+		fa = os.path.join(tmp_dir, 'scaffolds.fa')
+		headers = ['dna:chromosome', 'dna:scaffold extra words', 'dna:contig', '', 'dna:supercontig', 'x'*1000]
+		seqs = {}
+		with open(fa, 'w') as OF:
+			for i in range(60):
+				chrom = 'S%i'%(i)
+				seqs[chrom] = 'ACGTN'*(i+1)
+				OF.write('>%s %s\n'%(chrom, headers[i%len(headers)]))
+				OF.write(seqs[chrom]+'\n')
+		import pysam
+		pysam.faidx(fa)
+		expected = [3, 2, 1, 0, 1, 0]
+		self.assertEqual(reader.fasta_qualities(fa), {'S%i'%(i):expected[i%len(headers)] for i in range(60)})
+		rmtree(tmp_dir)
+	def test_methcache(self):
+		M5 = Meth5py(self.mr1, self.fa)
+		MC = reader.methcache(self.mr1, self.fa, chunkSize=6, cacheSize=12)
+		for chrom in ('Chr1', 'Chr2'):
+			for s in range(20):
+				for e in range(s+1, 21):
+					old = M5.fetch(chrom, s+1, e)
+					new = MC.fetch(chrom, s, e)
+					for i in range(4):
+						self.assertTrue(np.array_equal(old[:,i], new[i]))
+		self.assertEqual(len(MC.chunks), 2)
+		M5.close()
+		MC.close()
 	def test_split2quality(self):
 		self.assertEqual(reader._split2quality('> dna:chromosome bears'.split(' ')), 3)
 		self.assertEqual(reader._split2quality('> dna:scaffold'.split(' ')), 2)
@@ -121,6 +190,164 @@ class TestReader(unittest.TestCase):
 		FA = FastaFile(self.fa)
 		for chrom in FA.references:
 			self.assertEqual(RC.chrom_qualities[chrom], 3)
+	def test_encode_seq(self):
+		seq = 'AGTCNRYagtcn-'
+		self.assertEqual(list(reader.encode_seq(seq)), [0,1,2,3,4,4,4,0,1,2,3,4,4])
+		self.assertEqual(list(reader.encode_seq(seq[:7])), [constants.base2index[b] for b in seq[:7]])
+		FA = FastaFile(self.fa)
+		I = reader.input_slicer(self.fa, self.mr1)
+		for chrom in FA.references:
+			c, x = I._get_region(chrom, 0, 20, 3, 20)
+			self.assertEqual(list(x[:,0]), [constants.base2index[b] for b in FA.fetch(chrom)])
+			self.assertTrue(np.allclose(x[:,1], np.arange(1,21)/20.0))
+		FA.close()
+	def test_packed_reference(self):
+		tmp_dir = 'ref_tmp'
+		if os.path.exists(tmp_dir): rmtree(tmp_dir)
+		os.makedirs(tmp_dir)
+		fa = os.path.join(tmp_dir, 'ref.fa')
+		seqs = {'C1':'ACGTNNacgtRYAAGGTTCCA', 'C2':'nACG', 'C3':'GATTACAGATTACA'*3}
+		with open(fa, 'w') as OF:
+			for chrom in sorted(seqs):
+				OF.write('>%s dna:scaffold\n'%(chrom))
+				for i in range(0, len(seqs[chrom]), 10):
+					OF.write(seqs[chrom][i:i+10]+'\n')
+		import pysam
+		pysam.faidx(fa)
+		# A tiny chunk size exercises chunk boundaries
+		PR = reader.packed_reference(fa, chunkSize=8)
+		self.assertEqual(PR.chroms, ['C1','C2','C3'])
+		for chrom, seq in seqs.items():
+			self.assertEqual(PR.chrom_lens[chrom], len(seq))
+			self.assertEqual(PR.chrom_qualities[chrom], 2)
+			for s in range(len(seq)):
+				for e in range(s+1, len(seq)+1):
+					self.assertEqual(list(PR.fetch(chrom, s, e)), list(reader.encode_seq(seq[s:e])))
+		# Reopening maps the existing store
+		self.assertEqual(list(reader.packed_reference(fa).fetch('C1', 0, 6)), [0,3,1,2,4,4])
+		I = reader.input_slicer(self.fa, self.mr1)
+		self.assertTrue(isinstance(I.RC, reader.packed_reference))
+		rmtree(tmp_dir)
+	def test_compact_inputs(self):
+		I = reader.input_slicer(self.fa, self.mr1)
+		self.assertEqual(constants.compact_dtype.itemsize, 17)
+		for chrom in ('Chr1', 'Chr2'):
+			q = I.RC.chrom_qualities[chrom]
+			c, cx = I._get_region(chrom, 2, 20, q, 15, compact=True)
+			c, x = I._get_region(chrom, 2, 20, q, 15)
+			self.assertEqual(cx.dtype, constants.compact_dtype)
+			self.assertTrue(np.array_equal(reader.expand_inputs(cx, I.ploidy, q), x))
+			self.assertTrue(np.array_equal(x[:,0], I.RC.fetch(chrom, 2, 17)))
+			self.assertTrue(np.all(x[:,8:] == (I.ploidy, q)))
+			# Ratios lose at most float16 precision
+			meth = I.MC.fetch(chrom, 2, 17)
+			for i in np.nonzero(meth[0] != -1)[0]:
+				channel = meth[0][i]*2+2
+				self.assertAlmostEqual(x[i,channel], meth[2][i]/float(meth[3][i]), places=3)
+				self.assertEqual(x[i,channel+1], meth[3][i])
+			# Batches of records reverse complement like expanded inputs
+			cb = I._list2batch_num(cx, 5, 3, 2)
+			xb = I._list2batch_num(x, 5, 3, 2)
+			self.assertTrue(np.array_equal(reader.expand_inputs(cb, I.ploidy, q), xb))
+			self.assertTrue(np.array_equal(reader.expand_inputs(reader.rev_comp(cb), I.ploidy, q), reader.rev_comp(xb)))
+		# Coverage saturates instead of wrapping
+		meth = (np.array([0, -1]), np.array([0, 0]), np.array([1, 0]), np.array([10**6, 0]))
+		records = I._compact_region(np.array([3, 0], dtype=np.uint8), meth, 0, 20)
+		self.assertEqual(records['cov'][0,0], constants.max_compact_cov)
+	def test_feature_store(self):
+		store_dir = 'features_tmp'
+		I = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		FS = reader.feature_store(self.fa, self.mr1, store_dir=store_dir)
+		self.assertFalse(FS.complete())
+		# Missing tracks are remembered until they are built
+		self.assertEqual(FS.missing, set(['Chr1', 'Chr2']))
+		FS.build(I, chunk_size=7)
+		self.assertEqual(FS.missing, set())
+		self.assertTrue(FS.complete())
+		IF = reader.input_slicer(self.fa, self.mr1, self.gff3, features=store_dir)
+		self.assertFalse(IF.MC)
+		for chrom in ('Chr1', 'Chr2'):
+			for (c1, x1, y1), (c2, x2, y2) in zip(I.chrom_iter(chrom, 5, 2, 3), IF.chrom_iter(chrom, 5, 2, 3)):
+				self.assertEqual(c1, c2)
+				self.assertTrue(np.array_equal(x1, x2))
+				self.assertTrue(np.array_equal(y1, y2))
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3, stateful=True)
+		ISF = reader.input_slicer(self.fa, self.mr1, self.gff3, stateful=True, features=store_dir)
+		self.assertFalse(ISF.pool)
+		for (c1, x1, y1), (c2, x2, y2) in zip(IS.stateful_chrom_iter('Chr1', 5, 1, 2, stranded=True), \
+				ISF.stateful_chrom_iter('Chr1', 5, 1, 2, stranded=True)):
+			self.assertEqual(c1, c2)
+			self.assertTrue(np.array_equal(x1, x2))
+			self.assertTrue(np.array_equal(y1, y2))
+		# Quality and ploidy are added at expansion and share the same tracks
+		self.assertEqual(FS.store_dir, reader.feature_store(self.fa, self.mr1, quality=1, ploidy=4, store_dir=store_dir).store_dir)
+		rmtree(store_dir)
+	def test_featurize_cli(self):
+		store_dir = 'features_cli_tmp'
+		testArgs = ['teamRNN', \
+			'-R', self.fa, \
+			'-M', self.mr1, \
+			'--features', store_dir, \
+			'featurize']
+		with patch('sys.argv', testArgs):
+			teamRNN.main()
+		self.assertTrue('Done' in logStream.getvalue().split('\n')[-2])
+		self.assertEqual(logStream.getvalue().count('Featurized'), 2)
+		self.assertTrue(reader.feature_store(self.fa, self.mr1, store_dir=store_dir).complete())
+		IF = reader.input_slicer(self.fa, self.mr1, features=store_dir)
+		self.assertFalse(IF.MC)
+		# Existing tracks are only rebuilt with -f
+		with patch('sys.argv', testArgs):
+			teamRNN.main()
+		self.assertEqual(logStream.getvalue().count('Featurized'), 2)
+		with patch('sys.argv', testArgs+['-f']):
+			teamRNN.main()
+		self.assertEqual(logStream.getvalue().count('Featurized'), 4)
+		rmtree(store_dir)
+	def test_convert_cli(self):
+		testArgs = ['teamRNN', \
+			'-R', self.fa, \
+			'-M', self.mr1, \
+			'convert', \
+			'-p', '2', \
+			'--chunk_mb', '1']
+		with patch('sys.argv', testArgs):
+			teamRNN.main()
+		self.assertTrue('Done' in logStream.getvalue().split('\n')[-2])
+		self.assertTrue('Converted 15 methratio lines' in logStream.getvalue())
+		self.assertTrue(reader.meth_store(self.mr1, self.fa).complete())
+		# Methylation is now read from the converted columns
+		MC = reader.methcache(self.mr1, self.fa)
+		self.assertTrue(MC.MS)
+		self.assertFalse(MC.M5)
+		MC.close()
+	def test_meth_store(self):
+		store_dir = 'columns_tmp'
+		MC = reader.methcache(self.mr1, self.fa)
+		MS = reader.meth_store(self.mr1, self.fa, store_dir=store_dir)
+		self.assertFalse(MS.complete())
+		# Small chunks split the file across processes
+		self.assertTrue(len(MS._ranges(100)) > 1)
+		self.assertEqual(MS.build(processes=2, chunk_bytes=100), 15)
+		self.assertTrue(MS.complete())
+		self.assertEqual(MS.build(), 0)
+		for chrom, chrom_len in MC.chrom_lens.items():
+			for c1, c2 in zip(MC.fetch(chrom, 0, chrom_len), MS.fetch(chrom, 0, chrom_len)):
+				self.assertTrue(np.array_equal(c1, c2))
+		MC.close()
+		# Records outside of the reference are skipped
+		bad_meth = 'bad_meth.txt'
+		with open(self.mr1) as IF, open(bad_meth, 'w') as OF:
+			OF.write(IF.read())
+			OF.write('ChrX\t10\t+\tCHH\t0.5\t20.0\t10\t20\t1\t1\t0.2\t0.2\n')
+			OF.write('Chr1\t21\t+\tCHH\t0.5\t20.0\t10\t20\t1\t1\t0.2\t0.2\n')
+		MS2 = reader.meth_store(bad_meth, self.fa, store_dir=store_dir)
+		self.assertEqual(MS2.build(processes=2, chunk_bytes=100), 15)
+		for chrom, chrom_len in MC.chrom_lens.items():
+			for c1, c2 in zip(MS.fetch(chrom, 0, chrom_len), MS2.fetch(chrom, 0, chrom_len)):
+				self.assertTrue(np.array_equal(c1, c2))
+		os.remove(bad_meth)
+		rmtree(store_dir)
 	def test_rev_comp(self):
 		IS = reader.input_slicer(self.fa, self.mr1, stateful=True)
 		XL = [x for c,x in IS.stateful_chrom_iter('Chr1', seq_len=5, batch_size=2)]
@@ -346,6 +573,198 @@ class TestReader(unittest.TestCase):
 						R2 = [c for c,x in IS.stateful_chrom_iter('Chr1', seq_len, \
 							1, batch_size, 1, hvd_size)]
 						self.assertEqual(len(R1), len(R2))
+	def test_plan_batches(self):
+		I = reader.input_slicer(self.fa, self.mr1)
+		for seq_len, offset, batch_size in ((5,1,1), (3,2,3), (4,1,5)):
+			full = {chrom:[c for c, x in I.chrom_iter(chrom, seq_len, offset, batch_size)] for chrom in ('Chr1','Chr2')}
+			for hvd_size in (1,2,3,7):
+				plan = I.plan_batches(seq_len, offset, batch_size, hvd_size)
+				self.assertEqual(len(plan), hvd_size)
+				loads = [sum([last-first for chrom, first, last in shard]) for shard in plan]
+				self.assertTrue(max(loads)-min(loads) <= 1)
+				# Every batch is classified exactly once, in genome order
+				CL = []
+				for shard in plan:
+					for chrom, first, last in shard:
+						CL += [c for c, x in I.chrom_range_iter(chrom, first, last, seq_len, offset, batch_size)]
+				self.assertEqual(CL, full['Chr1']+full['Chr2'])
+	def test_tfdata_pipeline(self):
+		import tensorflow as tf
+		from teamRNN import pipeline
+		I = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		for seq_len, offset, batch_size in ((5,1,1), (3,2,3)):
+			TP = pipeline.tfdata_pipeline(I, ['Chr2','Chr1'], seq_len, offset, batch_size, batch_size)
+			expected = []
+			for chrom in ('Chr1','Chr2'):
+				expected += [(x, y.astype(np.float32)) for c, x, y in I.chrom_iter(chrom, seq_len, offset, batch_size)]
+			self.assertEqual(TP.n_batches, len(expected))
+			with tf.Graph().as_default():
+				TP = pipeline.tfdata_pipeline(I, ['Chr2','Chr1'], seq_len, offset, batch_size, batch_size)
+				next_batch = tf.compat.v1.data.make_one_shot_iterator(TP.dataset).get_next()
+				with tf.compat.v1.Session() as sess:
+					# Interleaving changes the order, but not the batches
+					found = [sess.run(next_batch) for i in range(TP.n_batches)]
+			key = lambda xy: (xy[0].tobytes(), xy[1].tobytes())
+			self.assertEqual(sorted(map(key, found)), sorted(map(key, expected)))
+		I.close()
+		self.assertFalse(I.MC)
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3, stateful=True, workers=2)
+		for stranded in (False, True):
+			expected = dict((chrom, list(IS.stateful_chrom_iter(chrom, 3, 1, 4, stranded=stranded))) for chrom in ('Chr1','Chr2'))
+			with tf.Graph().as_default():
+				TP = pipeline.tfdata_pipeline(IS, ['Chr1','Chr2'], 3, 1, 4, 4, stateful=True, stranded=stranded)
+				with tf.compat.v1.Session() as sess:
+					for chrom in ('Chr1','Chr2'):
+						ds, n_forward = TP.datasets[chrom]
+						self.assertEqual(n_forward*(2 if stranded else 1), len(expected[chrom]))
+						next_batch = tf.compat.v1.data.make_one_shot_iterator(ds).get_next()
+						for ec, ex, ey in expected[chrom]:
+							x, y = sess.run(next_batch)
+							self.assertTrue(np.array_equal(x, ex))
+							self.assertTrue(np.array_equal(y, ey))
+						# Datasets end with the chromosome instead of repeating
+						self.assertRaises(tf.errors.OutOfRangeError, sess.run, next_batch)
+		IS.close()
+		self.assertFalse(IS.pool)
+	def test_window_pipeline(self):
+		from teamRNN import pipeline
+		I = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		# Workers never read the methylation file that I has open and has read from
+		self.assertTrue(I.MC.M5)
+		I.chrom_track('Chr1')
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3, stateful=True, workers=2)
+		self.assertTrue(all(IS.pool.map(worker_reads_columns, range(4))))
+		for chrom in ('Chr1','Chr2'):
+			track = I.chrom_track(chrom, chunk_size=7)
+			self.assertEqual(track.dtype, constants.compact_dtype)
+			self.assertTrue(np.array_equal(reader.expand_inputs(track, I.ploidy, I.RC.chrom_qualities[chrom]), \
+				I._get_region(chrom, 0, 20, I.RC.chrom_qualities[chrom], 20)[1]))
+		for seq_len, offset, batch_size in ((5,1,1), (3,2,3)):
+			for stranded in (False, True):
+				TP = pipeline.window_pipeline(I, ['Chr2','Chr1'], seq_len, offset, batch_size, batch_size, stranded=stranded)
+				expected = []
+				for chrom in ('Chr1','Chr2'):
+					for c, x, y in I.chrom_iter(chrom, seq_len, offset, batch_size):
+						y = y.copy()
+						if stranded: reader.mask(y, '-')
+						expected.append((x, y))
+				self.assertEqual(len(TP.dataset), len(expected))
+				for (x, y), (ex, ey) in zip(TP.dataset, expected):
+					self.assertTrue(np.array_equal(x, ex))
+					self.assertTrue(np.array_equal(y, ey))
+		for stranded in (False, True):
+			TP = pipeline.window_pipeline(IS, ['Chr1','Chr2'], 3, 1, 4, 4, stateful=True, stranded=stranded)
+			for chrom in ('Chr1','Chr2'):
+				ds, n_forward = TP.datasets[chrom]
+				expected = list(IS.stateful_chrom_iter(chrom, 3, 1, 4, stranded=stranded))
+				self.assertEqual(len(ds), len(expected))
+				self.assertEqual(n_forward*(2 if stranded else 1), len(expected))
+				for (x, y), (ec, ex, ey) in zip(ds, expected):
+					self.assertTrue(np.array_equal(x, ex))
+					self.assertTrue(np.array_equal(y, ey))
+	def test_stream_pipeline(self):
+		from teamRNN import pipeline
+		I = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		loaded, fits = [], []
+		test = self
+		class history:
+			losses, acc = [0.0], [0.0]
+		class fake_model:
+			def fit(self, batches, **kwargs):
+				# Never more than n_resident chromosomes loaded and not yet fit
+				test.assertTrue(len(loaded) <= len(fits)+TP.n_resident)
+				fits.append(batches)
+			def reset_states(self):
+				pass
+		TP = pipeline.stream_pipeline(I, ['Chr2','Chr1'], 3, 1, 2, 2)
+		self.assertEqual(TP.n_resident, 2)
+		self.assertEqual(TP.chrom_bytes['Chr1'], 18*3*(17+self.n_outputs))
+		big = pipeline.stream_pipeline(I, ['Chr2','Chr1'], 3, 1, 2, 2, mem_budget=1)
+		self.assertTrue(big.n_resident > 2)
+		load = TP.load
+		TP.load = lambda chrom: loaded.append(chrom) or load(chrom)
+		for E in range(2):
+			TP.fit_epoch(fake_model(), history, E)
+		self.assertEqual(loaded, ['Chr1','Chr2']*2)
+		for batches, chrom in zip(fits, loaded):
+			expected = [(x, y) for c, x, y in I.chrom_iter(chrom, 3, 1, 2)]
+			self.assertEqual(len(batches), len(expected))
+			for (x, y), (ex, ey) in zip(batches, expected):
+				self.assertTrue(np.array_equal(x, ex))
+				self.assertTrue(np.array_equal(y, ey))
+	def test_strand_batch(self):
+		from teamRNN import pipeline
+		I = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		cbl, xbl, ybl = zip(*I.chrom_iter('Chr1', 3, 1, 2))
+		data = pipeline.load_chrom(I, 'Chr1', 3, 1, 2, 2)
+		y = data[1].copy()
+		# The reverse strand of the whole chromosome, as it used to be cached
+		xr = reader.rev_comp(np.vstack(xbl[::-1]))
+		yr = np.flip(np.vstack(ybl[::-1]), axis=1)
+		reader.mask(yr, '+')
+		forward = pipeline.strand_batches(data, 2, True)
+		reverse = pipeline.strand_batches(data, 2, True, reverse=True)
+		self.assertEqual(len(forward), len(cbl))
+		for i in range(len(cbl)):
+			fx, fy = forward[i]
+			self.assertTrue(np.array_equal(fx, xbl[i]))
+			self.assertTrue(np.array_equal(fy, ybl[i]*(fy != 0)))
+			self.assertFalse(np.any(fy[:,:,len(constants.gff3_f2i)/2:len(constants.gff3_f2i)]))
+			rx, ry = reverse[i]
+			self.assertTrue(np.array_equal(rx, xr[i*2:(i+1)*2]))
+			self.assertTrue(np.array_equal(ry, yr[i*2:(i+1)*2]))
+		# Only the requested batches are masked
+		self.assertTrue(np.array_equal(data[1], y))
+	def test_eval_batches(self):
+		from teamRNN import pipeline
+		I = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		# Workers never read the methylation file that I has open and has read from
+		self.assertTrue(I.MC.M5)
+		I.chrom_track('Chr1')
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3, stateful=True, workers=2)
+		self.assertTrue(all(IS.pool.map(worker_reads_columns, range(4))))
+		for stateful in (False, True):
+			for stranded in (False, True):
+				S = IS if stateful else I
+				args = (S, 'Chr1', 3, 1, 4, 4, 0, 1, stateful, stranded)
+				data = pipeline.load_chrom(*args[:-1])
+				views = list(pipeline.eval_batches(*args, data=data))
+				lazy = list(pipeline.eval_batches(*args))
+				self.assertEqual(len(views), len(lazy))
+				self.assertEqual(len(views), data[0].shape[0]/4*(2 if stranded else 1))
+				for (vc, vx, vy, vr), (lc, lx, ly, lr) in zip(views, lazy):
+					self.assertEqual(vc, lc)
+					self.assertEqual(vr, lr)
+					self.assertTrue(np.array_equal(vx, lx))
+					self.assertTrue(np.array_equal(vy, ly))
+					self.assertEqual(vx.dtype, np.float32)
+				self.assertEqual(data[0].dtype, constants.compact_dtype)
+	def test_stateful_shared_batch(self):
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3, stateful=True, workers=2)
+		I = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		self.assertEqual(IS.pool._processes, 2)
+		for chrom in ('Chr1', 'Chr2'):
+			chrom_quality = I.RC.chrom_qualities[chrom]
+			for c, x, y in IS.stateful_chrom_iter(chrom, 3, 1, 4):
+				self.assertEqual(x.shape, (4, 3, 10))
+				self.assertEqual(y.shape, (4, 3, self.n_outputs))
+				for i, (chrom, s, e) in enumerate(c):
+					ec, ex, ey = I._get_region(chrom, s, 20, chrom_quality, 3)
+					self.assertEqual(c[i], ec)
+					self.assertTrue(np.array_equal(x[i], ex))
+					self.assertTrue(np.array_equal(y[i], ey))
+		shared_file = IS._shared[1]
+		self.assertTrue(os.path.exists(shared_file))
+		del IS
+		self.assertFalse(os.path.exists(shared_file))
+		# Buffers that are never freed are removed when the process exits
+		IS = reader.input_slicer(self.fa, self.mr1, stateful=True, workers=1)
+		shared_file = IS._shared_batch(2, 3)[1]
+		self.assertEqual(reader._shared_files[shared_file], os.getpid())
+		reader._remove_shared_files()
+		self.assertFalse(os.path.exists(shared_file))
+		self.assertEqual(reader._shared_files, {})
+		del IS
 	def test_stranded_stateful_chrom_iter(self):
 		IS = reader.input_slicer(self.fa, self.mr1, stateful=True)
 		I = reader.input_slicer(self.fa, self.mr1)
@@ -436,6 +855,52 @@ class TestReader(unittest.TestCase):
 		tmp[2:7,constants.gff3_f2i['-exon']] = 1
 		tmp[8:14,constants.gff3_f2i['-exon']] = 1
 		self.assertTrue(np.array_equal(res2, tmp))
+	def test_gff3_raster(self):
+		GI = reader.gff3_interval(self.gff3, force=True)
+		# Rasters are only opened when a chromosome is fetched
+		self.assertEqual(GI.rasters, {})
+		for chrom in ('Chr1', 'Chr2'):
+			GI.fetch(chrom, 0, 1)
+			self.assertTrue(os.path.exists(GI._raster_file(chrom)))
+			for s in range(20):
+				for e in range(s+1, 21):
+					tmp = np.zeros((e-s, self.n_outputs), dtype=np.uint8)
+					hits = sorted(GI.interval_tree[chrom].search(s,e), key=lambda i: (i.start, i.end))
+					for interval in hits:
+						element_id, te_order_id, te_sufam_id = interval.data
+						tmp[max(interval.start,s)-s:min(interval.end,e)-s, element_id] = 1
+						tmp[max(interval.start,s)-s:min(interval.end,e)-s, -2:] = (te_order_id, te_sufam_id)
+					self.assertTrue(np.array_equal(GI.fetch(chrom, s, e), tmp))
+		self.assertEqual(GI.fetch('Chr3', 0, 5).sum(), 0)
+		# Warm starts map the cached raster instead of rebuilding it
+		GI2 = reader.gff3_interval(self.gff3)
+		self.assertTrue(isinstance(GI2.raster('Chr1'), np.memmap))
+		self.assertTrue(np.array_equal(GI2.fetch('Chr1', 0, 20), GI.fetch('Chr1', 0, 20)))
+	def test_gff3_cache(self):
+		tmp_dir = 'gff3_tmp'
+		if os.path.exists(tmp_dir): rmtree(tmp_dir)
+		os.makedirs(tmp_dir)
+		gff3 = os.path.join(tmp_dir, 'test.gff3')
+		with open(self.gff3, 'r') as IF, open(gff3, 'w') as OF:
+			OF.write(IF.read())
+		GI = reader.gff3_interval(gff3)
+		self.assertTrue(os.path.exists('%s.%s.npz'%(gff3, GI.key)))
+		self.assertEqual(glob(os.path.join(tmp_dir, '*.pkl')), [])
+		self.assertEqual(glob(os.path.join(tmp_dir, '*.tmp')), [])
+		# Parse parameters are part of the key
+		self.assertNotEqual(GI.key, reader.gff3_interval(gff3, out_dim=len(constants.gff3_f2i)).key)
+		self.assertNotEqual(GI.key, reader.gff3_interval(gff3, include_chrom=True).key)
+		# Warm starts reuse the arrays
+		self.assertEqual(reader.gff3_interval(gff3).key, GI.key)
+		# Changed contents are parsed again
+		with open(gff3, 'a') as OF:
+			OF.write('Chr3\ttest\tgene\t2\t4\t.\t+\t.\tID=team_8\n')
+		GI2 = reader.gff3_interval(gff3)
+		self.assertNotEqual(GI2.key, GI.key)
+		self.assertEqual(GI.fetch('Chr3', 0, 5).sum(), 0)
+		self.assertEqual(GI2.fetch('Chr3', 0, 5)[:,constants.gff3_f2i['+gene']].tolist(), [0,1,1,1,0])
+		self.assertTrue(np.array_equal(GI2.fetch('Chr1', 0, 20), GI.fetch('Chr1', 0, 20)))
+		rmtree(tmp_dir)
 	def test_input_iter_gff3(self):
 		I = reader.input_slicer(self.fa, self.mr1, self.gff3)
 		XYL = list(I.genome_iter()) 
@@ -593,6 +1058,211 @@ class TestReader(unittest.TestCase):
 					OA.vote(*c, array=y, overwrite=True)
 		out_lines = OA.write_gff3()
 		self._compare_against_file(out_lines, self.gff3)
+	def test_vote_store(self):
+		self.assertEqual(writer.vote_dtype(3), np.uint8)
+		self.assertEqual(writer.vote_dtype(500), np.uint16)
+		self.assertEqual(writer.vote_dtype(), np.uint32)
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		# Small blocks split the chromosomes, which are swapped out between votes
+		OA = writer.output_aggregator(self.fa, max_votes=6, block_size=6)
+		for chrom in sorted(IS.FA.references)*2:
+			for cb,xb,yb in IS.chrom_iter(chrom, seq_len=5, offset=2, batch_size=2):
+				for c,y in zip(cb, yb):
+					OA.vote(*c, array=y)
+		self._compare_against_file(OA.write_gff3(), self.gff3)
+		self.assertEqual(OA.feature_totals.dtype, np.uint8)
+		# Only voted columns are stored
+		voted = OA.feature_votes.voted_columns()
+		self.assertTrue(0 < len(voted) < len(constants.gff3_i2f))
+		self.assertEqual(set(voted), set(np.flatnonzero(OA.feature_votes.column_sums())))
+		OA.close()
+	def test_vote_cache(self):
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		batches = [b for chrom in sorted(IS.FA.references) for b in IS.chrom_iter(chrom, seq_len=5, offset=2, batch_size=2)]
+		outputs = []
+		# A budget of two full uint8 blocks forces evictions while switching chromosomes
+		for budget in (0, 12):
+			OA = writer.output_aggregator(self.fa, h5_file='tmp_vote%i.h5'%(budget), max_votes=3, block_size=6, mem_budget=budget)
+			for cb, xb, yb in batches[::2]+batches[1::2]:
+				OA.vote_batch(cb, yb)
+			outputs.append(OA.write_gff3())
+			if budget:
+				self.assertTrue(OA.cache.nbytes <= budget)
+				self.assertTrue(OA.cache.writes > 0)
+				# Evicting unmodified blocks writes nothing
+				writes = OA.cache.writes
+				OA.write_gff3()
+				self.assertEqual(OA.cache.writes, writes)
+			else:
+				self.assertEqual(OA.cache.writes, 0)
+			OA.close()
+		self.assertEqual(outputs[0], outputs[1])
+		self._compare_against_file(outputs[1], self.gff3)
+	def test_write_gff3_parallel(self):
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		OA = writer.output_aggregator(self.fa, h5_file='tmp_vote_par.h5', max_votes=3, block_size=6)
+		for chrom in sorted(IS.FA.references):
+			for cb,xb,yb in IS.chrom_iter(chrom, seq_len=5, offset=2, batch_size=2):
+				OA.vote_batch(cb, yb)
+		out_lines = OA.write_gff3()
+		OA.write_gff3('tmp_par.gff3', processes=2, pool=call_pool)
+		with open('tmp_par.gff3') as GF:
+			self.assertEqual(GF.read(), '\n'.join(out_lines)+'\n')
+		os.remove('tmp_par.gff3')
+		# The vote file is reopened after the workers finish
+		self.assertEqual(OA.write_gff3(), out_lines)
+		OA.close()
+		self.assertFalse(os.path.exists('tmp_vote_par.h5'))
+	def test_write_gff3_after_session(self):
+		import tensorflow as tf
+		import threading
+		from teamRNN import pipeline
+		I = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		OA = writer.output_aggregator(self.fa, h5_file='tmp_vote_sess.h5', max_votes=3, block_size=6)
+		for chrom in sorted(I.FA.references):
+			for cb,xb,yb in I.chrom_iter(chrom, seq_len=5, offset=2, batch_size=2):
+				OA.vote_batch(cb, yb)
+		out_lines = OA.write_gff3()
+		with tf.Graph().as_default():
+			TP = pipeline.tfdata_pipeline(I, ['Chr1','Chr2'], 5, 1, 1, 1)
+			next_batch = tf.compat.v1.data.make_one_shot_iterator(TP.dataset).get_next()
+			with tf.compat.v1.Session() as sess:
+				sess.run(next_batch)
+				# Another thread is reading HDF5 while the workers call features
+				stop = threading.Event()
+				def read_meth():
+					while not stop.is_set(): I.MC.M5.H5['Chr1'][:]
+				T = threading.Thread(target=read_meth)
+				T.start()
+				try:
+					for i in range(3):
+						self.assertEqual(OA.write_gff3(processes=2, pool=call_pool), out_lines)
+				finally:
+					stop.set()
+					T.join()
+		I.close()
+		OA.close()
+	def test_vote_store_add_at(self):
+		import h5py
+		H5 = h5py.File('tmp_add_at.h5', 'w')
+		VS = writer.vote_store(H5, 'Chr1', 20, 4, np.uint8, block_size=6)
+		positions, cols = np.array([0, 5, 6, 6, 19, 5]), np.array([1, 1, 1, 1, 3, 0])
+		VS.add_at(positions, cols)
+		# The same votes one base at a time
+		dense = np.zeros((20, 4), dtype=np.uint8)
+		for p, c in zip(positions, cols):
+			dense[p, c] += 1
+		self.assertTrue(np.array_equal(VS.region(0, 20), dense))
+		# Overwritten votes are set to one
+		VS.add_at(positions, cols, overwrite=True)
+		self.assertTrue(np.array_equal(VS.region(0, 20), np.minimum(dense, 1)))
+		self.assertEqual(VS.voted_columns(), [0, 1, 3])
+		H5.close()
+		os.remove('tmp_add_at.h5')
+	def test_vote_store_range_sums(self):
+		import h5py
+		H5 = h5py.File('tmp_range_sums.h5', 'w')
+		VS = writer.vote_store(H5, 'Chr1', 20, 4, np.uint8, block_size=6)
+		rng = np.random.RandomState(4)
+		votes = rng.randint(0, 3, (20, 4)).astype(np.uint8)
+		votes[6:12] = 0
+		VS.add(0, 20, votes)
+		starts = np.array([0, 0, 3, 5, 6, 7, 19, 13])
+		ends = np.array([20, 1, 9, 6, 12, 18, 20, 13])
+		sums = VS.range_sums(starts, ends)
+		for s, e, row in zip(starts, ends, sums):
+			self.assertTrue(np.array_equal(row, votes[s:e].sum(axis=0)))
+		# Cached block totals follow new votes
+		VS.add_at([7, 7, 19], [1, 1, 3])
+		votes[7,1] += 2
+		votes[19,3] += 1
+		sums = VS.range_sums(starts, ends)
+		for s, e, row in zip(starts, ends, sums):
+			self.assertTrue(np.array_equal(row, votes[s:e].sum(axis=0)))
+		self.assertTrue(np.array_equal(VS.column_sums(), votes.sum(axis=0)))
+		H5.close()
+		os.remove('tmp_range_sums.h5')
+	def test_vote_batch(self):
+		rng = np.random.RandomState(3)
+		n_out = len(constants.gff3_i2f)+2
+		for stranded in (False, True):
+			for overwrite in (False, True):
+				for offset in (1, 3, 7):
+					OA1 = writer.output_aggregator(self.fa, h5_file='tmp_vote1.h5', stranded=stranded, block_size=8)
+					OA2 = writer.output_aggregator(self.fa, h5_file='tmp_vote2.h5', stranded=stranded, block_size=8)
+					for chrom, n in (('Chr1', 3), ('Chr2', 2), ('Chr1', 1)):
+						cb = [(chrom, i*offset, i*offset+5) for i in range(n)]
+						yb = (rng.rand(n, 5, n_out) < 0.3).astype(np.uint32)
+						yb[:,:,-2:] = rng.randint(0, 3, (n, 5, 2))
+						for reverse in ((False, True) if stranded else (False,)):
+							for c, y in zip(cb, yb):
+								OA1.vote(*c, array=y, overwrite=overwrite, reverse=reverse)
+							OA2.vote_batch(cb, yb, overwrite=overwrite, reverse=reverse)
+					for chrom in ('Chr1', 'Chr2'):
+						OA1._load_arrays(chrom)
+						OA2._load_arrays(chrom)
+						for vs1, vs2 in zip(OA1.stores, OA2.stores):
+							self.assertTrue(np.array_equal(vs1.region(0, 20), vs2.region(0, 20)))
+					OA1.close()
+					OA2.close()
+	def test_write_gff3s(self):
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		OA = writer.output_aggregator(self.fa, h5_file='tmp_vote_multi.h5', max_votes=3, block_size=6)
+		for chrom in sorted(IS.FA.references):
+			for cb,xb,yb in IS.chrom_iter(chrom, seq_len=5, offset=2, batch_size=2):
+				OA.vote_batch(cb, yb)
+		settings = [(0.5, 0, 0), (0.3, 0, 0), (0.5, 4, 2), (0.8, 4, 2)]
+		separate = [OA.write_gff3(threshold=t, min_size=s, max_fill_size=f) for t,s,f in settings]
+		# One pass writes every output
+		outputs = [('', t, s, f) for t,s,f in settings]
+		outputs[1] = ('tmp_multi.gff3',)+outputs[1][1:]
+		combined = OA.write_gff3s(outputs, processes=2, pool=call_pool)
+		self.assertIsNone(combined[1])
+		with open('tmp_multi.gff3') as GF:
+			self.assertEqual(GF.read(), '\n'.join(separate[1])+'\n')
+		os.remove('tmp_multi.gff3')
+		for k in (0, 2, 3):
+			self.assertEqual(combined[k], separate[k])
+		OA.close()
+	def test_threshold_outputs(self):
+		import argparse
+		settings = teamRNN._call_settings('0.5:75:50,0.7,0.7:0:0')
+		self.assertEqual(settings, [(0.5, 75, 50), (0.7, None, None), (0.7, 0, 0)])
+		self.assertRaises(argparse.ArgumentTypeError, teamRNN._call_settings, '0.5:75')
+		self.assertRaises(argparse.ArgumentTypeError, teamRNN._call_settings, 'half')
+		self.assertEqual(teamRNN.threshold_outputs('out.gff3', [(0.5, 75, 50)]), [('out.gff3', 0.5, 75, 50)])
+		# Output names include every setting, so filters alone tell them apart
+		outputs = teamRNN.threshold_outputs('tmp_filters.gff3', [(0.5, 0, 0), (0.5, 4, 2)])
+		self.assertEqual([o[0] for o in outputs], ['tmp_filters_T0.5_min0_fill0.gff3', 'tmp_filters_T0.5_min4_fill2.gff3'])
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		OA = writer.output_aggregator(self.fa, h5_file='tmp_vote_filters.h5', max_votes=3, block_size=6)
+		for chrom in sorted(IS.FA.references):
+			for cb,xb,yb in IS.chrom_iter(chrom, seq_len=5, offset=2, batch_size=2):
+				OA.vote_batch(cb, yb)
+		OA.write_gff3s(outputs)
+		self.assertNotEqual(*[open(o[0]).read() for o in outputs])
+		for out_file, t, m, f in outputs:
+			with open(out_file) as GF:
+				self.assertEqual(GF.read(), '\n'.join(OA.write_gff3(threshold=t, min_size=m, max_fill_size=f))+'\n')
+			os.remove(out_file)
+		OA.close()
+	def test_keep_votes(self):
+		IS = reader.input_slicer(self.fa, self.mr1, self.gff3)
+		OA = writer.output_aggregator(self.fa, h5_file='tmp_vote_keep.h5', max_votes=3, block_size=6, mem_budget=64, keep=True)
+		for chrom in sorted(IS.FA.references):
+			for cb,xb,yb in IS.chrom_iter(chrom, seq_len=5, offset=2, batch_size=2):
+				OA.vote_batch(cb, yb)
+		self.assertFalse(OA.complete())
+		out_lines = [OA.write_gff3(threshold=t, min_size=4, max_fill_size=2) for t in (0.3, 0.5)]
+		# Evicted and cached blocks are all written when the votes are kept
+		OA.close()
+		self.assertTrue(os.path.exists('tmp_vote_keep.h5'))
+		OA = writer.output_aggregator(self.fa, h5_file='tmp_vote_keep.h5', read_only=True)
+		self.assertTrue(OA.complete())
+		self.assertEqual([OA.write_gff3(threshold=t, min_size=4, max_fill_size=2) for t in (0.3, 0.5)], out_lines)
+		OA.close()
+		self.assertTrue(os.path.exists('tmp_vote_keep.h5'))
+		os.remove('tmp_vote_keep.h5')
 	def test_batch_new(self):
 		IS = reader.input_slicer(self.fa, self.mr1)
 		BL = list(IS.genome_iter(seq_len=5, batch_size=4))
@@ -951,6 +1621,106 @@ class TestReader(unittest.TestCase):
 				self.assertEqual(test_split, cli_split)
 		if os.path.exists('test_cli'):
 			rmtree('test_cli')
+	def _train_cli(self, out_dir, *train_args):
+		'''
+		Trains a small plain RNN from the command line
+		'''
+		testArgs = ['teamRNN', \
+			'-R', self.fa, \
+			'-D', out_dir, \
+			'-M', self.mr1, \
+			'--workers', '1', \
+			'train', \
+			'-A', self.gff3, \
+			'-E', '1', \
+			'-L', '5', \
+			'-B', '3', \
+			'-C', 'rnn', \
+			'-n', '10', \
+			'-f']+list(train_args)
+		with patch('sys.argv', testArgs):
+			teamRNN.main()
+		self.assertTrue('Done' in logStream.getvalue().split('\n')[-2])
+		self.assertTrue(os.path.exists('%s/config.pkl'%(out_dir)))
+	def test_call_cli(self):
+		out_dir = 'test_call_cli'
+		self._train_cli(out_dir)
+		testArgs = ['teamRNN', \
+			'-R', self.fa, \
+			'-D', out_dir, \
+			'-M', self.mr1, \
+			'--max_fill', '0', \
+			'--min_feat', '0', \
+			'--workers', '1', \
+			'--keep_votes', \
+			'classify', \
+			'-O', '%s/out.gff3'%(out_dir)]
+		with patch('sys.argv', testArgs):
+			teamRNN.main()
+		self.assertTrue('Done' in logStream.getvalue().split('\n')[-2])
+		self.assertTrue(os.path.exists('%s/votes.h5'%(out_dir)))
+		# Kept votes are called again with two filters in one pass
+		testArgs = ['teamRNN', \
+			'-R', self.fa, \
+			'-D', out_dir, \
+			'--max_fill', '0', \
+			'--min_feat', '0', \
+			'--workers', '1', \
+			'call', \
+			'-O', '%s/call.gff3'%(out_dir), \
+			'-T', '0.5,0.5:5:2']
+		with patch('sys.argv', testArgs):
+			teamRNN.main()
+		self.assertTrue('Done' in logStream.getvalue().split('\n')[-2])
+		with open('%s/out.gff3'%(out_dir)) as F1, open('%s/call_T0.5_min0_fill0.gff3'%(out_dir)) as F2:
+			self.assertEqual(F1.read(), F2.read())
+		self.assertTrue(os.path.exists('%s/call_T0.5_min5_fill2.gff3'%(out_dir)))
+		# Missing and unfinished vote files exit before calling
+		testArgs[testArgs.index('call'):] = ['call', '-V', '%s/missing.h5'%(out_dir)]
+		with patch('sys.argv', testArgs):
+			self.assertRaises(SystemExit, teamRNN.main)
+		self.assertTrue('Could not find %s/missing.h5'%(out_dir) in logStream.getvalue())
+		OA = writer.output_aggregator(self.fa, h5_file='%s/unfinished.h5'%(out_dir), keep=True)
+		OA.vote('Chr1', 0, 5, np.ones((5, self.n_outputs), dtype=np.uint8))
+		# The vote file is closed without writing its cached votes
+		OA._release()
+		testArgs[-1] = '%s/unfinished.h5'%(out_dir)
+		with patch('sys.argv', testArgs):
+			self.assertRaises(SystemExit, teamRNN.main)
+		self.assertTrue('missing votes from an unfinished classification' in logStream.getvalue())
+		rmtree(out_dir)
+	def test_prefetch_cli(self):
+		out_dir = 'test_prefetch_cli'
+		self._train_cli(out_dir)
+		for prefetch in ('0', '2'):
+			testArgs = ['teamRNN', \
+				'-R', self.fa, \
+				'-D', out_dir, \
+				'-M', self.mr1, \
+				'--workers', '1', \
+				'--prefetch', prefetch, \
+				'classify', \
+				'-O', '%s/out_%s.gff3'%(out_dir, prefetch)]
+			with patch('sys.argv', testArgs):
+				teamRNN.main()
+			self.assertTrue('Done' in logStream.getvalue().split('\n')[-2])
+			self.assertTrue('(prefetch=%s)'%(prefetch) in logStream.getvalue())
+		# Batches prepared in the background give the same predictions
+		with open('%s/out_0.gff3'%(out_dir)) as F1, open('%s/out_2.gff3'%(out_dir)) as F2:
+			self.assertEqual(F1.read(), F2.read())
+		rmtree(out_dir)
+	def test_pipeline_cli(self):
+		out_dir = 'test_pipeline_cli'
+		messages = {'tfdata':'through the tfdata pipeline', 'window':'through the window pipeline', \
+			'stream':'Streaming training chromosomes from disk'}
+		for name, message in sorted(messages.items()):
+			# Every epoch pulls a fresh pass over the training data
+			self._train_cli(out_dir, '--pipeline', name, '-E', '2')
+			self.assertTrue(message in logStream.getvalue())
+			self.assertTrue('Epoch-0001 - Finished training' in logStream.getvalue())
+			self.assertTrue(os.path.exists('%s/training_output.gff3'%(out_dir)))
+			rmtree(out_dir)
+			logStream.truncate(0)
 	def test_stateful_cli_01(self):
 		if not self.test_model: return
 		out_dir, lr, sl = 'test_stateful_cli', '0.01', '4'